@@ -20,6 +20,7 @@ import pygst
 pygst.require('0.10')
 gobject.threads_init()
 import gst
+import numpy as np
 import time
 import os
 
@@ -28,20 +29,44 @@ class ASR():
     BASE = '/home/liamw/Python/audio/MusicDB/model/88a693a77bb44a1ca402fa61b4bc6dbf/'
     NAME = 'MusicDB'
 
+    # Batch decoding pipelines: no VAD and no clock sync, so audio is
+    # decoded as fast as pocketsphinx can go and each input is one utterance.
+    # decodebin makes a new pad for every file, which is linked to
+    # audioconvert by __DecodedPad as the pipeline is reused.
+    FILEPIPELINE = (" filesrc name=src ! decodebin name=dec"
+                    " audioconvert name=conv ! audioresample !"
+                    " pocketsphinx name=asr ! fakesink sync=false")
+    BUFFERPIPELINE = (" appsrc name=src ! audioconvert ! audioresample !"
+                      " pocketsphinx name=asr ! fakesink sync=false")
+    BATCHTIMEOUT = 600       # Seconds allowed for decoding one input
+
     def __init__(self, callback, hmm=None, lm=None, dic=None, nBestSize=0,
-                 latdir=None, fsg=None, tag='cmu', wordLimit=9999, minProb=-5000):
+                 latdir=None, fsg=None, tag='cmu', wordLimit=9999, minProb=-5000,
+                 live=True):
+        """If live is False only the batch Decode methods are used, so the
+           audio source pipeline is not built and the models are loaded
+           only by the batch pipelines
+        """
         self.isPlaying = False
         self.callback = callback
         self.tag = tag
         self.wordLimit = wordLimit
         self.minProb = minProb
-        self.asr = self.__InitGsr(hmm, lm, dic, nBestSize, latdir, fsg)
+        self.batch = {}
+        self.pipeline = None
+        self.asr = self.__InitGsr(hmm, lm, dic, nBestSize, latdir, fsg, live)
+
+    def SetCallback(self, callback, tag=None):
+      """Rebinds results to a new owner, e.g. when reused from a pool"""
+      self.callback = callback
+      if (tag is not None):
+        self.tag = tag
 
     def IsPlaying(self):
       return self.isPlaying
 
     def Play(self):
-      if (self.isPlaying is False):
+      if (self.isPlaying is False and self.pipeline):
         self.pipeline.set_state(gst.STATE_PLAYING)
         self.isPlaying = True
 
@@ -54,15 +79,122 @@ class ASR():
       pass
 
     def Exit(self):
+      for pipeline, asr, results in self.batch.values():
+        pipeline.set_state(gst.STATE_NULL)
+      self.batch = {}
+      if (self.pipeline):
+        self.pipeline.set_state(gst.STATE_NULL)
+      self.isPlaying = False
       self.asr = None
 
-    def __InitGsr(self, hmm, lm, dic, nBestSize, latdir, fsg):
+    def DecodeFiles(self, paths):
+      """Decodes audio files in any format gstreamer can read.
+
+         Returns a list of (path, items, prob, decodeSeconds, audioSeconds)
+         in input order, where items is empty if nothing was recognized and
+         audioSeconds is None if the duration could not be determined.
+      """
+      pipeline, asr, results = self.__GetBatchPipeline(self.FILEPIPELINE)
+      src = pipeline.get_by_name('src')
+      out = []
+      for path in paths:
+        src.set_property('location', path)
+        out.append((path,) + self.__BatchDecode(pipeline, results, None))
+      return out
+
+    def DecodeBuffers(self, buffers, rate=16000, channels=1, sampwidth=2):
+      """Decodes raw PCM byte buffers, returning a list of
+         (index, items, prob, decodeSeconds, audioSeconds)
+      """
+      pipeline, asr, results = self.__GetBatchPipeline(self.BUFFERPIPELINE)
+      src = pipeline.get_by_name('src')
+      caps = ('audio/x-raw-int,endianness=1234,signed=true,width=%d,'
+              'depth=%d,rate=%d,channels=%d' %
+              (sampwidth * 8, sampwidth * 8, rate, channels))
+      src.set_property('caps', gst.Caps(caps))
+      out = []
+      for i, data in enumerate(buffers):
+        seconds = float(len(data)) / (rate * channels * sampwidth)
+        out.append((i,) + self.__BatchDecode(pipeline, results, src, data,
+                                             seconds))
+      return out
+
+    def DecodeArrays(self, arrays, rate=16000):
+      """Decodes mono numpy arrays of int16 samples, or floats in the range
+         -1.0 to 1.0, returning results as DecodeBuffers
+      """
+      def Pcm(a):
+        a = np.asarray(a)
+        if (a.dtype.kind == 'f'):
+          a = np.clip(a, -1.0, 1.0) * 32767
+        return a.astype('<i2').tostring()
+      return self.DecodeBuffers((Pcm(a) for a in arrays), rate)
+
+    def __GetBatchPipeline(self, description):
+      """Batch pipelines are built once so the models are only loaded once"""
+      if (description not in self.batch):
+        pipeline = gst.parse_launch(description)
+        dec = pipeline.get_by_name('dec')
+        if (dec):
+          sink = pipeline.get_by_name('conv').get_pad('sink')
+          dec.connect('new-decoded-pad', self.__DecodedPad, sink)
+        asr = pipeline.get_by_name('asr')
+        results = []
+        asr.connect('result', self.__BatchResult, results)
+        self.__ConfigureAsr(asr)
+        self.batch[description] = (pipeline, asr, results)
+      return self.batch[description]
+
+    def __DecodedPad(self, dec, pad, last, sink):
+        """Links the audio pad decodebin makes for each file"""
+        if (not pad.get_caps()[0].get_name().startswith('audio/')):
+          return
+        if (sink.is_linked()):
+          sink.get_peer().unlink(sink)
+        pad.link(sink)
+
+    def __BatchResult(self, asr, text, uttid, prob, score, results):
+        items = [text] if (text) else []
+        if (text and self.nBestSize > 0):
+          items += asr.get_property('nbest')
+        results.append((items, prob))
+
+    def __BatchDecode(self, pipeline, results, src, data=None, seconds=None):
+        """Runs one input through to end of stream"""
+        del results[:]
+        start = time.time()
+        pipeline.set_state(gst.STATE_PLAYING)
+        if (src is not None):
+          src.emit('push-buffer', gst.Buffer(data))
+          src.emit('end-of-stream')
+        bus = pipeline.get_bus()
+        msg = bus.poll(gst.MESSAGE_EOS | gst.MESSAGE_ERROR,
+                       self.BATCHTIMEOUT * gst.SECOND)
+        if (msg is None or msg.type == gst.MESSAGE_ERROR):
+          print "Batch decode failed:", msg.parse_error() if (msg) else 'timeout'
+        elif (seconds is None):
+          try:
+            seconds = float(pipeline.query_duration(gst.FORMAT_TIME)[0]) / gst.SECOND
+          except gst.QueryError:
+            pass
+        elapsed = time.time() - start
+        pipeline.set_state(gst.STATE_READY)
+        if (len(results) == 0):
+          return ([], None, elapsed, seconds)
+        items, prob = results[-1]
+        return (items, prob, elapsed, seconds)
+
+    def __InitGsr(self, hmm, lm, dic, nBestSize, latdir, fsg, live):
         if (hmm is None):
           hmm = self.BASE
         if (lm is None):
           lm = self.BASE + self.NAME + '.lm'
         if (dic is None):
           dic = self.BASE + self.NAME + '.dic'
+        self.config = (hmm, lm, dic, latdir, fsg)
+        self.nBestSize = nBestSize
+        if (not live):
+          return None
         pipeline =  " gconfaudiosrc ! audioconvert ! audioresample !"
         pipeline += " vader name=vad auto-threshold=true !"
         pipeline += " pocketsphinx"
@@ -70,6 +202,13 @@ class ASR():
         pipeline += " ! fakesink"
         self.pipeline = gst.parse_launch(pipeline)
         asr = self.pipeline.get_by_name('asr')
+        asr.connect('partial_result', self.__AsrPartial)
+        asr.connect('result', self.__AsrResult)
+        self.__ConfigureAsr(asr)
+        return asr
+
+    def __ConfigureAsr(self, asr):
+        hmm, lm, dic, latdir, fsg = self.config
         if (os.path.exists(hmm)):
           asr.set_property('hmm', hmm[:-1]) # FIXME: Remove trailing '/'
         if (not fsg and os.path.exists(lm)):
@@ -80,19 +219,16 @@ class ASR():
           asr.set_property('latdir', latdir)
         if (fsg):
           asr.set_property('fsg', fsg)
-        self.nBestSize = nBestSize
-        if (nBestSize > 0):
-          asr.set_property('nbest_size', nBestSize)
-        asr.connect('partial_result', self.__AsrPartial)
-        asr.connect('result', self.__AsrResult)
+        if (self.nBestSize > 0):
+          asr.set_property('nbest_size', self.nBestSize)
         asr.set_property('configured', True)
-        return asr
 
     def __AsrPartial(self, asr, text, uttid):
         items = [text]
         nbest = asr.get_property('nbest')
         if (self.nBestSize > 0): items += nbest
-        self.callback('partial', self.tag, items)
+        if (self.callback):
+          self.callback('partial', self.tag, items)
 
     def __AsrResult(self, asr, text, uttid, prob, score):
         items = [text]
@@ -100,5 +236,6 @@ class ASR():
         nbest = asr.get_property('nbest')
         if (self.nBestSize > 0): items += nbest
         # Reject anything that is not within word count and probability limits
-        if (len(text.split(' ')) <= self.wordLimit and prob >= self.minProb):
+        if (self.callback and len(text.split(' ')) <= self.wordLimit and
+            prob >= self.minProb):
           self.callback('result', self.tag, items)
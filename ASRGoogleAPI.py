@@ -16,12 +16,14 @@ PARTICULAR PURPOSE.
 """
 
 from SpeechRecord import SpeechRecord
+from VAD import AdaptiveVAD, HangoverVAD
+from AudioEncode import AudioEncoder, FLAC, CONTENTTYPES
+from SpeechTransport import HTTPTransport
+from WorkQueue import WorkQueue
+from SpeechStream import ParseResults
 import threading
-import os
 import sys
-import subprocess
 import json
-import requests
 
 class ASRGoogleAPI(threading.Thread):
 
@@ -29,101 +31,169 @@ class ASRGoogleAPI(threading.Thread):
   RATE = 16000             # 16KHz is only rate supported by Google
   INITIALTIMEOUT = 10      # How long to wait before aborting start
   DEFAULTTIMEOUT = 2       # How long to wait before aborting end
-  MINLENGTH = 4            # Minimum number of frames in recording to submit
-
-  def __init__(self, callback, timeout=DEFAULTTIMEOUT, tag='google'):
-    self.queue = []
-    self.event = threading.Event()
+  MINLENGTH = 1.0          # Minimum duration in seconds of recording to submit
+  CHUNKMS = 30             # Capture chunk size in milliseconds
+  WORKERS = 4              # Maximum number of recognitions in flight
+  QUEUESIZE = 8            # Maximum number of utterances awaiting upload
+  URL = 'https://www.google.com/speech-api/v1/recognize?client=chromium&lang=en-QA&maxresults=10'
+
+  def __init__(self, callback, timeout=DEFAULTTIMEOUT, tag='google',
+               chunkMs=CHUNKMS, vad=None, url=URL, workers=WORKERS,
+               requestTimeout=HTTPTransport.TIMEOUT, queueSize=QUEUESIZE,
+               policy=WorkQueue.DROPOLDEST, streaming=None, loop=None):
+    """If a streaming backend is given, audio is uploaded while the user is
+       still speaking and 'partial' events are reported before the final
+       'result'; otherwise each utterance is posted once it is complete.
+
+       If a RecognizerLoop is given, audio processing and uploads run on
+       the loop thread using the loop's shared transport and encoder, and
+       no thread of this recognizer's own is started.
+    """
+    self.queue = WorkQueue(queueSize, policy)
+    self.streaming = streaming
+    self.activeStream = None
     self.stop = False
     self.isPlaying = False
-    self.counter = 0
-    self.pending = False
-    self.flushing = False
     self.timeout = timeout
     self.callback = callback
     self.tag = tag
-    self.rec = SpeechRecord(rate=self.RATE, callback=self.__RecordingComplete)
+    self.loop = loop
+    if (vad is None):
+      vad = HangoverVAD(AdaptiveVAD())
+    if (streaming):
+      streamCallback = self.__StreamAudio
+    else:
+      streamCallback = None
+    self.rec = SpeechRecord(rate=self.RATE, callback=self.__RecordingComplete,
+                            chunkMs=chunkMs, mode=SpeechRecord.CALLBACK,
+                            vad=vad, streamCallback=streamCallback,
+                            post=loop.Post if (loop) else None)
     threading.Thread.__init__(self)
-    self.start()
+    if (loop):
+      self.encoder = loop.GetEncoder(self.rec.channels,
+                                     self.rec.GetSampleWidth(), self.RATE)
+      self.transport = loop.GetTransport(url, workers, requestTimeout)
+      # One callback for every request keeps this session's results in
+      # order without waiting on other sessions sharing the transport
+      self.responseCallback = lambda generation, r: \
+        loop.Post(self.__TransportResponse, generation, r)
+      # Slots freed by any session sharing the transport may suit us
+      self.slotListener = lambda: loop.Post(self.__Pump)
+      self.transport.AddSlotListener(self.slotListener)
+    else:
+      self.encoder = AudioEncoder(self.rec.channels,
+                                  self.rec.GetSampleWidth(), self.RATE)
+      self.transport = HTTPTransport(url, self.__TransportResponse,
+                                     workers=workers, timeout=requestTimeout)
+      self.start()
 
   def __StartNewRecording(self):
-    self.pending = True
     #print "* Started new recording"
     self.rec.StartRecord(maxSeconds=self.MAXRECTIME,
                          timeout=self.timeout,
                          initTimeout=self.INITIALTIMEOUT)
  
   def __RecordingComplete(self):
-    self.pending = False
     info = self.rec.GetRecordingInfo()
     #print "* Recording complete:", info[0], "frames"
-    if (info[0] >= self.MINLENGTH and self.isPlaying):
-      filename = "__ASRGoogleAPI__" + str(self.counter) + ".flac"
-      self.rec.WriteFileAndClose(filename)
-      self.counter += 1
-      self.__Enqueue(filename)
-      #print "* Queued:", filename
-      self.event.set()
+    seconds = float(info[0] * self.rec.chunk) / self.RATE
+    if (self.activeStream):
+      # Streamed utterances have already been uploaded
+      if (seconds >= self.MINLENGTH and self.isPlaying):
+        self.activeStream.End()
+      else:
+        self.activeStream.Cancel()
+      self.activeStream = None
+    elif (seconds >= self.MINLENGTH and self.isPlaying and
+          not self.streaming):
+      # Encoding happens on the encoder's pool so capture carries on
+      audio = self.encoder.EncodeAsync(self.rec.GetRecordingViews(), FLAC)
+      self.queue.Put(audio)
+      #print "* Queued:", seconds, "seconds"
+      if (self.loop):
+        self.__Pump()
     if (self.isPlaying):
       self.__StartNewRecording()
 
-  def __GoogleAPITransaction(self, filename):
-
-    url = 'https://www.google.com/speech-api/v1/recognize?client=chromium&lang=en-QA&maxresults=10'
-    headers = { 'Content-Type': 'audio/x-flac; rate='+str(self.RATE)+';' }
-    fd = open(filename, 'r')
-    files = { 'file': (filename, fd) }
-    r = requests.post(url, files=files, headers=headers)
-    fd.close()
-    text = r.text
+  def __StreamAudio(self, data):
+    """Called by the recorder with audio as soon as speech is detected"""
+    if (self.activeStream is None):
+      generation = self.queue.GetGeneration()
+      callback = lambda event, items: \
+                   self.__StreamResult(event, items, generation)
+      self.activeStream = self.streaming.Begin(callback)
+    self.activeStream.Feed(data)
+
+  def __StreamResult(self, event, items, generation):
+    if (self.callback and self.isPlaying and self.queue.IsCurrent(generation)):
+      self.callback(event, self.tag, items)
+
+  def __GoogleAPITransaction(self, audio, generation):
+    """Submits audio (bytes or a pending encode) to the transport"""
+    headers = { 'Content-Type': CONTENTTYPES[FLAC]+'; rate='+str(self.RATE)+';' }
+    callback = self.responseCallback if (self.loop) else None
+    self.transport.Submit(audio, headers, context=generation,
+                          callback=callback)
+
+  def __TransportResponse(self, generation, r):
+    """Called by the transport with each response, in submission order"""
+    if (not self.queue.IsCurrent(generation)):
+      return     # Cancelled by a flush while in flight
+    if (r is None):
+      print "Was not able to reach the API"
+      return
+    resp = self.__ParseResponse(r.text)
+    if (resp and self.callback and self.isPlaying):
+      self.callback('result', self.tag, resp)
+
+  def __ParseResponse(self, text):
 
     try:
-      resp = json.loads(text)
-      if ('status' in resp.keys() and resp['status'] == 0):
-        if ('hypotheses' in resp.keys() and len(resp['hypotheses']) > 0):
-          return [resp['hypotheses'][i]['utterance'].upper() for i in range(0,len(resp['hypotheses']))]
+      for event, items in ParseResults(json.loads(text)):
+        if (event == 'result'):
+          return items
     except:
       print "Was not able to process API response:", sys.exc_info()[0]
       print "Raw text for debug:", text
 
     return None
 
-  def __Enqueue(self, filename):
-    self.queue += [filename]
-    #print "* Queue contents: ", self.queue
-
-  def __Dequeue(self):
-    if (len(self.queue) > 0):
-      head = self.queue[0]
-      self.queue = self.queue[1:]
-      return head
-    return None
-
-  def __Remove(self, filename):
-    os.remove(filename)
-
   def Flush(self):
-    self.flushing = True
+    """Discards queued utterances and cancels those already in flight"""
+    self.queue.Flush()
+    if (self.loop is None):
+      # A shared transport also carries other sessions' requests, and the
+      # generation check already drops ours
+      self.transport.Flush()
+
+  def GetQueueStats(self):
+    stats = self.queue.GetStats()
+    stats['inFlight'] = self.transport.GetPending()
+    return stats
+
+  def __Pump(self):
+    """Submits queued utterances while the transport has room (loop mode)"""
+    while (not self.stop and self.transport.HasSlot()):
+      job = self.queue.Get(timeout=0)
+      if (job is None):
+        break
+      audio, generation = job
+      if (self.isPlaying):
+        self.__GoogleAPITransaction(audio, generation)
 
   def run(self):
     while (not self.stop):
-      self.event.wait()
-      self.event.clear()
-      #print "* Woken up to check the queue"
-      while (True):
-        filename = self.__Dequeue()
-        #print "* Got the following:", filename
-        if (filename):
-          if (self.isPlaying and not self.flushing):
-            resp = self.__GoogleAPITransaction(filename)
-            if (resp and self.callback):
-              self.callback('result', self.tag, resp)
-          #else:
-            #print "* Ignoring since isPlaying:", self.isPlaying
-          self.__Remove(filename)
-        else:
-          self.flushing = False
-          break
+      # Leave utterances in the bounded queue until the transport has
+      # room, so back-pressure applies to the queue rather than piling up
+      self.transport.WaitForSlot()
+      job = self.queue.Get()
+      if (job is None):
+        break
+      audio, generation = job
+      if (self.isPlaying):
+        self.__GoogleAPITransaction(audio, generation)
+      #else:
+        #print "* Ignoring since isPlaying:", self.isPlaying
  
   def IsPlaying(self):
     return self.isPlaying
@@ -139,6 +209,14 @@ class ASRGoogleAPI(threading.Thread):
   def Exit(self):
     self.Pause()
     self.stop = True
-    self.event.set()
-    self.join()
+    self.queue.Close()
+    # Stops the capture stream, which would otherwise keep calling back
+    self.rec.Exit()
+    if (self.loop):
+      # The transport and encoder belong to the loop
+      self.transport.RemoveSlotListener(self.slotListener)
+    else:
+      self.join()
+      self.transport.Exit()
+      self.encoder.Exit()
 
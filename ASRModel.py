@@ -16,8 +16,20 @@ KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
 IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
 PARTICULAR PURPOSE.
 """
-import os, errno, shutil, uuid, subprocess, re, glob
+import os, errno, shutil, uuid, subprocess, re, glob, hashlib, tempfile
+import random
+from multiprocessing.pool import ThreadPool
 from SpeechRecord import *
+import ParallelDecode
+from FeatureCache import FeatureCache, LinkTree, LinkFile, HashFile
+from ParallelCmd import RunCommands, DefaultJobs
+from BuildGraph import BuildGraph
+from LanguageModel import LanguageModel, LanguageModelExceptionBadCounts
+from PronunciationStore import PronunciationStore, ReadDictionary
+from CorpusIndex import CorpusIndex
+from CorpusStore import CorpusStore
+from TrainingManifest import TrainingManifest
+from UtteranceArchive import UtteranceArchive, PackDirectory, UnpackArchive
 
 class ASRModelExceptionEnvironmentNotSetup:
   pass
@@ -26,15 +38,30 @@ class ASRModel:
 
   MODELS = "ASRMODELS"
   VOICES = "/usr/share/mbrola/voices/"
+  VOICE = "en1"
+  SYNTHRATE = 115     # espeak words per minute
   SPHINXTRAIN = "/usr/local/lib/sphinxtrain/"
   WORDALIGN = "/usr/local/lib/sphinxtrain/scripts/decode/word_align.pl"
   SPHINXLIBEXEC = "/usr/local/libexec/sphinxtrain/"
   CMUSPEECHURL = "http://www.speech.cs.cmu.edu/cgi-bin/tools/lmtool/run"
   LOGIOSTOOLS = "~/Projects/cmusphinx-code-12331-trunk/logios/Tools"
-  DICTCMD = "MakeDict/make_pronunciation.pl"
   TRAINING = "/training/"
   MODEL = "/model/"
   OUTPUT = "/output/"
+  FEATURES = "features/"
+  ACCUM = "accum."
+  STAGES = "stages/"
+  FEATLIST = "features.list"
+  LMORDER = 3
+  COUNTS = ".counts"
+  PRONUNCIATIONS = "pronunciations.dic"
+  INDEX = ".index"
+  INDEXSAVE = 10000   # Lines indexed before the index is saved again
+  MANIFEST = ".manifest"
+  ARCHIVE = ".archive"
+  EXPORT = "wav/"
+  SYNTH = "synth/"
+  JOURNAL = ".journal"
   TEXT = ".txt"
   WAV = ".wav"
   TRAN = ".transcription"
@@ -63,6 +90,11 @@ class ASRModel:
     self.fileids = self.training + self.name + self.FILEIDS
     self.corpus = self.training + self.name + self.CORPUS
     self.trans = self.training + self.name + self.TRAN
+    self.counts = self.training + self.name + self.COUNTS
+    self.ngrams = None
+    self.index = None
+    self.store = None
+    self.jobs = None
     self.output  = self.root + self.OUTPUT
     self.__mkdir(self.root)
     self.__mkdir(self.training)
@@ -75,8 +107,15 @@ class ASRModel:
     self.model = self.root + self.MODEL + model + "/"
     self.dict = self.model + self.name + self.DICT
     self.lm = self.model + self.name + self.LM
-    # Load all IDs from training data
-    self.GetAllIds()
+    # Training entries are listed by the manifest, which is filled in from
+    # the training directory the first time it is opened
+    self.manifest = TrainingManifest(self.training + self.name + self.MANIFEST,
+                                     self.training)
+    # Sessions holding their audio in a packed archive have one here
+    self.archivePath = self.training + self.name + self.ARCHIVE
+    self.archive = None
+    if (os.path.exists(self.archivePath)):
+      self.archive = UtteranceArchive(self.archivePath)
     # Make sure corpus file exists if not already created
     with open(self.corpus, 'a') as f: f.close()
 
@@ -136,65 +175,142 @@ class ASRModel:
       cmd = [ 'play', f ]
       self.__RunCmd(cmd, debug=True)
       return True
+    if (self.archive and self.archive.Has(id)):
+      fd, f = tempfile.mkstemp(suffix=self.WAV)
+      os.close(fd)
+      try:
+        self.archive.WriteWave(id, f)
+        self.__RunCmd([ 'play', f ], debug=True)
+      finally:
+        os.remove(f)
+      return True
     return False
 
-  def FindSubstring(self, text):
+  def IsPacked(self):
+    return (self.archive is not None)
+
+  def PackTraining(self):
+
+    # Moves every wave file and transcript into the packed archive, after
+    # which the training directory only holds generated files
+    if (self.archive is None):
+      self.archive = UtteranceArchive(self.archivePath)
+    packed = 0
+    for id in self.manifest.GetIds():
+      sent = self.manifest.GetTranscript(id)
+      wav = self.training + id + self.WAV
+      if (os.path.exists(wav)):
+        with open(wav, 'rb') as f:
+          data = f.read()
+          f.close()
+        self.archive.Add(id, data, sent)
+        self.manifest.SetWave(id, self.archivePath, data, commit=False)
+        os.remove(wav)
+        packed += 1
+      if (os.path.exists(self.training + id + self.TEXT)):
+        os.remove(self.training + id + self.TEXT)
+    self.manifest.Commit()
+    return packed
+
+  def UnpackTraining(self):
+
+    # Writes the archive back out as wave and transcript files
+    if (self.archive is None):
+      return 0
+    for id in self.manifest.GetIds():
+      with open(self.training + id + self.TEXT, 'w') as f:
+        f.write(self.manifest.GetTranscript(id))
+        f.close()
+      if (self.archive.Has(id)):
+        wav = self.training + id + self.WAV
+        self.archive.WriteWave(id, wav)
+        self.manifest.SetWave(id, wav, commit=False)
+    self.manifest.Commit()
+    count = self.archive.GetCount()
+    self.archive.Close()
+    self.archive = None
+    for f in (self.archivePath, self.archivePath + UtteranceArchive.INDEX):
+      os.remove(f)
+    return count
+
+  def CompactTraining(self):
+
+    # Reclaims the space of deleted utterances in the archive
+    if (self.archive is None):
+      return 0
+    wasted = self.archive.GetWastedBytes()
+    self.archive.Compact()
+    return wasted
+
+  def ExportWaves(self, path, ids=None):
+
+    # Writes <id>.wav for the given (by default all ready) entries to a
+    # directory, for tools that need ordinary wave files
+    if (path[-1] != '/'): path += '/'
+    self.__mkdir(path)
+    if (ids is None):
+      ids = self.manifest.GetIds(TrainingManifest.READY)
+    packed = []
+    for id in ids:
+      wav = self.training + id + self.WAV
+      if (os.path.exists(wav)):
+        LinkFile(wav, path + id + self.WAV)
+      else:
+        packed.append(id)
+    if (self.archive and packed):
+      self.archive.WriteWaves([id for id in packed if self.archive.Has(id)],
+                              path)
+    return len(ids)
 
-    k = 0
-    hits = []
-    with open(self.corpus, 'r') as f:
-      for line in f:
-        res = text in line
-        if (res):
-          hits.append((k, line.strip()))
-        k += 1
-    return hits
+  def __GetCorpusStore(self):
 
-  def FindContainsOrderedWords(self, text):
+    if (self.store is None):
+      self.store = CorpusStore(self.corpus)
+    else:
+      self.store.Refresh()
+    return self.store
 
-    k = 0
-    hits = []
-    words = text.split(' ')
-    with open(self.corpus, 'r') as f:
-      for line in f:
-        nextpos = 0
-        for w in words:
-          pos = line[nextpos:].find(w)
-          if (pos >= 0):
-            nextpos += len(w)
-          else:
-            break
-        if (pos >= 0):
-          hits.append((k, line.strip()))
-          k += 1
-    return hits
+  def __GetCorpusIndex(self):
 
-  def FindStartsWith(self, text):
+    # The index catches up with lines appended since it was last saved
+    if (self.index is None):
+      self.index = CorpusIndex(self.__GetCorpusStore(), self.corpus + self.INDEX)
+    else:
+      self.__GetCorpusStore()
+    self.index.Update()
+    if (self.index.GetPending() >= self.INDEXSAVE):
+      self.index.Save()
+    return self.index
 
-    k = 0
-    hits = []
-    with open(self.corpus, 'r') as f:
-      for line in f:
-        res = line.startswith(text)
-        if (res):
-          hits.append((k, line.strip()))
-        k += 1
-    return hits
+  def SaveIndexes(self):
 
-  def Find(self, regexp):
+    # Persist the corpus index and n-gram counts so the next session only
+    # has to catch up with lines added after this point
+    if (self.index and self.index.GetPending() > 0):
+      self.index.Save()
+    if (self.ngrams):
+      self.__SaveNgramCounts()
 
-    k = 0
-    hits = []
-    with open(self.corpus, 'r') as f:
-      for line in f:
-        res = re.findall(regexp, line)
-        if (res):
-          hits.append((k, line.strip()))
-        k += 1
-    return hits
+  def FindSubstring(self, text):
+    return self.__GetCorpusIndex().FindSubstring(text)
+
+  def FindContainsOrderedWords(self, text):
+    return self.__GetCorpusIndex().FindOrderedWords(text.split())
+
+  def FindStartsWith(self, text):
+    return self.__GetCorpusIndex().FindStartsWith(text)
+
+  def Find(self, regexp):
+    return self.__GetCorpusIndex().Find(regexp)
 
   def DeleteCorpus(self):
     with open(self.corpus, 'w') as f: f.close()
+    if (os.path.exists(self.counts)): os.remove(self.counts)
+    self.ngrams = None
+    self.index = None
+    if (self.store): self.store.Refresh()
+    if (os.path.exists(self.corpus + self.INDEX)):
+      os.remove(self.corpus + self.INDEX)
 
   def DeleteModel(self, id):
 
@@ -206,41 +322,153 @@ class ASRModel:
     else:
       return False
 
+  def GetModelDiskUsage(self):
+
+    # Files shared by several model versions are only counted once in the
+    # total, which is the space actually used
+    path = self.root + self.MODEL
+    usage = []
+    seen = set()
+    total = 0
+    for id in self.ListModels():
+      size = 0
+      for root, dirs, files in os.walk(path + id):
+        for name in files:
+          st = os.lstat(os.path.join(root, name))
+          size += st.st_size
+          if ((st.st_dev, st.st_ino) not in seen):
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+      usage.append((id, size))
+    return (usage, total)
+
   def DeleteEntry(self, id):
+    return (len(self.DeleteEntries([ id ])) > 0)
 
-    f = self.training + id + self.TEXT
-    if (os.path.exists(f)):
-      os.remove(f)
-      f = self.training + id + self.WAV
-      if (os.path.exists(f)):
-        os.remove(f)
-      return True
-    return False
+  def DeleteEntries(self, ids=None):
 
-  def __TextToWaveFile(self, path, sent):
+    # Removes the entries in one transaction, or all of them if no ids are
+    # given, and returns the ids that were deleted
+    if (ids is None):
+      deleted = self.manifest.Clear()
+    else:
+      deleted = self.manifest.Delete(ids)
+    if (self.archive):
+      self.archive.Remove(deleted)
+    for id in deleted:
+      for f in (self.training + id + self.TEXT, self.training + id + self.WAV):
+        if (os.path.exists(f)):
+          os.remove(f)
+    return deleted
+
+  def __TextToWaveFile(self, path, sent, voice=VOICE, rate=SYNTHRATE):
 
-    rate = 115
-    voice = 'mb-en1'
-    mbvoice = self.VOICES + 'en1'
-    pho = '/tmp/tmp.pho'
     # This relies on 'espeak' to generate phonics output
     # which is then used by 'mbrola' text-to-voice software.
-    cmd = [ 'espeak', '-s', str(rate), '-v', voice, '"'+sent+'"', '--pho',
-            '--phonout', pho ]
-    self.__RunCmd(cmd, debug=True)
-    cmd = ['mbrola', mbvoice, pho, path ]
-    self.__RunCmd(cmd, debug=True)
-
-  def AutoAddUtterancesFile(self, path, numEntries=None):
-    new = []
-    k = 0
+    # Each call has its own .pho file so several can run at once.
+    fd, pho = tempfile.mkstemp(suffix='.pho')
+    os.close(fd)
+    try:
+      cmd = [ 'espeak', '-s', str(rate), '-v', 'mb-' + voice, '"'+sent+'"',
+              '--pho', '--phonout', pho ]
+      ok = (self.__RunCmd(cmd, debug=True) == 0)
+      if (ok):
+        cmd = ['mbrola', self.VOICES + voice, pho, path ]
+        ok = (self.__RunCmd(cmd, debug=True) == 0)
+    finally:
+      os.remove(pho)
+    if (not ok and os.path.exists(path)):
+      # A failed run may leave a truncated wave file behind
+      os.remove(path)
+    return (ok and os.path.exists(path))
+
+  def __ReadJournal(self, journal):
+
+    # Maps line number -> id for lines synthesized by an earlier run
+    done = {}
+    if (os.path.exists(journal)):
+      with open(journal, 'r') as f:
+        for line in f:
+          parts = line.split()
+          if (len(parts) == 2 and line.endswith(self.NEWLINE)):
+            done[int(parts[0])] = parts[1]
+        f.close()
+    return done
+
+  def AutoAddUtterancesFile(self, path, numEntries=None, jobs=None,
+                            voices=None, rates=None, progress=None):
+    """Synthesizes an utterance for each line of a file on up to jobs
+       concurrent espeak/mbrola runs and returns their ids in line order.
+
+       voices is a list of mbrola voices and rates a (min, max) range of
+       espeak rates, chosen per line for variety.  progress(done, total)
+       is called as utterances are added.  Lines are journaled under the
+       file and the voices, rates and numEntries given, so running again
+       with the same settings only synthesizes lines which are not already
+       training entries, such as those left by an interrupted run, while
+       other voices or rates add a new utterance for every line.
+    """
+    sents = []
     with open(path, 'r') as f:
       for line in f:
-        if (numEntries is not None and k == numEntries): break
-        new.append(self.AutoAddUtterance(line.strip()))
-        k += 1
+        if (numEntries is not None and len(sents) == numEntries): break
+        sents.append(line.strip())
       f.close()
-    return new
+    if (not voices): voices = [ self.VOICE ]
+    if (not rates): rates = (self.SYNTHRATE, self.SYNTHRATE)
+
+    # Completed lines are journaled under the hash of the file and the
+    # settings, so only a rerun of the same synthesis resumes
+    settings = repr((numEntries, list(voices), tuple(rates)))
+    key = hashlib.sha1(HashFile(path) + settings).hexdigest()
+    journal = self.output + 'synth.' + key + self.JOURNAL
+    done = self.__ReadJournal(journal)
+    # Lines whose entries have since been deleted are synthesized again
+    done = dict((k, id) for k, id in done.iteritems()
+                if (k < len(sents) and self.manifest.Has(id)))
+    if (done):
+      print "Skipping", len(done), "lines synthesized by an earlier run"
+    todo = [k for k in range(len(sents)) if k not in done]
+    synthdir = self.output + self.SYNTH
+    self.__mkdir(synthdir)
+
+    def Synth(k):
+      rng = random.Random(k)
+      voice = rng.choice(voices)
+      rate = rng.randint(rates[0], rates[-1])
+      id = self.__RandName()
+      wav = synthdir + id + self.WAV
+      if (self.__TextToWaveFile(wav, sents[k], voice, rate)):
+        return (k, id, wav)
+      return (k, None, None)
+
+    jobs = jobs if (jobs) else DefaultJobs()
+    pool = ThreadPool(max(1, min(jobs, len(todo))))
+    failed = 0
+    try:
+      with open(journal, 'a') as log:
+        # Results arrive in line order while the pool keeps synthesizing,
+        # and only this thread touches the manifest and archive
+        for k, id, wav in pool.imap(Synth, todo):
+          if (id is None):
+            failed += 1
+          else:
+            self.AddSentence(sents[k], id)
+            dst = self.training + id + self.WAV
+            os.rename(wav, dst)
+            self.__StoreWave(id, dst)
+            done[k] = id
+            log.write("%d %s" % (k, id) + self.NEWLINE)
+            log.flush()
+          if (progress):
+            progress(len(done) + failed, len(sents))
+        log.close()
+    finally:
+      # Lines still being synthesized when interrupted are redone next time
+      pool.terminate()
+      pool.join()
+      shutil.rmtree(synthdir, ignore_errors=True)
+    return [done[k] for k in range(len(sents)) if k in done]
 
   def AddUtterancesFile(self, path, numEntries=None):
     new = []
@@ -255,11 +483,12 @@ class ASRModel:
       f.close()
     return new
 
-  def AutoAddUtterance(self, sent):
+  def AutoAddUtterance(self, sent, voice=VOICE, rate=SYNTHRATE):
 
     id = self.AddSentence(sent)
     path = self.root + self.TRAINING + id + self.WAV
-    self.__TextToWaveFile(path, sent)
+    if (self.__TextToWaveFile(path, sent, voice, rate)):
+      self.__StoreWave(id, path)
     return id
 
   def AddUtterance(self, sent):
@@ -274,6 +503,7 @@ class ASRModel:
       path = self.root + self.TRAINING + id + self.WAV
       sr.WriteFileAndClose(path)
       sr.Exit()
+      self.__StoreWave(id, path)
       return (info, id)
     print "**** No sound detected!"
     return None
@@ -282,28 +512,66 @@ class ASRModel:
 
     if (id is None):
       id = self.__RandName()
-    path = self.root + self.TRAINING + id + self.TEXT
-    with open(path, 'w') as f:
-      f.write(sent.upper())
-      f.close() 
+    if (self.archive is None):
+      path = self.root + self.TRAINING + id + self.TEXT
+      with open(path, 'w') as f:
+        f.write(sent.upper())
+        f.close() 
+    self.manifest.Add(id, sent.upper())
     return id
 
+  def __StoreWave(self, id, path):
+
+    # In a packed session the new wave file is moved into the archive
+    if (self.archive is None):
+      self.manifest.SetWave(id, path)
+      return
+    with open(path, 'rb') as f:
+      data = f.read()
+      f.close()
+    self.archive.Add(id, data, self.manifest.GetTranscript(id))
+    self.manifest.SetWave(id, self.archivePath, data)
+    os.remove(path)
+
   def UpdateTraining(self):
-    self.GetAllIds()
     self.__WriteFileids()
     self.__WriteTranscriptions()
 
-  def BuildModel(self, name=None):
+  def BuildModel(self, name=None, jobs=None):
+    """Adapts the current model into a new one.  Stages whose inputs have
+       not changed since the last build are restored rather than re-run.
+       Returns a list of (stage, 'built' or 'skipped').
+    """
+    self.jobs = jobs
     self.__MakeAdaptDir(name)
-    self.__BuildDict()
-    self.__MakeAcousticFeatures()
-    self.__CollectStatistics()
-    self.__MLLRTransform()
-    self.__MAPAdapt()
-    self.__MakeSendump()
+    self.dict = self.adapt + self.name + self.DICT
+    self.lm = self.adapt + self.name + self.LM
+    self.accumdirs = self.__AccumDirs()
+    base = [ self.model + f for f in
+             ('means', 'variances', 'mixture_weights', 'transition_matrices') ]
+    adapted = [ self.adapt + f for f in
+                ('means', 'variances', 'mixture_weights', 'transition_matrices') ]
+    graph = BuildGraph(self.output + self.STAGES)
+    graph.Add('dict', self.__BuildDict, inputs=[ self.corpus ],
+              outputs=[ self.dict, self.lm, self.adapt + self.name + '.vocab' ])
+    graph.Add('features', self.__MakeAcousticFeatures)
+    graph.Add('bw', self.__CollectStatistics,
+              inputs=[ self.model[:-1], self.dict, self.fileids, self.trans,
+                       self.output + self.FEATLIST ],
+              outputs=self.accumdirs, after=[ 'dict', 'features' ])
+    graph.Add('mllr', self.__MLLRTransform,
+              inputs=base[:2] + self.accumdirs,
+              outputs=[ self.output + 'mllr_matrix' ], after=[ 'bw' ])
+    graph.Add('map', self.__MAPAdapt, inputs=base + self.accumdirs,
+              outputs=adapted, after=[ 'bw' ])
+    graph.Add('sendump', self.__MakeSendump,
+              inputs=[ self.adapt + 'mdef.txt', self.adapt + 'mixture_weights' ],
+              outputs=[ self.adapt + 'sendump' ], after=[ 'map' ])
+    stages = graph.Run()
     self.model = self.adapt   # Transition to new model
+    return stages
 
-  def TestModel(self, name=None, path=None):
+  def TestModel(self, name=None, path=None, jobs=1):
 
     # If no test directory is given, simply use the training directory
     # as a self-test of how good the model is...
@@ -316,46 +584,74 @@ class ASRModel:
       fileids = path + "/" + name + self.FILEIDS
       hyp = self.training + self.name + self.HYP
 
-    cmd = [ 'pocketsphinx_batch', '-adcin', 'yes', '-cepdir', 
-            path, '-cepext', self.WAV, '-ctl', fileids,
-            '-lm', self.lm, '-dict', self.dict, '-hmm', self.model,
-            '-hyp', hyp ]
-    self.__RunCmd(cmd, debug=True)
+    export = None
+    if (self.archive and path == self.training):
+      # Packed audio is written out for the decoder and removed afterwards
+      export = tempfile.mkdtemp(prefix='test', dir=self.output)
+      self.ExportWaves(export, ParallelDecode.ReadControlFile(fileids))
+      path = export
+    try:
+      return self.__TestModel(path, fileids, hyp, jobs)
+    finally:
+      if (export): shutil.rmtree(export, ignore_errors=True)
+
+  def __TestModel(self, path, fileids, hyp, jobs):
+
+    # A single job decodes the whole control file as one shard
+    ids = ParallelDecode.ReadControlFile(fileids)
+    missing = ParallelDecode.DecodeBatch(ids, path, self.model, self.lm,
+                                         self.dict, hyp, jobs=jobs,
+                                         cepext=self.WAV, logfile=self.logfile)
+    if (missing):
+      print "No hypothesis for", missing, "of", len(ids), "utterances"
     cmd = [ self.WORDALIGN, self.trans, hyp ] 
     resp = self.__RunCmd(cmd)
     return resp[0]
 
   def ReadSentence(self, id):
-
-    path = self.root + self.TRAINING + id + self.TEXT
-    with open(path, 'r') as f:
-      sent = f.read()
-      f.close() 
-      return sent
+    return self.manifest.GetTranscript(id)
 
   def GetTrainingSize(self):
-    return len(self.idList)
+    return self.manifest.GetCount()
+
+  def GetTrainingDuration(self):
+    return self.manifest.GetDuration()
 
   def GetCorpusSize(self):
-    k = 0 
-    with open(self.corpus, 'r') as f:
-      for line in f:
-        k = k + 1
-    return k
+    return self.__GetCorpusStore().GetLineCount()
 
-  def GetAllIds(self):
+  def ReadCorpusLines(self, start=0, stop=None):
+    store = self.__GetCorpusStore()
+    if (stop is None):
+      stop = store.GetLineCount()
+    return zip(xrange(start, stop), store.IterLines(start, stop))
+
+  def SampleCorpus(self, n, seed=None):
+    return self.__GetCorpusStore().Sample(n, seed)
 
-    path = self.training
-    self.textFiles = [f for f in os.listdir(path) if f.endswith(self.TEXT)]
-    self.waveFiles = [f for f in os.listdir(path) if f.endswith(self.WAV)]
-    self.idList = [self.__GetIdFromFile(f) for f in self.textFiles]
-    return self.idList
+  def GetAllIds(self):
+    return self.manifest.GetIds()
+
+  def RescanTraining(self):
+
+    # Picks up utterances copied into or deleted from the training
+    # directory by hand, returning (added, updated, removed)
+    counts = self.manifest.Import(texts=(self.archive is None))
+    if (self.archive):
+      # A packed session keeps all of its audio in the archive
+      for id in self.manifest.GetIds(TrainingManifest.READY):
+        wav = self.training + id + self.WAV
+        if (os.path.exists(wav)):
+          self.__StoreWave(id, wav)
+    return counts
  
   def AddCorpus(self, sent):
 
     with open(self.corpus, 'a') as f:
       f.write(sent.upper()+self.NEWLINE)
       f.close()
+    self.__GetNgramCounts()
+    if (self.index): self.__GetCorpusIndex()
 
   def AddFileToCorpus(self, path):
 
@@ -367,31 +663,71 @@ class ASRModel:
           f.write(line.upper())
         r.close()
       f.close()
+    self.__GetNgramCounts()
+    if (self.index): self.__GetCorpusIndex()
     return k
 
-  def __GetIdFromFile(self, path):
-    return path[:-4]
-    
-  def __WriteTranscriptions(self):
+  def __CorpusCheck(self, offset):
+
+    # Hash of the corpus just before offset, to notice a rewritten corpus
+    with open(self.corpus, 'rb') as f:
+      start = max(0, offset - 4096)
+      f.seek(start)
+      return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+  def __GetNgramCounts(self):
+
+    # The counts persist with the corpus offset they reflect, so only
+    # lines appended since then are counted
+    if (self.ngrams is None):
+      lm = LanguageModel(order=self.LMORDER)
+      offset = 0
+      if (os.path.exists(self.counts)):
+        try:
+          state = lm.Load(self.counts)
+          size = os.path.getsize(self.corpus)
+          if (state[0] <= size and state[1] == self.__CorpusCheck(state[0])):
+            offset = state[0]
+        except LanguageModelExceptionBadCounts:
+          pass
+      if (offset == 0 or lm.order != self.LMORDER):
+        # Recount from scratch
+        lm = LanguageModel(order=self.LMORDER)
+        offset = 0
+      self.ngrams = lm
+      self.ngramOffset = offset
+    self.ngramOffset = self.ngrams.AddCorpusFrom(self.corpus, self.ngramOffset)
+    return self.ngrams
+
+  def __SaveNgramCounts(self):
+    state = (self.ngramOffset, self.__CorpusCheck(self.ngramOffset))
+    self.ngrams.Save(self.counts, state)
+
+  def UpdateLanguageModel(self):
+
+    # Writes the LM, vocabulary and dictionary of the current model from
+    # the counts, so new corpus words have pronunciations.  Model files may
+    # be shared with other versions, so never rewrite them in place.
+    lm = self.__GetNgramCounts()
+    self.__SaveNgramCounts()
+    vocab = self.model + self.name + '.vocab'
+    for f in (vocab, self.lm):
+      if (os.path.exists(f)): os.remove(f)
+    lm.WriteArpa(self.lm)
+    # Words already in the dictionary are kept, since grammars may use them
+    words = lm.GetVocabulary()
+    if (os.path.exists(self.dict)):
+      words += [w for w, p in ReadDictionary(self.dict)]
+    self.__WriteDictionary(words, self.dict, self.dict)
+    return lm.WriteVocabulary(vocab)
 
-    with open(self.trans, 'w') as f:
-      for w in self.waveFiles:
-        id = self.__GetIdFromFile(w)
-        with open(self.training+id+self.TEXT, 'r') as r:
-          sent = r.read()
-          trans = "<s> " + sent + " </s> (" + id + ")"
-          r.close()
-        f.write(trans + self.NEWLINE)
-      f.close() 
+  def __WriteTranscriptions(self):
+    self.manifest.WriteTranscriptions(self.trans)
 
   def __WriteFileids(self):
 
-    with open(self.fileids, 'w') as f:
-      for w in self.waveFiles:
-        # Only wave files are admissible for SPHINX training
-        id = self.__GetIdFromFile(w)
-        f.write(id + self.NEWLINE)
-      f.close()
+    # Only entries with wave files are admissible for SPHINX training
+    self.manifest.WriteFileids(self.fileids)
 
   def __RunCmd(self, cmd, debug=False):
 
@@ -407,30 +743,67 @@ class ASRModel:
     else:
       with open(os.devnull, 'w') as devnull:
         task = subprocess.Popen(cmd, stdout=self.logfile, stderr=devnull)
-        task.wait()
+        return task.wait()
 
   def __MakeAcousticFeatures(self):
 
+    # Only new or changed wave files are run through sphinx_fe
     featParams = self.model + 'feat.params'
-    cmd = [ 'sphinx_fe', '-argfile', featParams,
-            '-samprate', str(self.RATE), '-c', self.fileids,
-            '-di', self.training, '-do', self.training, '-ei', 'wav',
-            '-eo', 'mfc', '-mswav', 'yes' ] 
-    self.__RunCmd(cmd, debug=True)
+    cache = FeatureCache(self.training + self.FEATURES, featParams,
+                         self.RATE, jobs=self.jobs)
+    ids = ParallelDecode.ReadControlFile(self.fileids)
+    if (self.archive is None):
+      cache.Update(ids, self.training, self.training, self.logfile)
+    else:
+      # Audio is only written out for utterances without features, from
+      # the archive or from wave files not yet packed
+      wavdir = self.output + self.EXPORT
+      shutil.rmtree(wavdir, ignore_errors=True)
+      self.__mkdir(wavdir)
+      try:
+        cache.Update(ids, wavdir, self.training, self.logfile,
+                     hashes=self.manifest.GetHashes(ids),
+                     export=lambda missing, path:
+                              self.ExportWaves(path, missing))
+      finally:
+        shutil.rmtree(wavdir, ignore_errors=True)
+    cache.Prune()
+    # List the features used so later stages can tell when they change
+    with open(self.output + self.FEATLIST, 'w') as f:
+      f.write(cache.paramsHash + self.NEWLINE)
+      for id in ids:
+        f.write(id + ' ' + cache.GetHash(id) + self.NEWLINE)
+      f.close()
+
+  def __AccumDirs(self):
+
+    # One accumulator directory for each concurrent bw part
+    jobs = self.jobs if (self.jobs) else DefaultJobs()
+    utts = len(ParallelDecode.ReadControlFile(self.fileids))
+    parts = max(1, min(jobs, utts))
+    return [ self.output + self.ACCUM + str(k) for k in range(parts) ]
 
   def __CollectStatistics(self):
 
     mdef = self.model + "mdef.txt"
     bwCmd = self.SPHINXLIBEXEC + 'bw'
 
-    last = self.__chdir(self.training)
-    cmd = [ bwCmd, '-hmmdir', self.model[:-1], '-moddeffn', mdef,
-            '-ts2cbfn', '.semi.', '-feat', '1s_c_d_dd',
-            '-svspec', '0-12/13-25/26-38', '-cmn', 'current',
-            '-agc', 'none', '-dictfn', self.dict, '-ctlfn', self.fileids,
-            '-lsnfn', self.trans, '-accumdir', self.output[:-1] ]
-    self.__RunCmd(cmd, debug=True)
-    self.__chdir(last)
+    # Each bw process handles one part of the control file and writes its
+    # own accumulator directory, all of which are used by the adaptation
+    parts = len(self.accumdirs)
+    for d in glob.glob(self.output + self.ACCUM + '*'):
+      shutil.rmtree(d)
+    cmds = []
+    for k, accumdir in enumerate(self.accumdirs):
+      self.__mkdir(accumdir)
+      cmd = [ bwCmd, '-hmmdir', self.model[:-1], '-moddeffn', mdef,
+              '-ts2cbfn', '.semi.', '-feat', '1s_c_d_dd',
+              '-svspec', '0-12/13-25/26-38', '-cmn', 'current',
+              '-agc', 'none', '-dictfn', self.dict, '-ctlfn', self.fileids,
+              '-lsnfn', self.trans, '-accumdir', accumdir,
+              '-part', str(k + 1), '-npart', str(parts) ]
+      cmds.append(cmd)
+    RunCommands(cmds, parts, self.logfile, cwd=self.training)
 
   def __MLLRTransform(self):
 
@@ -439,7 +812,7 @@ class ASRModel:
     mllrCmd = self.SPHINXLIBEXEC + 'mllr_solve'
     mllrOut = self.output + 'mllr_matrix'
     cmd = [ mllrCmd, '-meanfn', means, '-varfn', variances,
-           '-outmllrfn', mllrOut, '-accumdir', self.output[:-1] ]
+           '-outmllrfn', mllrOut, '-accumdir' ] + self.accumdirs
     self.__RunCmd(cmd, debug=True)
 
   def __MakeAdaptDir(self, name):
@@ -449,7 +822,9 @@ class ASRModel:
     else:
       id = name
     self.adapt = self.root + self.MODEL + id + "/"
-    shutil.copytree(self.model, self.adapt)
+    # Model versions share unchanged files through hard links.  Files the
+    # build rewrites are unlinked first, so older versions are unaffected.
+    LinkTree(self.model, self.adapt)
 
   def __MAPAdapt(self):
 
@@ -464,9 +839,9 @@ class ASRModel:
     mapCmd = self.SPHINXLIBEXEC + 'map_adapt'
     
     cmd = [ mapCmd, '-meanfn', means, '-varfn', var,
-            '-mixwfn', mw, '-tmatfn', tm, '-accumdir', self.output[:-1],
-            '-mapmeanfn', ameans, '-mapvarfn' , avar,
-            '-mapmixwfn', amw, '-maptmatfn', atm ]
+            '-mixwfn', mw, '-tmatfn', tm, '-mapmeanfn', ameans,
+            '-mapvarfn' , avar, '-mapmixwfn', amw, '-maptmatfn', atm,
+            '-accumdir' ] + self.accumdirs
     self.__RunCmd(cmd, debug=True)
 
   def __MakeSendump(self):
@@ -481,48 +856,36 @@ class ASRModel:
 
   def __BuildDict(self):
 
-    nval = 3    # Only 3-gram model is supported at the moment
-    wfreq = self.training + self.name + '.wfreq'
-    context = self.training + self.name + '.ccs'
-    cmd = [ 'text2wfreq', '<', self.corpus, '>', wfreq ]
-    #self.__RunCmd(cmd, debug=False)
-    os.system(' '.join(cmd))
+    # Counts are kept up to date as the corpus grows, so only new lines
+    # are read here
+    lm = self.__GetNgramCounts()
+    self.__SaveNgramCounts()
     vocab = self.adapt + self.name + '.vocab'
-    cmd = [ 'wfreq2vocab', '<', wfreq, '>', vocab ]
-    #self.__RunCmd(cmd, debug=False)
-    os.system(' '.join(cmd))
-    cmd = [ "echo '<s>'", '>>', vocab ]
-    os.system(' '.join(cmd))
-    #self.__RunCmd(cmd, debug=False)
-    cmd = [ "echo '</s>'", '>>', vocab ]
-    os.system(' '.join(cmd))
-    #self.__RunCmd(cmd, debug=False)
-    idngram = self.training + self.name + '.idngram'
-    cmd = [ 'text2idngram', '-n', str(nval), '-idngram', idngram, '-vocab', vocab,
-            '<', self.corpus ]
-    os.system(' '.join(cmd))
-#    cmd = [ "echo '<S>'", '>', context ]
-#    os.system(' '.join(cmd))
-#    cmd = [ "echo '</S>'", '>>', context ]
-#    os.system(' '.join(cmd))
-    binlm = self.training + self.name + '.binlm'
-#    cmd = [ 'idngram2lm', '-context', context, '-n', str(nval), '-idngram', idngram, '-vocab', vocab,
-    cmd = [ 'idngram2lm', '-n', str(nval), '-idngram', idngram, '-vocab', vocab,
-            '-binary', binlm ]
-    os.system(' '.join(cmd))
-    #self.__RunCmd(cmd, debug=False)
-    cmd = [ 'binlm2arpa', '-binary', binlm, '-arpa', self.adapt + self.name + '.lm' ]
-    os.system(' '.join(cmd))
-    #self.__RunCmd(cmd, debug=False)
-    mkdict = self.LOGIOSTOOLS + '/' + self.DICTCMD
-    cmd = [ mkdict, '-tools', self.LOGIOSTOOLS, '-dictdir', self.adapt,
-            '-words', self.name + '.vocab', '-dict', self.name + '.dic' ]
-    os.system(' '.join(cmd))
+    lm.WriteVocabulary(vocab)
+    lm.WriteArpa(self.adapt + self.name + self.LM)
+
+    self.__WriteDictionary(lm.GetVocabulary(),
+                           self.model + self.name + self.DICT,
+                           self.adapt + self.name + self.DICT)
 
     # Setup new directories
     self.dict = self.adapt + self.name + self.DICT
     self.lm = self.adapt + self.name + self.LM
 
+  def __WriteDictionary(self, words, base, path):
+
+    # Only words without a stored pronunciation go through letter-to-sound
+    store = PronunciationStore(self.models + self.PRONUNCIATIONS,
+                               os.path.expanduser(self.LOGIOSTOOLS),
+                               jobs=self.jobs)
+    if (os.path.exists(base)):
+      store.Seed(base)
+    store.Generate(words, self.logfile)
+    if (os.path.exists(path)): os.remove(path)
+    missing = store.WriteDictionary(words, path)
+    if (missing):
+      print "No pronunciation for", len(missing), "words:", ' '.join(missing[:10])
+
   def __BuildDictOnline(self):
 
     # Setup new directories
@@ -544,6 +907,8 @@ class ASRModel:
     dictUrl = loc + ident + ".dic"
     lmUrl = loc + ident + ".lm"
     # We only need the .lm and .dic files, so fetch those
+    for f in (self.dict, self.lm):
+      if (os.path.exists(f)): os.remove(f)
     cmd = [ 'curl', dictUrl, '-o', self.dict ]
     self.__RunCmd(cmd, debug=True)
     cmd = [ 'curl', lmUrl, '-o', self.lm ]
@@ -0,0 +1,93 @@
+"""
+AudioBuffer
+
+A fixed capacity ring buffer for raw PCM audio.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+class AudioRingBuffer:
+
+  def __init__(self, capacity):
+    """Preallocates a buffer holding up to capacity bytes of audio"""
+    self.data = bytearray(capacity)
+    self.view = memoryview(self.data)
+    self.Clear()
+
+  def Clear(self):
+    self.head = 0          # Offset of the oldest byte held
+    self.length = 0        # Number of bytes held
+    self.overrun = 0       # Number of bytes overwritten since last clear
+
+  def GetCapacity(self):
+    return len(self.data)
+
+  def GetLength(self):
+    return self.length
+
+  def __len__(self):
+    return self.length
+
+  def Resize(self, capacity):
+    """Changes the capacity, which discards the current contents"""
+    if (capacity != len(self.data)):
+      self.data = bytearray(capacity)
+      self.view = memoryview(self.data)
+    self.Clear()
+
+  def Append(self, chunk):
+    """Appends a chunk, overwriting the oldest audio if the buffer is full"""
+    capacity = len(self.data)
+    src = memoryview(chunk)
+    n = len(src)
+    if (n > capacity):
+      self.overrun += n - capacity
+      src = src[n-capacity:]
+      n = capacity
+    tail = (self.head + self.length) % capacity
+    first = min(n, capacity - tail)
+    self.data[tail:tail+first] = src[:first]
+    if (first < n):
+      self.data[:n-first] = src[first:]
+    self.length += n
+    if (self.length > capacity):
+      lost = self.length - capacity
+      self.overrun += lost
+      self.head = (self.head + lost) % capacity
+      self.length = capacity
+
+  def Truncate(self, nbytes):
+    """Keeps only the most recent nbytes (no data is moved)"""
+    if (nbytes < self.length):
+      drop = self.length - max(nbytes, 0)
+      self.head = (self.head + drop) % len(self.data)
+      self.length -= drop
+
+  def Trim(self, nbytes):
+    """Removes the most recent nbytes (no data is moved)"""
+    self.length = max(0, self.length - max(nbytes, 0))
+
+  def GetViews(self):
+    """Returns the contents as a list of one or two memoryviews, oldest first
+
+       The views share storage with the buffer so they are only valid until
+       the next Append.
+    """
+    if (self.length == 0):
+      return []
+    capacity = len(self.data)
+    end = self.head + self.length
+    if (end <= capacity):
+      return [self.view[self.head:end]]
+    return [self.view[self.head:], self.view[:end-capacity]]
+
+  def GetBytes(self):
+    """Returns a copy of the contents as a single string"""
+    return b''.join([v.tobytes() for v in self.GetViews()])
@@ -0,0 +1,341 @@
+"""
+AudioEncode
+
+In-memory WAV, FLAC and raw PCM encoding of recorded audio.
+
+The FLAC encoder is a small native implementation (fixed linear predictors
+with partitioned Rice coding of the residual) so no external tools or
+temporary files are needed.
+
+Dependencies: numpy
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import io
+import wave
+import struct
+import hashlib
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+class AudioEncodeExceptionUnsupportedFormat:
+  pass
+
+RAW = 'raw'
+WAV = 'wav'
+FLAC = 'flac'
+
+# Content types suitable for uploading each format
+CONTENTTYPES = { RAW: 'audio/l16', WAV: 'audio/wav', FLAC: 'audio/x-flac' }
+
+def _Join(data):
+  if (isinstance(data, (list, tuple))):
+    return b''.join([memoryview(d).tobytes() for d in data])
+  return memoryview(data).tobytes()
+
+def EncodeRaw(data):
+  """Returns raw PCM bytes from a buffer or list of buffers (memoryviews)"""
+  return _Join(data)
+
+def EncodeWav(data, channels, sampwidth, rate):
+  """Returns a complete WAV file image as bytes"""
+  if (not isinstance(data, (list, tuple))):
+    data = [data]
+  out = io.BytesIO()
+  wf = wave.open(out, 'wb')
+  wf.setnchannels(channels)
+  wf.setsampwidth(sampwidth)
+  wf.setframerate(rate)
+  for d in data:
+    wf.writeframes(d)
+  wf.close()
+  return out.getvalue()
+
+def EncodeFlac(data, channels, sampwidth, rate):
+  """Returns a complete FLAC file image as bytes"""
+  pcm = _Join(data)
+  encoder = FlacEncoder(channels, sampwidth, rate)
+  frames = encoder.Encode(pcm) + encoder.Finish()
+  return encoder.GetHeader(encoder.GetTotalSamples(), pcm) + frames
+
+def Encode(data, fmt, channels, sampwidth, rate):
+  """Encodes audio in the given format (RAW, WAV or FLAC)"""
+  if (fmt == RAW):
+    return EncodeRaw(data)
+  if (fmt == WAV):
+    return EncodeWav(data, channels, sampwidth, rate)
+  if (fmt == FLAC):
+    return EncodeFlac(data, channels, sampwidth, rate)
+  raise AudioEncodeExceptionUnsupportedFormat
+
+def _Crc8Table():
+  table = []
+  for i in range(256):
+    crc = i
+    for j in range(8):
+      crc = ((crc << 1) ^ 0x07) & 0xFF if (crc & 0x80) else (crc << 1) & 0xFF
+    table.append(crc)
+  return table
+
+def _Crc16Table():
+  table = []
+  for i in range(256):
+    crc = i << 8
+    for j in range(8):
+      crc = ((crc << 1) ^ 0x8005) & 0xFFFF if (crc & 0x8000) else \
+            (crc << 1) & 0xFFFF
+    table.append(crc)
+  return table
+
+CRC8TABLE = _Crc8Table()
+CRC16TABLE = _Crc16Table()
+
+def Crc8(data):
+  crc = 0
+  table = CRC8TABLE
+  for b in bytearray(data):
+    crc = table[crc ^ b]
+  return crc
+
+def Crc16(data):
+  crc = 0
+  table = CRC16TABLE
+  for b in bytearray(data):
+    crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ b]
+  return crc
+
+def PackBits(values, widths):
+  """Packs unsigned integer fields of the given bit widths MSB first.
+
+     Returns the bits as a numpy array of 0/1 values so fields can be
+     concatenated before the final byte packing.
+  """
+  values = np.asarray(values, dtype=np.uint64)
+  widths = np.asarray(widths, dtype=np.int64)
+  total = int(widths.sum())
+  if (total == 0):
+    return np.zeros(0, dtype=np.uint8)
+  field = np.repeat(np.arange(len(widths)), widths)
+  ends = np.cumsum(widths)
+  shift = ends[field] - 1 - np.arange(total)
+  # Fields never hold more than 63 significant bits, so larger shifts
+  # (long unary codes) can be clamped without changing the result
+  shift = np.minimum(shift, 63).astype(np.uint64)
+  return ((values[field] >> shift) & np.uint64(1)).astype(np.uint8)
+
+class FlacEncoder:
+
+  BLOCKSIZE = 4096       # Samples per channel in each frame
+  MAXORDER = 4           # Highest fixed predictor order
+  MAXPARTITION = 6       # Highest Rice partition order tried
+  MAXRICE = 14           # Highest Rice parameter (15 is the escape code)
+
+  # Frame header codes for sample rates that can be given directly
+  RATECODES = { 8000: 4, 16000: 5, 22050: 6, 24000: 7, 32000: 8,
+                44100: 9, 48000: 10, 96000: 11 }
+
+  # Frame header codes for sample sizes
+  SIZECODES = { 8: 1, 16: 4 }
+
+  def __init__(self, channels, sampwidth, rate, blocksize=BLOCKSIZE):
+    """Incremental encoder: raw PCM goes in, FLAC frames come out"""
+    if (sampwidth not in (1, 2) or not 1 <= channels <= 8):
+      raise AudioEncodeExceptionUnsupportedFormat
+    self.channels = channels
+    self.sampwidth = sampwidth
+    self.bps = sampwidth * 8
+    self.rate = rate
+    self.blocksize = blocksize
+    self.pending = b''
+    self.frameNumber = 0
+    self.totalSamples = 0
+
+  def GetTotalSamples(self):
+    return self.totalSamples
+
+  def GetHeader(self, totalSamples=0, pcm=None):
+    """Returns the stream marker and STREAMINFO block.
+
+       totalSamples and the MD5 of the pcm data may be left unknown when
+       streaming, as permitted by the format.
+    """
+    if (pcm is None):
+      md5 = b'\0' * 16
+    elif (self.sampwidth == 1):
+      # The signature is always taken over signed samples
+      signed = np.frombuffer(pcm, dtype=np.uint8).astype(np.int16) - 128
+      md5 = hashlib.md5(signed.astype(np.int8).tostring()).digest()
+    else:
+      md5 = hashlib.md5(pcm).digest()
+    info = struct.pack('>HH', self.blocksize, self.blocksize)
+    info += b'\0' * 6          # Min/max frame sizes unknown
+    packed = (self.rate << 44) | ((self.channels - 1) << 41) | \
+             ((self.bps - 1) << 36) | totalSamples
+    info += struct.pack('>Q', packed) + md5
+    return b'fLaC' + struct.pack('>I', (1 << 31) | len(info)) + info
+
+  def Encode(self, data):
+    """Adds raw PCM and returns any complete frames as bytes"""
+    self.pending += memoryview(data).tobytes()
+    blockBytes = self.blocksize * self.channels * self.sampwidth
+    out = []
+    pos = 0
+    while (len(self.pending) - pos >= blockBytes):
+      out.append(self.__EncodeFrame(self.pending[pos:pos+blockBytes]))
+      pos += blockBytes
+    self.pending = self.pending[pos:]
+    return b''.join(out)
+
+  def Finish(self):
+    """Flushes the final short frame"""
+    out = b''
+    if (len(self.pending) > 0):
+      out = self.__EncodeFrame(self.pending)
+      self.pending = b''
+    return out
+
+  def __Samples(self, pcm):
+    if (self.sampwidth == 1):
+      # 8-bit PCM is unsigned
+      s = np.frombuffer(pcm, dtype=np.uint8).astype(np.int64) - 128
+    else:
+      s = np.frombuffer(pcm, dtype='<i2').astype(np.int64)
+    return s.reshape(-1, self.channels)
+
+  def __Utf8(self, n):
+    """Frame numbers use the UTF-8 style variable length coding"""
+    if (n < 0x80):
+      return bytearray([n])
+    length = 2
+    while (n >= (1 << (5 * length + 1))):
+      length += 1
+    out = bytearray()
+    for i in range(length - 1):
+      out.insert(0, 0x80 | (n & 0x3F))
+      n >>= 6
+    out.insert(0, ((0xFF00 >> length) & 0xFF) | n)
+    return out
+
+  def __EncodeFrame(self, pcm):
+    samples = self.__Samples(pcm)
+    blocksize = len(samples)
+    self.totalSamples += blocksize
+
+    header = bytearray([0xFF, 0xF8])
+    header.append((7 << 4) | self.RATECODES.get(self.rate, 0))
+    header.append(((self.channels - 1) << 4) | (self.SIZECODES[self.bps] << 1))
+    header += self.__Utf8(self.frameNumber)
+    header += struct.pack('>H', blocksize - 1)
+    header.append(Crc8(header))
+    self.frameNumber += 1
+
+    bits = [self.__Subframe(samples[:, c]) for c in range(self.channels)]
+    bits = np.concatenate(bits)
+    frame = bytes(header) + np.packbits(bits).tostring()
+    return frame + struct.pack('>H', Crc16(frame))
+
+  def __Subframe(self, x):
+    n = len(x)
+    if (np.all(x == x[0])):
+      return PackBits([0x00, x[0] & ((1 << self.bps) - 1)], [8, self.bps])
+
+    # Pick the fixed predictor order with the smallest residual
+    best = None
+    res = x
+    for order in range(0, min(self.MAXORDER, n - 1) + 1):
+      if (order > 0):
+        res = np.diff(res)
+      cost = np.abs(res).sum()
+      if (best is None or cost < best[0]):
+        best = (cost, order, res)
+    cost, order, res = best
+
+    residual = self.__Residual(res, n, order)
+    mask = (1 << self.bps) - 1
+    if (residual is None or len(residual) >= n * self.bps):
+      fields = np.concatenate([[0x02], x & mask])
+      return PackBits(fields, [8] + [self.bps] * n)
+    fields = np.concatenate([[0x10 | (order << 1)], x[:order] & mask])
+    head = PackBits(fields, [8] + [self.bps] * order)
+    return np.concatenate([head, residual])
+
+  def __Residual(self, res, n, order):
+    """Rice codes the residual, choosing the partition order and parameters"""
+    u = (res << 1) ^ (res >> 63)          # Zigzag to unsigned
+    ks = np.arange(self.MAXRICE + 1)
+    # Quotients for every Rice parameter at once, summed per partition below
+    shifted = u[None, :] >> ks[:, None]
+    best = None
+    for p in range(0, self.MAXPARTITION + 1):
+      if (n % (1 << p) != 0 or (n >> p) <= order):
+        break
+      size = n >> p
+      bounds = [0] + [size * i - order for i in range(1, (1 << p) + 1)]
+      lens = np.diff(bounds)
+      sums = np.add.reduceat(shifted, bounds[:-1], axis=1)
+      costs = lens[None, :] * (ks[:, None] + 1) + sums
+      params = [int(k) for k in np.argmin(costs, axis=0)]
+      total = int(costs[params, np.arange(1 << p)].sum()) + 4 * (1 << p)
+      if (best is None or total < best[0]):
+        best = (total, p, params, bounds)
+    if (best is None):
+      return None
+    total, p, params, bounds = best
+
+    # Coding method 0 (4-bit parameters) and the partition order
+    values = [np.array([0, p])]
+    widths = [np.array([2, 4])]
+    for i in range(1 << p):
+      k = params[i]
+      part = u[bounds[i]:bounds[i+1]]
+      # Each residual is a unary quotient terminated by a 1, then k low bits
+      codes = np.empty(2 * len(part) + 1, dtype=np.int64)
+      lens = np.empty(2 * len(part) + 1, dtype=np.int64)
+      codes[0] = k
+      lens[0] = 4
+      codes[1::2] = 1
+      lens[1::2] = (part >> k) + 1
+      codes[2::2] = part & ((1 << k) - 1)
+      lens[2::2] = k
+      values.append(codes)
+      widths.append(lens)
+    return PackBits(np.concatenate(values), np.concatenate(widths))
+
+class AudioEncoder:
+
+  WORKERS = 2
+
+  def __init__(self, channels, sampwidth, rate, workers=WORKERS):
+    """Encodes recordings, optionally in the background on a worker pool"""
+    self.channels = channels
+    self.sampwidth = sampwidth
+    self.rate = rate
+    self.workers = workers
+    self.pool = None
+
+  def Encode(self, data, fmt=FLAC):
+    return Encode(data, fmt, self.channels, self.sampwidth, self.rate)
+
+  def EncodeAsync(self, data, fmt=FLAC):
+    """Queues an encode and returns an AsyncResult whose get() gives bytes.
+
+       The data is copied first since recorder views are reused.
+    """
+    if (self.pool is None):
+      self.pool = ThreadPool(self.workers)
+    return self.pool.apply_async(Encode, (EncodeRaw(data), fmt, self.channels,
+                                          self.sampwidth, self.rate))
+
+  def Exit(self):
+    if (self.pool):
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
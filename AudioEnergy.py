@@ -0,0 +1,179 @@
+"""
+AudioEnergy
+
+A numpy based RMS energy engine for raw PCM audio chunks.
+
+Dependencies: numpy
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import numpy as np
+
+def CalcRmsPower(data, dtype=np.int16):
+  """Computes the RMS level of a chunk (or list of chunks) of sound"""
+  if (isinstance(data, (list, tuple))):
+    chunks = data
+  else:
+    chunks = [data]
+  total = 0.0
+  count = 0
+  for c in chunks:
+    s = np.frombuffer(c, dtype=dtype)
+    if (len(s) > 0):
+      # Accumulate in float64 so large int16 squares can't overflow
+      total += np.dot(s, s.astype(np.float64))
+      count += len(s)
+  if (count > 0):
+    return np.sqrt(total / count)
+  return 0
+
+class RmsEnergy:
+
+  CAPACITY = 256       # Initial number of energy frames held
+
+  def __init__(self, dtype=np.int16, channels=1, window=None, channel=None,
+               capacity=CAPACITY):
+    """Creates an energy tracker.
+
+       window is the number of samples (per channel) in each energy frame,
+       or None to produce one energy frame per chunk.  If channel is given
+       only that channel of interleaved audio is measured, otherwise all
+       channels are combined.
+    """
+    self.dtype = np.dtype(dtype)
+    self.channels = channels
+    self.window = window
+    self.channel = channel
+    self.sumsq = np.zeros(capacity)
+    self.counts = np.zeros(capacity, dtype=np.int64)
+    self.scratch = np.zeros(0)
+    self.Reset()
+
+  def Reset(self):
+    """Discards all energy frames and any partially filled frame"""
+    self.start = 0
+    self.end = 0
+    self.partialSum = 0.0
+    self.partialCount = 0
+
+  def __Reserve(self, n):
+    """Makes room for another n frames at the end of the arrays"""
+    if (self.end + n <= len(self.sumsq)):
+      return
+    length = self.end - self.start
+    if (length + n > len(self.sumsq) / 2):
+      size = max(2 * len(self.sumsq), length + n)
+      sumsq = np.zeros(size)
+      counts = np.zeros(size, dtype=np.int64)
+    else:
+      # Plenty of dead space at the front, so just compact in place
+      sumsq = self.sumsq
+      counts = self.counts
+    sumsq[:length] = self.sumsq[self.start:self.end]
+    counts[:length] = self.counts[self.start:self.end]
+    self.sumsq = sumsq
+    self.counts = counts
+    self.start = 0
+    self.end = length
+
+  def __Append(self, sumsq, count):
+    self.__Reserve(1)
+    self.sumsq[self.end] = sumsq
+    self.counts[self.end] = count
+    self.end += 1
+
+  def __Square(self, samples):
+    """Squares samples into the float64 scratch area (no allocation)"""
+    n = len(samples)
+    if (len(self.scratch) < n):
+      self.scratch = np.zeros(n)
+    sq = self.scratch[:n]
+    np.multiply(samples, samples, out=sq, dtype=np.float64)
+    return sq
+
+  def Update(self, chunk):
+    """Adds a chunk of raw audio and returns the number of new frames"""
+    samples = np.frombuffer(chunk, dtype=self.dtype)
+    if (self.channel is not None):
+      samples = samples.reshape(-1, self.channels)[:, self.channel]
+    n = len(samples)
+    if (n == 0):
+      return 0
+    sq = self.__Square(samples)
+    if (self.window is None):
+      self.__Append(sq.sum(), n)
+      return 1
+
+    if (self.channel is None):
+      size = self.window * self.channels
+    else:
+      size = self.window
+    frames = 0
+    i = 0
+
+    # Complete any frame left over from the previous chunk
+    if (self.partialCount > 0):
+      i = min(size - self.partialCount, n)
+      self.partialSum += sq[:i].sum()
+      self.partialCount += i
+      if (self.partialCount == size):
+        self.__Append(self.partialSum, size)
+        self.partialSum = 0.0
+        self.partialCount = 0
+        frames += 1
+
+    # Whole frames are summed straight into the energy array
+    whole = (n - i) / size
+    if (whole > 0):
+      self.__Reserve(whole)
+      out = self.sumsq[self.end:self.end+whole]
+      np.sum(sq[i:i+whole*size].reshape(whole, size), axis=1, out=out)
+      self.counts[self.end:self.end+whole] = size
+      self.end += whole
+      i += whole * size
+      frames += whole
+
+    # Carry the remainder over as a partial frame
+    if (i < n):
+      self.partialSum += sq[i:].sum()
+      self.partialCount += n - i
+    return frames
+
+  def GetFrameCount(self):
+    return self.end - self.start
+
+  def GetRms(self, frames=1):
+    """Returns the RMS level over the last number of frames"""
+    frames = min(frames, self.end - self.start)
+    if (frames <= 0):
+      return 0
+    count = self.counts[self.end-frames:self.end].sum()
+    if (count == 0):
+      return 0
+    return np.sqrt(self.sumsq[self.end-frames:self.end].sum() / count)
+
+  def GetEnergies(self, frames=None):
+    """Returns the RMS level of every frame held, or just the last frames"""
+    start = self.start
+    if (frames is not None):
+      start = max(start, self.end - frames)
+    sumsq = self.sumsq[start:self.end]
+    counts = self.counts[start:self.end]
+    return np.sqrt(sumsq / np.maximum(counts, 1))
+
+  def Truncate(self, frames):
+    """Keeps only the last number of frames"""
+    if (frames < self.end - self.start):
+      self.start = self.end - max(frames, 0)
+
+  def Trim(self, frames):
+    """Removes the last number of frames"""
+    self.end = max(self.start, self.end - max(frames, 0))
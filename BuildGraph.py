@@ -0,0 +1,180 @@
+"""
+BuildGraph
+
+Runs a set of build stages in dependency order, skipping any stage whose
+inputs are unchanged since it last ran and running independent stages
+concurrently.
+
+Each stage declares the files (or directories) it reads and writes.  The
+inputs are hashed by content, and after a stage runs its outputs are
+saved (as hard links) alongside a stamp of that hash.  If a later build
+finds the same hash the saved outputs are linked back into place instead
+of running the stage again, so outputs may live in a different directory
+on every build.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from multiprocessing.pool import ThreadPool
+from FeatureCache import LinkFile, LinkTree
+import hashlib
+import shutil
+import os
+
+class BuildGraphExceptionCycle:
+  pass
+
+def HashPaths(paths, h=None):
+  """Hashes the contents of files in order, descending into directories.
+     Paths themselves are not hashed since outputs of an earlier stage may
+     be in a different place on each build.
+  """
+  if (h is None):
+    h = hashlib.sha1()
+  for path in paths:
+    h.update('\2')
+    if (os.path.isdir(path)):
+      for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+          f = os.path.join(root, name)
+          h.update(os.path.relpath(f, path) + '\0')
+          HashFileContents(f, h)
+    elif (os.path.exists(path)):
+      HashFileContents(path, h)
+    else:
+      h.update('\1missing')
+  return h
+
+def HashFileContents(path, h):
+  with open(path, 'rb') as f:
+    while (True):
+      block = f.read(1 << 16)
+      if (not block):
+        break
+      h.update(block)
+
+def RemovePath(path):
+  if (os.path.isdir(path) and not os.path.islink(path)):
+    shutil.rmtree(path)
+  elif (os.path.lexists(path)):
+    os.remove(path)
+
+def LinkPath(src, dst):
+  """Hard links a file or directory tree, replacing whatever is at dst"""
+  RemovePath(dst)
+  if (os.path.isdir(src)):
+    LinkTree(src, dst)
+  else:
+    LinkFile(src, dst)
+
+class BuildStage:
+
+  def __init__(self, name, func, inputs=None, outputs=[], after=[]):
+    """inputs of None means the stage has no stamp and always runs"""
+    self.name = name
+    self.func = func
+    self.inputs = inputs
+    self.outputs = outputs
+    self.after = after
+
+class BuildGraph:
+
+  STAMP = "stamp"
+  BUILT = 'built'
+  SKIPPED = 'skipped'
+
+  def __init__(self, stampdir, jobs=2):
+    """Stamps and saved outputs are kept under stampdir"""
+    if (stampdir[-1] != '/'): stampdir += '/'
+    self.stampdir = stampdir
+    self.jobs = jobs
+    self.stages = []
+
+  def Add(self, name, func, inputs=None, outputs=[], after=[]):
+    self.stages.append(BuildStage(name, func, inputs, outputs, after))
+
+  def __StageDir(self, stage):
+    return self.stampdir + stage.name + '/'
+
+  def __Hash(self, stage):
+    h = hashlib.sha1(stage.name + '\0')
+    h.update(str(len(stage.outputs)) + '\0')
+    return HashPaths(stage.inputs, h).hexdigest()
+
+  def __ReadStamp(self, stage):
+    path = self.__StageDir(stage) + self.STAMP
+    if (not os.path.exists(path)):
+      return None
+    with open(path, 'r') as f:
+      return f.read().strip()
+
+  def __Restore(self, stage):
+    d = self.__StageDir(stage)
+    saved = [d + str(k) for k in range(len(stage.outputs))]
+    for s in saved:
+      if (not os.path.exists(s)):
+        return False
+    for s, out in zip(saved, stage.outputs):
+      LinkPath(s, out)
+    return True
+
+  def __Save(self, stage, stamp):
+    d = self.__StageDir(stage)
+    if (os.path.isdir(d)):
+      shutil.rmtree(d)
+    os.makedirs(d)
+    for k, out in enumerate(stage.outputs):
+      if (os.path.exists(out)):
+        LinkPath(out, d + str(k))
+    # The stamp is written last so an interrupted save is never trusted
+    with open(d + self.STAMP, 'w') as f:
+      f.write(stamp)
+
+  def __RunStage(self, stage):
+    if (stage.inputs is None):
+      stage.func()
+      return self.BUILT
+    stamp = self.__Hash(stage)
+    if (stamp == self.__ReadStamp(stage) and self.__Restore(stage)):
+      return self.SKIPPED
+    # Outputs may be hard linked to saved copies or older models, so they
+    # are removed rather than overwritten in place
+    for out in stage.outputs:
+      RemovePath(out)
+    stage.func()
+    self.__Save(stage, stamp)
+    return self.BUILT
+
+  def Run(self):
+    """Runs all stages and returns a list of (name, BUILT or SKIPPED)
+       in completion order
+    """
+    names = set(s.name for s in self.stages)
+    pending = list(self.stages)
+    done = {}
+    order = []
+    pool = ThreadPool(max(1, self.jobs))
+    try:
+      while (pending):
+        ready = [s for s in pending
+                 if all((a in done or a not in names) for a in s.after)]
+        if (len(ready) == 0):
+          raise BuildGraphExceptionCycle
+        for s in ready:
+          pending.remove(s)
+        results = pool.map(self.__RunStage, ready)
+        for s, r in zip(ready, results):
+          done[s.name] = r
+          order.append((s.name, r))
+    finally:
+      pool.close()
+      pool.join()
+    return order
@@ -0,0 +1,278 @@
+"""
+CorpusIndex
+
+A persistent search index over a line oriented text corpus.
+
+The index holds positional word postings, a character trigram index and
+a prefix index of line numbers sorted by line text.  Substring and
+regular expression queries are narrowed down with the trigram index
+(using the literal text a regular expression must contain) and only the
+candidate lines are checked.  Lines are read through a CorpusStore, and
+as the corpus is only appended to the index catches up from the last
+line it covered.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from array import array
+import sre_parse
+import sre_constants
+import hashlib
+import marshal
+import re
+import os
+
+NEWLINE = "\n"
+
+def RequiredLiterals(regexp):
+  """Returns the literal strings any match of regexp must contain, taken
+     from runs of plain characters in its top level sequence
+  """
+  try:
+    parsed = sre_parse.parse(regexp)
+  except (sre_constants.error, OverflowError):
+    return []
+  if (parsed.pattern.flags & (re.IGNORECASE | re.VERBOSE)):
+    return []
+  literals = []
+  run = ''
+  for op, av in parsed:
+    if (op == sre_constants.LITERAL):
+      run += unichr(av) if (av > 255) else chr(av)
+    else:
+      if (run):
+        literals.append(run)
+      run = ''
+  if (run):
+    literals.append(run)
+  return literals
+
+class CorpusIndex:
+
+  VERSION = 2
+  CHECKSIZE = 4096       # Bytes before the covered offset that are hashed
+
+  def __init__(self, store, path):
+    """store is the CorpusStore to index and path where the index is saved"""
+    self.store = store
+    self.path = path
+    self.__Reset()
+    if (os.path.exists(path)):
+      self.__Load()
+    self.dirty = 0
+
+  def __Reset(self):
+    self.count = 0               # Corpus lines covered
+    self.postings = {}           # Word -> line of each occurrence
+    self.positions = {}          # Word -> word position of each occurrence
+    self.trigrams = {}           # Trigram -> lines containing it
+    self.prefix = array('L')     # Line numbers sorted by line text
+    self.dirty = 0
+
+  def __Check(self, count):
+    end = self.store.GetOffset(count)
+    start = max(0, end - self.CHECKSIZE)
+    return hashlib.sha1(self.store.GetBytes(start, end)).hexdigest()
+
+  def __Load(self):
+    try:
+      with open(self.path, 'rb') as f:
+        data = marshal.load(f)
+        f.close()
+      version, count, check, postings, positions, trigrams, prefix = data
+      if (version != self.VERSION or count > self.store.GetLineCount() or
+          check != self.__Check(count)):
+        return
+    except (EOFError, ValueError, TypeError, OSError, IOError):
+      return
+    def Arrays(table):
+      out = {}
+      for key, s in table.iteritems():
+        a = array('L')
+        a.fromstring(s)
+        out[key] = a
+      return out
+    self.count = count
+    self.postings = Arrays(postings)
+    self.positions = Arrays(positions)
+    self.trigrams = Arrays(trigrams)
+    self.prefix = array('L')
+    self.prefix.fromstring(prefix)
+
+  def Save(self):
+    def Strings(table):
+      return dict((key, a.tostring()) for key, a in table.iteritems())
+    data = (self.VERSION, self.count, self.__Check(self.count),
+            Strings(self.postings), Strings(self.positions),
+            Strings(self.trigrams), self.prefix.tostring())
+    with open(self.path + '.tmp', 'wb') as f:
+      marshal.dump(data, f)
+      f.close()
+    os.rename(self.path + '.tmp', self.path)
+    self.dirty = 0
+
+  def GetPending(self):
+    """Returns the number of lines indexed since the index was saved"""
+    return self.dirty
+
+  def Update(self):
+    """Indexes lines added to the store, returning how many there were"""
+    total = self.store.GetLineCount()
+    if (total < self.count):
+      self.__Reset()          # Truncated or replaced
+    added = range(self.count, total)
+    for k in added:
+      self.__IndexLine(k, self.store.GetLine(k))
+    self.count = total
+    self.__InsertPrefix(added)
+    self.dirty += len(added)
+    return len(added)
+
+  def __IndexLine(self, k, line):
+    for pos, w in enumerate(line.split()):
+      if (w not in self.postings):
+        self.postings[w] = array('L')
+        self.positions[w] = array('L')
+      self.postings[w].append(k)
+      self.positions[w].append(pos)
+    for tri in set(line[i:i + 3] for i in range(len(line) - 2)):
+      lines = self.trigrams.get(tri)
+      if (lines is None):
+        lines = self.trigrams[tri] = array('L')
+      lines.append(k)
+
+  def __InsertPrefix(self, added):
+    """Merges new line numbers into the prefix index"""
+    if (len(added) == 0):
+      return
+    added.sort(key=self.GetLine)
+    merged = array('L')
+    i = 0
+    for k in added:
+      text = self.GetLine(k)
+      j = self.__Bisect(text, i)
+      merged.extend(self.prefix[i:j])
+      merged.append(k)
+      i = j
+    merged.extend(self.prefix[i:])
+    self.prefix = merged
+
+  def __Bisect(self, text, lo=0):
+    """First position in the prefix index whose line is >= text"""
+    hi = len(self.prefix)
+    while (lo < hi):
+      mid = (lo + hi) // 2
+      if (self.GetLine(self.prefix[mid]) < text):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def GetLineCount(self):
+    return self.count
+
+  def GetLine(self, k):
+    """Returns line k without its newline"""
+    return self.store.GetLine(k)
+
+  def __Hits(self, lines):
+    return [(int(k), self.GetLine(k).strip()) for k in sorted(lines)]
+
+  def __TrigramCandidates(self, text):
+    """Lines which contain every trigram of text, or None if text is too
+       short to be narrowed down
+    """
+    if (len(text) < 3):
+      return None
+    tris = set(text[i:i + 3] for i in range(len(text) - 2))
+    lists = []
+    for tri in tris:
+      lines = self.trigrams.get(tri)
+      if (lines is None):
+        return set()
+      lists.append(lines)
+    lists.sort(key=len)
+    candidates = set(lists[0])
+    for lines in lists[1:]:
+      candidates.intersection_update(lines)
+      if (not candidates):
+        break
+    return candidates
+
+  def __AllLines(self):
+    return xrange(self.count)
+
+  def FindSubstring(self, text):
+    candidates = self.__TrigramCandidates(text)
+    if (candidates is None):
+      candidates = self.__AllLines()
+    return self.__Hits(k for k in candidates if text in self.GetLine(k))
+
+  def FindStartsWith(self, text):
+    hits = []
+    i = self.__Bisect(text)
+    while (i < len(self.prefix)):
+      k = self.prefix[i]
+      if (not self.GetLine(k).startswith(text)):
+        break
+      hits.append(k)
+      i += 1
+    return self.__Hits(hits)
+
+  def FindWords(self, words):
+    """Lines containing every one of the words, in any order"""
+    candidates = None
+    for w in words:
+      lines = set(self.postings.get(w, ()))
+      candidates = lines if (candidates is None) else candidates & lines
+      if (not candidates):
+        return []
+    return self.__Hits(candidates if (candidates) else [])
+
+  def FindOrderedWords(self, words):
+    """Lines containing the words in the given order, not necessarily
+       next to each other
+    """
+    hits = [k for k, line in self.FindWords(words)]
+    if (len(hits) == 0):
+      return []
+    wanted = set(hits)
+    # Word positions within each candidate line
+    where = {}
+    for w in set(words):
+      lines = self.postings[w]
+      positions = self.positions[w]
+      table = where[w] = {}
+      for i in xrange(len(lines)):
+        if (lines[i] in wanted):
+          table.setdefault(lines[i], []).append(positions[i])
+    ordered = []
+    for k in hits:
+      pos = -1
+      for w in words:
+        later = [p for p in where[w][k] if p > pos]
+        if (not later):
+          break
+        pos = later[0]
+      else:
+        ordered.append(k)
+    return self.__Hits(ordered)
+
+  def Find(self, regexp):
+    pattern = re.compile(regexp)
+    candidates = None
+    for literal in RequiredLiterals(regexp):
+      lines = self.__TrigramCandidates(literal)
+      if (lines is not None):
+        candidates = lines if (candidates is None) else candidates & lines
+    if (candidates is None):
+      candidates = self.__AllLines()
+    return self.__Hits(k for k in candidates
+                       if pattern.search(self.GetLine(k)))
@@ -0,0 +1,183 @@
+"""
+CorpusStore
+
+Random access to the lines of a text corpus which is only appended to.
+
+The corpus is memory mapped and a table of line start offsets is kept
+in an array, which is saved beside the corpus and extended as lines are
+appended.  A hash of the bytes before the last saved offset is kept with
+the table, so a corpus rewritten behind its back is noticed.  Counting
+lines and fetching any line are constant time, and slices of the corpus
+can be iterated as buffers without copying.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from array import array
+import hashlib
+import random
+import mmap
+import os
+
+NEWLINE = "\n"
+
+class CorpusStore:
+
+  OFFSETS = ".offsets"
+  CHECK = ".check"
+  CHECKSIZE = 4096       # Bytes before the last offset that are hashed
+
+  def __init__(self, path):
+    self.path = path
+    self.offsetsPath = path + self.OFFSETS
+    self.checkPath = self.offsetsPath + self.CHECK
+    self.mm = None
+    self.size = 0
+    # Start offset of every line followed by the end of the last line
+    self.offsets = array('L', [0])
+    self.check = None      # Hash of the corpus before the last offset
+    self.__LoadOffsets()
+    self.Refresh()
+
+  def __LoadOffsets(self):
+    if (not os.path.exists(self.offsetsPath)):
+      return
+    offsets = array('L')
+    with open(self.offsetsPath, 'rb') as f:
+      data = f.read()
+      f.close()
+    data = data[:len(data) - len(data) % offsets.itemsize]
+    offsets.fromstring(data)
+    check = None
+    if (os.path.exists(self.checkPath)):
+      with open(self.checkPath, 'r') as f:
+        check = f.read().split()
+        f.close()
+    # The hash must be of the end of this table, or the table is stale
+    if (len(offsets) > 0 and offsets[0] == 0 and check and len(check) == 2 and
+        check[0] == str(offsets[-1])):
+      self.offsets = offsets
+      self.check = check[1]
+    else:
+      with open(self.offsetsPath, 'wb') as f:
+        f.close()
+
+  def __Map(self):
+    size = os.path.getsize(self.path) if (os.path.exists(self.path)) else 0
+    if (size != self.size):
+      # Buffers already handed out keep the old mapping alive
+      self.mm = None
+      if (size > 0):
+        with open(self.path, 'rb') as f:
+          self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+          f.close()
+      self.size = size
+
+  def __Digest(self, end):
+    start = max(0, end - self.CHECKSIZE)
+    return hashlib.sha1(self.GetBytes(start, end)).hexdigest()
+
+  def __SaveCheck(self):
+    end = self.offsets[-1]
+    self.check = self.__Digest(end)
+    with open(self.checkPath + '.tmp', 'w') as f:
+      f.write("%d %s" % (end, self.check) + NEWLINE)
+      f.close()
+    os.rename(self.checkPath + '.tmp', self.checkPath)
+
+  def __Valid(self):
+    end = self.offsets[-1]
+    if (end > self.size):
+      return False
+    return (end == 0 or self.__Digest(end) == self.check)
+
+  def Refresh(self):
+    """Picks up lines appended to the corpus, returning how many"""
+    self.__Map()
+    if (not self.__Valid()):
+      # Truncated or rewritten, so the table is rebuilt
+      self.offsets = array('L', [0])
+      with open(self.offsetsPath, 'wb') as f:
+        f.close()
+    end = self.offsets[-1]
+    added = array('L')
+    while (self.mm is not None and end < self.size):
+      nl = self.mm.find(NEWLINE, end)
+      if (nl < 0):
+        break         # Partly written, picked up next time
+      end = nl + 1
+      added.append(end)
+    if (len(added) > 0):
+      self.offsets.extend(added)
+      if (len(self.offsets) == len(added) + 1):
+        added.insert(0, 0)
+      with open(self.offsetsPath, 'ab') as f:
+        added.tofile(f)
+        f.close()
+      self.__SaveCheck()
+    return len(added)
+
+  def Append(self, lines):
+    """Appends lines (without newlines) and returns the first line number"""
+    first = self.GetLineCount()
+    with open(self.path, 'a') as f:
+      for line in lines:
+        f.write(line + NEWLINE)
+      f.close()
+    self.Refresh()
+    return first
+
+  def Truncate(self):
+    with open(self.path, 'w') as f:
+      f.close()
+    self.Refresh()
+
+  def GetLineCount(self):
+    return len(self.offsets) - 1
+
+  def GetOffset(self, k):
+    """Returns the byte offset of line k, or of the end of the corpus when
+       k is the line count
+    """
+    return self.offsets[k]
+
+  def GetLine(self, k):
+    """Returns line k without its newline"""
+    return self.mm[self.offsets[k]:self.offsets[k + 1] - 1]
+
+  def GetBuffer(self, k):
+    """Returns line k as a buffer onto the mapping, without copying"""
+    start = self.offsets[k]
+    return buffer(self.mm, start, self.offsets[k + 1] - 1 - start)
+
+  def GetBytes(self, start, end):
+    if (self.mm is None):
+      return ''
+    return self.mm[start:end]
+
+  def IterLines(self, start=0, stop=None):
+    for k in xrange(*slice(start, stop).indices(self.GetLineCount())):
+      yield self.mm[self.offsets[k]:self.offsets[k + 1] - 1]
+
+  def IterBuffers(self, start=0, stop=None):
+    """Iterates over a slice of lines as buffers, without copying"""
+    for k in xrange(*slice(start, stop).indices(self.GetLineCount())):
+      yield self.GetBuffer(k)
+
+  def Sample(self, n, seed=None):
+    """Returns (line number, line) for n lines chosen at random"""
+    rng = random.Random(seed)
+    ks = sorted(rng.sample(xrange(self.GetLineCount()),
+                           min(n, self.GetLineCount())))
+    return [(k, self.GetLine(k)) for k in ks]
+
+  def Close(self):
+    self.mm = None
+    self.size = 0
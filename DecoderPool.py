@@ -0,0 +1,157 @@
+"""
+DecoderPool
+
+A keyed pool of configured ASR decoders.
+
+Building an ASR instance creates a gstreamer pipeline and makes
+pocketsphinx load the acoustic model, language model and dictionary from
+disk.  The pool keeps decoders which are not in use, keyed by the model
+files they were loaded with, so starting a new session or switching back
+to a grammar that was used before does not reload anything.  The key
+includes the size and modification time of each file, so a model file
+rewritten in place is loaded afresh.
+
+Dependencies: pocketsphinx, gstreamer
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from ASR import ASR
+import threading
+import time
+import os
+
+class DecoderPoolExceptionFull:
+  pass
+
+class DecoderPool:
+
+  MAXSIZE = 4            # Maximum number of decoders, in use or idle
+  IDLETIMEOUT = 300      # Seconds an idle decoder is kept
+
+  def __init__(self, maxSize=MAXSIZE, idleTimeout=IDLETIMEOUT):
+    self.maxSize = maxSize
+    self.idleTimeout = idleTimeout
+    self.lock = threading.Lock()
+    self.idle = []         # (returned time, key, decoder), oldest first
+    self.busy = {}         # id(decoder) -> key
+
+  def __Stamp(self, path):
+    """Identifies the version of a model file on disk"""
+    try:
+      st = os.stat(path)
+      return (st.st_size, st.st_mtime)
+    except (OSError, TypeError):
+      return None
+
+  def __Key(self, hmm, lm, dic, fsg, nBestSize, latdir):
+    stamps = tuple(self.__Stamp(f) for f in (hmm, lm, dic, fsg))
+    return (hmm, lm, dic, fsg, nBestSize, latdir, stamps)
+
+  def __EvictIdle(self, now):
+    """Exits decoders which have been idle too long (lock held)"""
+    keep = []
+    for entry in self.idle:
+      if (now - entry[0] > self.idleTimeout):
+        entry[2].Exit()
+      else:
+        keep.append(entry)
+    self.idle = keep
+
+  def __Create(self, key):
+    hmm, lm, dic, fsg, nBestSize, latdir, stamps = key
+    return ASR(None, hmm=hmm, lm=lm, dic=dic, nBestSize=nBestSize,
+               latdir=latdir, fsg=fsg)
+
+  def __Reserve(self, key):
+    """Takes an idle decoder for key, or makes room for a new one.
+       Returns the decoder or None (lock held).
+    """
+    self.__EvictIdle(time.time())
+    for i in range(len(self.idle) - 1, -1, -1):
+      if (self.idle[i][1] == key):
+        return self.idle.pop(i)[2]
+    if (len(self.idle) + len(self.busy) >= self.maxSize):
+      if (len(self.idle) == 0):
+        raise DecoderPoolExceptionFull
+      # Evict the least recently used decoder of another configuration
+      self.idle.pop(0)[2].Exit()
+    return None
+
+  def Checkout(self, callback, hmm=None, lm=None, dic=None, fsg=None,
+               nBestSize=0, latdir=None, tag='cmu', wordLimit=9999,
+               minProb=-5000):
+    """Returns a paused decoder for the given models which reports to
+       callback, creating one only if no idle decoder matches
+    """
+    key = self.__Key(hmm, lm, dic, fsg, nBestSize, latdir)
+    token = object()
+    with self.lock:
+      decoder = self.__Reserve(key)
+      if (decoder is None):
+        # Placeholder so concurrent checkouts respect the size cap
+        self.busy[id(token)] = key
+    if (decoder is None):
+      try:
+        decoder = self.__Create(key)
+      finally:
+        with self.lock:
+          del self.busy[id(token)]
+    decoder.SetCallback(callback, tag)
+    decoder.wordLimit = wordLimit
+    decoder.minProb = minProb
+    with self.lock:
+      self.busy[id(decoder)] = key
+    return decoder
+
+  def Return(self, decoder):
+    """Pauses a decoder and keeps it for reuse"""
+    decoder.Pause()
+    decoder.Flush()
+    decoder.SetCallback(None)
+    with self.lock:
+      key = self.busy.pop(id(decoder))
+      self.idle.append((time.time(), key, decoder))
+      self.__EvictIdle(time.time())
+
+  def Warm(self, **kwargs):
+    """Loads a decoder ahead of time so a later Checkout is instant"""
+    self.Return(self.Checkout(None, **kwargs))
+
+  def Invalidate(self, path):
+    """Exits idle decoders loaded from path, e.g. after it is rewritten,
+       and returns how many decoders still checked out use it
+    """
+    with self.lock:
+      keep = []
+      for entry in self.idle:
+        if (path in entry[1][:4]):
+          entry[2].Exit()
+        else:
+          keep.append(entry)
+      self.idle = keep
+      return len([k for k in self.busy.values() if path in k[:4]])
+
+  def Evict(self):
+    """Exits idle decoders which have passed the idle timeout"""
+    with self.lock:
+      self.__EvictIdle(time.time())
+
+  def GetStats(self):
+    with self.lock:
+      return { 'idle': len(self.idle), 'busy': len(self.busy),
+               'maxSize': self.maxSize }
+
+  def Exit(self):
+    """Exits every idle decoder; decoders still checked out are left alone"""
+    with self.lock:
+      for entry in self.idle:
+        entry[2].Exit()
+      self.idle = []
@@ -0,0 +1,182 @@
+"""
+FeatureCache
+
+A content addressed cache of acoustic feature (.mfc) files.
+
+Features are stored under the hash of the feature parameters and the hash
+of each wave file's contents, so an utterance is only passed to sphinx_fe
+when its audio is new or has changed, and every feature is regenerated
+when feat.params changes.  Missing features are extracted by several
+sphinx_fe processes at once.
+
+Dependencies: sphinxbase
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from ParallelCmd import SplitList, RunCommands, DefaultJobs
+import hashlib
+import shutil
+import os
+
+NEWLINE = "\n"
+
+def HashFile(path, extra=''):
+  h = hashlib.sha1(extra)
+  with open(path, 'rb') as f:
+    while (True):
+      block = f.read(1 << 16)
+      if (not block):
+        break
+      h.update(block)
+  return h.hexdigest()
+
+def LinkFile(src, dst):
+  """Hard links src to dst (replacing dst), copying if links fail"""
+  if (os.path.lexists(dst)):
+    os.remove(dst)
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst)
+
+def LinkTree(src, dst):
+  """Recreates the directory src at dst with every file hard linked, so
+     the two share storage.  Files must be unlinked, never rewritten in
+     place, once linked.
+  """
+  os.makedirs(dst)
+  for name in os.listdir(src):
+    s = os.path.join(src, name)
+    d = os.path.join(dst, name)
+    if (os.path.isdir(s) and not os.path.islink(s)):
+      LinkTree(s, d)
+    elif (os.path.islink(s)):
+      os.symlink(os.readlink(s), d)
+    else:
+      LinkFile(s, d)
+
+class FeatureCache:
+
+  MANIFEST = "manifest"
+  WAV = ".wav"
+  MFC = ".mfc"
+
+  def __init__(self, root, params, rate, jobs=None):
+    """root is the cache directory and params the feat.params file"""
+    if (root[-1] != '/'): root += '/'
+    self.root = root
+    self.params = params
+    self.rate = rate
+    self.jobs = jobs if (jobs) else DefaultJobs()
+    # Parameters and sample rate both change the features produced
+    self.paramsHash = HashFile(params, str(rate))
+    self.store = self.root + self.paramsHash + '/'
+    if (not os.path.isdir(self.store)):
+      os.makedirs(self.store)
+    self.manifest = self.__LoadManifest()
+    self.hashes = {}       # id -> wave hash used by the last Update
+
+  def __LoadManifest(self):
+    """Maps id -> (size, mtime, hash) for wave files hashed before"""
+    manifest = {}
+    path = self.root + self.MANIFEST
+    if (os.path.exists(path)):
+      with open(path, 'r') as f:
+        for line in f:
+          parts = line.split()
+          if (len(parts) == 4):
+            manifest[parts[0]] = (int(parts[1]), parts[2], parts[3])
+    return manifest
+
+  def __SaveManifest(self):
+    path = self.root + self.MANIFEST
+    with open(path + '.tmp', 'w') as f:
+      for id, (size, mtime, h) in self.manifest.iteritems():
+        f.write("%s %d %s %s" % (id, size, mtime, h) + NEWLINE)
+    os.rename(path + '.tmp', path)
+
+  def __WaveHash(self, id, path):
+    """Hashes a wave file, skipping files whose size and mtime match"""
+    st = os.stat(path)
+    mtime = repr(st.st_mtime)
+    known = self.manifest.get(id)
+    if (known and known[0] == st.st_size and known[1] == mtime):
+      return known[2]
+    h = HashFile(path)
+    self.manifest[id] = (st.st_size, mtime, h)
+    return h
+
+  def GetHash(self, id):
+    """Returns the content hash of a wave file seen by Update"""
+    return self.hashes[id]
+
+  def Update(self, ids, wavdir, outdir, logfile=None, hashes=None,
+             export=None):
+    """Makes outdir/<id>.mfc current for every id, extracting only the
+       features not already cached.  Returns the number extracted.
+
+       If hashes (id -> wave hash) are known the wave files are not read,
+       and if export is given it is called as export(ids, wavdir) to write
+       just the wave files which need extracting.
+    """
+    if (wavdir[-1] != '/'): wavdir += '/'
+    if (outdir[-1] != '/'): outdir += '/'
+    known = hashes
+    hashes = {}
+    missing = []
+    for id in ids:
+      if (known and id in known):
+        h = known[id]
+      else:
+        h = self.__WaveHash(id, wavdir + id + self.WAV)
+      hashes[id] = h
+      if (not os.path.exists(self.store + h + self.MFC)):
+        missing.append(id)
+    if (export and missing):
+      export(missing, wavdir)
+    self.__Extract(missing, wavdir, hashes, logfile)
+    for id in ids:
+      cached = self.store + hashes[id] + self.MFC
+      if (os.path.exists(cached)):
+        LinkFile(cached, outdir + id + self.MFC)
+    self.hashes.update(hashes)
+    self.__SaveManifest()
+    return len(missing)
+
+  def __Extract(self, ids, wavdir, hashes, logfile):
+    if (len(ids) == 0):
+      return
+    tmp = self.store + 'tmp/'
+    if (not os.path.isdir(tmp)):
+      os.makedirs(tmp)
+    try:
+      cmds = []
+      for k, shard in enumerate(SplitList(ids, self.jobs)):
+        ctl = tmp + 'shard%d.fileids' % k
+        with open(ctl, 'w') as f:
+          f.write(NEWLINE.join(shard) + NEWLINE)
+        cmds.append([ 'sphinx_fe', '-argfile', self.params,
+                      '-samprate', str(self.rate), '-c', ctl,
+                      '-di', wavdir, '-do', tmp, '-ei', 'wav',
+                      '-eo', 'mfc', '-mswav', 'yes' ])
+      RunCommands(cmds, self.jobs, logfile)
+      for id in ids:
+        out = tmp + id + self.MFC
+        if (os.path.exists(out)):
+          os.rename(out, self.store + hashes[id] + self.MFC)
+    finally:
+      shutil.rmtree(tmp, ignore_errors=True)
+
+  def Prune(self):
+    """Removes features made with other parameters"""
+    for d in os.listdir(self.root):
+      if (d != self.paramsHash and os.path.isdir(self.root + d)):
+        shutil.rmtree(self.root + d, ignore_errors=True)
@@ -0,0 +1,386 @@
+"""
+LanguageModel
+
+Builds back-off n-gram language models directly from a text corpus.
+
+The corpus is streamed once and n-grams are counted in sorted numpy
+tables of 64 bit keys, with the word ids of an n-gram packed into each
+key, and 32 bit counts.  Recent counts are gathered in a dictionary and
+merged into the tables in batches, so memory stays close to twelve bytes
+per distinct n-gram.  Probabilities use Witten-Bell discounting with
+back-off to lower orders, and the model is written in ARPA format,
+optionally followed by conversion to the binary format pocketsphinx
+loads more quickly.
+
+Dependencies: numpy, sphinxbase (only for binary output)
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import numpy as np
+import subprocess
+import marshal
+import os
+
+class LanguageModelExceptionVocabularyFull:
+  pass
+
+class LanguageModelExceptionBadCounts:
+  pass
+
+def MergeCounts(tables):
+  """Merges (keys, counts) tables into one sorted table of unique keys"""
+  keys = np.concatenate([t[0] for t in tables])
+  counts = np.concatenate([t[1] for t in tables])
+  if (len(keys) == 0):
+    return keys, counts
+  order = np.argsort(keys, kind='mergesort')
+  keys = keys[order]
+  counts = counts[order]
+  starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+  return keys[starts], np.add.reduceat(counts, starts).astype(np.uint32)
+
+class LanguageModel:
+
+  ORDER = 3
+  VOCABSIZE = 20000        # Most frequent words kept, as wfreq2vocab
+  MAXNGRAMS = 20000000     # Table entries before singletons are pruned
+  BUFFERSIZE = 500000      # Recent n-grams counted before a merge
+  START = '<s>'
+  END = '</s>'
+  UNK = '<UNK>'
+  NEWLINE = "\n"
+  LOGZERO = -99.0
+  VERSION = 2              # Format of saved count tables
+
+  def __init__(self, order=ORDER, vocabSize=VOCABSIZE, cutoffs=None,
+               maxNgrams=MAXNGRAMS):
+    """cutoffs[k] is the count at or below which (k+2)-grams are dropped
+       when the model is written, e.g. [1, 1] for a trigram model.  An
+       n-gram whose context was dropped is dropped with it.
+    """
+    self.order = order
+    self.vocabSize = vocabSize
+    self.cutoffs = cutoffs if (cutoffs) else [0] * (order - 1)
+    self.maxNgrams = maxNgrams
+    self.__SetOrder(order)
+    self.words = []          # id -> word
+    self.ids = {}            # word -> id
+    # counts[n-1] is a (keys, counts) table sorted by key, and pending[n-1]
+    # holds recent counts not yet merged into it
+    self.counts = [self.__EmptyTable() for n in range(order)]
+    self.pending = [{} for n in range(order)]
+    self.pendingSize = 0
+    self.pruned = 0
+    self.__WordId(self.START)
+    self.__WordId(self.END)
+
+  def __SetOrder(self, order):
+    # Every word id of an n-gram must fit in one 64 bit key
+    self.bits = 64 // order
+    self.mask = (1 << self.bits) - 1
+
+  def __EmptyTable(self):
+    return (np.zeros(0, np.uint64), np.zeros(0, np.uint32))
+
+  def __WordId(self, word):
+    id = self.ids.get(word)
+    if (id is None):
+      id = len(self.words)
+      if (id > self.mask):
+        raise LanguageModelExceptionVocabularyFull
+      self.ids[word] = id
+      self.words.append(word)
+    return id
+
+  def Key(self, ids):
+    key = 0
+    for id in ids:
+      key = (key << self.bits) | id
+    return key
+
+  def Ids(self, key, n):
+    ids = []
+    for i in range(n):
+      ids.append(key & self.mask)
+      key >>= self.bits
+    ids.reverse()
+    return ids
+
+  def AddSentence(self, sent):
+    words = [w for w in sent.split() if w not in (self.START, self.END)]
+    if (len(words) == 0):
+      return
+    ids = ([self.ids[self.START]] + [self.__WordId(w) for w in words] +
+           [self.ids[self.END]])
+    bits = self.bits
+    for i in range(1, len(ids)):
+      key = 0
+      for n in range(min(self.order, i + 1)):
+        # Extend the n-gram ending at word i one word further back
+        key |= ids[i - n] << (bits * n)
+        table = self.pending[n]
+        c = table.get(key)
+        if (c is None):
+          table[key] = 1
+          self.pendingSize += 1
+        else:
+          table[key] = c + 1
+    if (self.pendingSize >= self.BUFFERSIZE):
+      self.__Merge()
+
+  def __Merge(self):
+    """Folds pending counts into the sorted tables"""
+    for n, table in enumerate(self.pending):
+      if (len(table) == 0):
+        continue
+      keys = np.fromiter(table.iterkeys(), np.uint64, len(table))
+      counts = np.fromiter(table.itervalues(), np.uint32, len(table))
+      self.counts[n] = MergeCounts([self.counts[n], (keys, counts)])
+      self.pending[n] = {}
+    self.pendingSize = 0
+    if (self.GetNgramCount() > self.maxNgrams):
+      self.__PruneSingletons()
+
+  def AddCorpus(self, path):
+    """Counts every line of a corpus file, returning the number of lines"""
+    k = 0
+    with open(path, 'r') as f:
+      for line in f:
+        self.AddSentence(line)
+        k += 1
+    return k
+
+  def AddCorpusFrom(self, path, offset=0):
+    """Counts the complete lines of a corpus file after a byte offset and
+       returns the offset following the last line counted, so a corpus
+       that is only appended to can be caught up with incrementally
+    """
+    with open(path, 'rb') as f:
+      f.seek(offset)
+      for line in f:
+        if (not line.endswith(self.NEWLINE)):
+          break     # Partly written, count it next time
+        self.AddSentence(line)
+        offset += len(line)
+    return offset
+
+  def Save(self, path, state=None):
+    """Saves the count tables together with any caller state (such as the
+       corpus offset they reflect)
+    """
+    self.__Merge()
+    tables = [(keys.tostring(), counts.tostring())
+              for keys, counts in self.counts]
+    data = (self.VERSION, self.order, self.vocabSize, self.cutoffs,
+            self.maxNgrams, self.words, tables, self.pruned, state)
+    with open(path + '.tmp', 'wb') as f:
+      marshal.dump(data, f)
+      f.close()
+    os.rename(path + '.tmp', path)
+
+  def Load(self, path):
+    """Replaces the count tables with saved ones and returns the state
+       given to Save
+    """
+    with open(path, 'rb') as f:
+      try:
+        data = marshal.load(f)
+      except (EOFError, ValueError, TypeError):
+        raise LanguageModelExceptionBadCounts
+      f.close()
+    if (data[0] != self.VERSION):
+      raise LanguageModelExceptionBadCounts
+    (version, self.order, self.vocabSize, self.cutoffs, self.maxNgrams,
+     self.words, tables, self.pruned, state) = data
+    self.__SetOrder(self.order)
+    self.counts = [(np.frombuffer(keys, np.uint64),
+                    np.frombuffer(counts, np.uint32))
+                   for keys, counts in tables]
+    self.pending = [{} for n in range(self.order)]
+    self.pendingSize = 0
+    self.ids = dict((w, id) for id, w in enumerate(self.words))
+    return state
+
+  def GetNgramCount(self):
+    """Returns the number of table entries, counting pending n-grams which
+       may already be in the tables
+    """
+    return (sum(len(keys) for keys, counts in self.counts) +
+            sum(len(t) for t in self.pending))
+
+  def __PruneSingletons(self):
+    """Keeps memory bounded by dropping n-grams seen once (above unigrams)"""
+    for n in range(1, self.order):
+      keys, counts = self.counts[n]
+      keep = counts > 1
+      self.pruned += len(keys) - int(keep.sum())
+      self.counts[n] = (keys[keep], counts[keep])
+
+  def GetVocabulary(self):
+    """Returns the words kept in the model, most frequent first"""
+    self.__Merge()
+    keys, counts = self.counts[0]
+    words = [(c, self.words[id])
+             for id, c in zip(keys.tolist(), counts.tolist())
+             if self.words[id] not in (self.START, self.END)]
+    words.sort(key=lambda x: (-x[0], x[1]))
+    return [w for c, w in words[:self.vocabSize]]
+
+  def __MapToVocabulary(self, vocab):
+    """Returns count tables with words outside vocab mapped to UNK"""
+    keep = set(self.ids[w] for w in vocab)
+    keep.add(self.ids[self.START])
+    keep.add(self.ids[self.END])
+    if (len(keep) == len(self.counts[0][0]) + 1):
+      return self.counts
+    unk = self.__WordId(self.UNK)
+    idmap = np.empty(len(self.words), np.uint64)
+    idmap.fill(unk)
+    keep = np.array(sorted(keep), np.intp)
+    idmap[keep] = keep
+    bits = np.uint64(self.bits)
+    mask = np.uint64(self.mask)
+    counts = []
+    for n, (keys, c) in enumerate(self.counts):
+      mapped = np.zeros(len(keys), np.uint64)
+      for i in range(n + 1):
+        shift = np.uint64(self.bits * i)
+        ids = ((keys >> shift) & mask).astype(np.intp)
+        mapped |= idmap[ids] << shift
+      counts.append(MergeCounts([(mapped, c)]))
+    return counts
+
+  def __Find(self, table, keys):
+    """Returns (values, found) for keys in a sorted (keys, values) table"""
+    tkeys, tvalues = table
+    if (len(tkeys) == 0):
+      return np.zeros(len(keys)), np.zeros(len(keys), bool)
+    i = np.minimum(np.searchsorted(tkeys, keys), len(tkeys) - 1)
+    return tvalues[i], tkeys[i] == keys
+
+  def __Groups(self, h):
+    """Returns the start of each run of equal values in sorted h"""
+    return np.flatnonzero(np.r_[True, h[1:] != h[:-1]])
+
+  def __Estimate(self, counts):
+    """Returns (probs, bows) where probs[n] is a sorted table of keys and
+       log10 probabilities and bows[n] one of keys and log10 back-off
+       weights
+    """
+    bits = np.uint64(self.bits)
+    start = self.ids[self.START]
+    probs = []
+    bows = [(np.zeros(0, np.uint64), np.zeros(0)) for n in range(self.order)]
+    # Unigrams: maximum likelihood, <s> is only ever a history
+    keys, c = counts[0]
+    other = keys != start
+    total = float(c[other].sum())
+    p1 = np.empty(len(keys))
+    p1.fill(self.LOGZERO)
+    p1[other] = np.log10(c[other] / total)
+    if (start not in keys):
+      i = np.searchsorted(keys, start)
+      keys = np.insert(keys, i, np.uint64(start))
+      p1 = np.insert(p1, i, self.LOGZERO)
+    probs.append((keys, p1))
+    for n in range(1, self.order):
+      keys, c = counts[n]
+      cutoff = self.cutoffs[n - 1] if (n - 1 < len(self.cutoffs)) else 0
+      if (len(keys) == 0):
+        probs.append((keys, np.zeros(0)))
+        continue
+      # Context totals and type counts include n-grams later cut off
+      h = keys >> bits
+      starts = self.__Groups(h)
+      ctypes = np.diff(np.r_[starts, len(h)])
+      ctotal = np.add.reduceat(c.astype(np.float64), starts)
+      p = c / np.repeat(ctotal + ctypes, ctypes)
+      # An n-gram whose context was cut off would leave its back-off
+      # weight dangling, so it goes too
+      kept = (c > cutoff) & self.__Find(probs[n - 1], h)[1]
+      keys = keys[kept]
+      h = h[kept]
+      p = p[kept]
+      if (len(keys) == 0):
+        probs.append((keys, np.zeros(0)))
+        continue
+      lowMask = np.uint64((1 << (self.bits * n)) - 1)
+      lower = self.__Prob(probs, bows, keys & lowMask, n)
+      starts = self.__Groups(h)
+      sizes = np.diff(np.r_[starts, len(h)])
+      ph = np.add.reduceat(p, starts)
+      pl = np.add.reduceat(10 ** lower, starts)
+      den = 1.0 - pl
+      # Where every word has been seen after h there is nothing to back
+      # off to: renormalize the seen words instead
+      full = den < 1e-6
+      bo = ~full
+      bows[n - 1] = (h[starts][bo], np.log10((1.0 - ph[bo]) / den[bo]))
+      pn = np.log10(p)
+      pn += np.repeat(np.where(full, -np.log10(ph), 0.0), sizes)
+      probs.append((keys, pn))
+    return probs, bows
+
+  def __Prob(self, probs, bows, keys, n):
+    """log10 P of each n-gram key (n words) using back-off"""
+    values, found = self.__Find(probs[n - 1], keys)
+    result = np.where(found, values, self.LOGZERO)
+    missing = ~found
+    if (n > 1 and missing.any()):
+      keys = keys[missing]
+      h = keys >> np.uint64(self.bits)
+      lower = keys & np.uint64((1 << (self.bits * (n - 1))) - 1)
+      bow, known = self.__Find(bows[n - 2], h)
+      result[missing] = (np.where(known, bow, 0.0) +
+                         self.__Prob(probs, bows, lower, n - 1))
+    return result
+
+  def WriteVocabulary(self, path):
+    vocab = sorted(self.GetVocabulary())
+    with open(path, 'w') as f:
+      for w in vocab + [self.START, self.END]:
+        f.write(w + self.NEWLINE)
+      f.close()
+    return len(vocab)
+
+  def WriteArpa(self, path):
+    vocab = self.GetVocabulary()
+    counts = self.__MapToVocabulary(vocab)
+    probs, bows = self.__Estimate(counts)
+    with open(path, 'w') as f:
+      f.write(self.NEWLINE + "\\data\\" + self.NEWLINE)
+      for n in range(self.order):
+        f.write("ngram %d=%d" % (n + 1, len(probs[n][0])) + self.NEWLINE)
+      for n in range(self.order):
+        f.write(self.NEWLINE + "\\%d-grams:" % (n + 1) + self.NEWLINE)
+        keys, p = probs[n]
+        bow, known = self.__Find(bows[n], keys)
+        bow = np.where(known, bow, 0.0)
+        prev = None
+        for key, pk, bk in zip(keys.tolist(), p.tolist(), bow.tolist()):
+          # Sorted keys group n-grams by context, so its text is reused
+          h = key >> self.bits
+          if (h != prev):
+            prev = h
+            context = ''.join(self.words[id] + ' ' for id in self.Ids(h, n))
+          text = context + self.words[key & self.mask]
+          line = "%.4f\t%s" % (pk, text)
+          if (n < self.order - 1):
+            line += "\t%.4f" % bk
+          f.write(line + self.NEWLINE)
+      f.write(self.NEWLINE + "\\end\\" + self.NEWLINE)
+      f.close()
+
+  def WriteBinary(self, arpa, path):
+    """Converts an ARPA file to the binary (DMP) format with sphinx_lm_convert"""
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.call([ 'sphinx_lm_convert', '-i', arpa, '-o', path ],
+                             stdout=devnull, stderr=devnull)
@@ -0,0 +1,62 @@
+"""
+ParallelCmd
+
+Helpers for splitting work into shards and running external commands
+concurrently on a bounded number of processes.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import subprocess
+import os
+
+def DefaultJobs():
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+def SplitList(items, n):
+  """Splits items into at most n contiguous shards of near equal size,
+     so concatenating the shards restores the original order
+  """
+  items = list(items)
+  n = max(1, min(n, len(items)))
+  size, extra = divmod(len(items), n)
+  shards = []
+  start = 0
+  for i in range(n):
+    end = start + size + (1 if (i < extra) else 0)
+    shards.append(items[start:end])
+    start = end
+  return [s for s in shards if s]
+
+def RunCommands(cmds, jobs=None, logfile=None, cwd=None):
+  """Runs each command with at most jobs running at once and returns
+     their exit codes in the order given.  Output and errors go to
+     logfile if given, otherwise they are discarded.
+  """
+  if (jobs is None):
+    jobs = DefaultJobs()
+  if (len(cmds) == 0):
+    return []
+  with open(os.devnull, 'w') as devnull:
+    out = logfile if (logfile) else devnull
+    def Run(cmd):
+      return subprocess.call(cmd, stdout=out, stderr=out, cwd=cwd)
+    pool = ThreadPool(max(1, min(jobs, len(cmds))))
+    try:
+      codes = pool.map(Run, cmds)
+    finally:
+      pool.close()
+      pool.join()
+  return codes
@@ -0,0 +1,100 @@
+"""
+ParallelDecode
+
+Decodes large batches of utterances by sharding the control file across
+several pocketsphinx_batch processes.  Each process loads the HMM, LM and
+dictionary once and decodes its whole shard, and the hypotheses are merged
+back into the original utterance order.
+
+Dependencies: pocketsphinx
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from ParallelCmd import SplitList, RunCommands, DefaultJobs
+import tempfile
+import shutil
+import re
+import os
+
+NEWLINE = "\n"
+
+class ParallelDecodeExceptionDecoderFailed:
+  pass
+
+def ReadControlFile(path):
+  with open(path, 'r') as f:
+    return [line.strip() for line in f if line.strip()]
+
+def ParseHypLine(line):
+  """Returns (uttid, line) for a pocketsphinx hypothesis line"""
+  m = re.search(r'\((\S+?)(\s+-?\d+)?\)\s*$', line)
+  if (m is None):
+    return (None, line)
+  return (m.group(1), line)
+
+def MergeHyps(ids, hyps, out):
+  """Writes hypotheses from the shard files in the order of ids.  An
+     utterance missing from every shard gets an empty hypothesis so that
+     word alignment still counts it.
+  """
+  found = {}
+  for path in hyps:
+    if (not os.path.exists(path)):
+      continue
+    with open(path, 'r') as f:
+      for line in f:
+        uttid, line = ParseHypLine(line.rstrip(NEWLINE))
+        if (uttid is not None):
+          found[uttid] = line
+  missing = 0
+  with open(out, 'w') as f:
+    for id in ids:
+      if (id in found):
+        f.write(found[id] + NEWLINE)
+      else:
+        f.write(" (" + id + ")" + NEWLINE)
+        missing += 1
+  return missing
+
+def DecodeBatch(ids, cepdir, hmm, lm, dic, hyp, jobs=None, cepext='.wav',
+                fsg=None, logfile=None, args=[]):
+  """Decodes the utterance ids found in cepdir into the hypothesis file
+     hyp using up to jobs processes.  Returns the number of utterances
+     which produced no hypothesis.  Raises an exception if any decoder
+     exits with an error, whose messages go to logfile if given.
+  """
+  if (jobs is None):
+    jobs = DefaultJobs()
+  workdir = tempfile.mkdtemp(prefix='decode')
+  try:
+    cmds = []
+    hyps = []
+    for k, shard in enumerate(SplitList(ids, jobs)):
+      ctl = os.path.join(workdir, 'shard%d.fileids' % k)
+      with open(ctl, 'w') as f:
+        f.write(NEWLINE.join(shard) + NEWLINE)
+      out = os.path.join(workdir, 'shard%d.hyp' % k)
+      cmd = [ 'pocketsphinx_batch', '-adcin', 'yes', '-cepdir', cepdir,
+              '-cepext', cepext, '-ctl', ctl, '-dict', dic, '-hmm', hmm,
+              '-hyp', out ]
+      if (fsg):
+        cmd += [ '-fsg', fsg ]
+      else:
+        cmd += [ '-lm', lm ]
+      cmds.append(cmd + list(args))
+      hyps.append(out)
+    codes = RunCommands(cmds, jobs, logfile)
+    if (any(codes)):
+      # Merging would pass a failed shard off as empty hypotheses
+      raise ParallelDecodeExceptionDecoderFailed
+    return MergeHyps(ids, hyps, hyp)
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,145 @@
+"""
+PronunciationStore
+
+A persistent word to pronunciation store used to build dictionaries.
+
+The store is a dictionary file in the usual SPHINX format which is only
+ever appended to.  It is seeded from existing .dic files, and words with
+no pronunciation are passed to the logios letter-to-sound tools in
+batches run concurrently, so the cost of building a dictionary grows with
+the number of new words rather than the size of the vocabulary.
+
+Dependencies: logios
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from ParallelCmd import RunCommands, DefaultJobs
+import threading
+import tempfile
+import shutil
+import re
+import os
+
+NEWLINE = "\n"
+
+def ReadDictionary(path):
+  """Returns a list of (word, pronunciation), with alternate
+     pronunciations such as WORD(2) given under their base word
+  """
+  entries = []
+  with open(path, 'r') as f:
+    for line in f:
+      parts = line.split(None, 1)
+      if (len(parts) < 2 or parts[0].startswith('##')):
+        continue
+      word = re.sub(r'\(\d+\)$', '', parts[0])
+      entries.append((word, ' '.join(parts[1].split())))
+  return entries
+
+class PronunciationStore:
+
+  BATCHSIZE = 500          # Words per letter-to-sound run
+  DICTCMD = "MakeDict/make_pronunciation.pl"
+
+  def __init__(self, path, tools, jobs=None):
+    """path is the store file, tools the logios Tools directory"""
+    self.path = path
+    self.tools = tools
+    self.jobs = jobs if (jobs) else DefaultJobs()
+    self.lock = threading.Lock()
+    self.prons = {}          # word -> [pronunciation, ...]
+    if (os.path.exists(path)):
+      for word, pron in ReadDictionary(path):
+        self.__Add(word, pron)
+
+  def __Add(self, word, pron):
+    prons = self.prons.setdefault(word, [])
+    if (pron not in prons):
+      prons.append(pron)
+      return True
+    return False
+
+  def __Append(self, entries):
+    """Adds entries to memory and to the end of the store file"""
+    with self.lock:
+      with open(self.path, 'a') as f:
+        for word, pron in entries:
+          if (self.__Add(word, pron)):
+            f.write(word + '\t' + pron + NEWLINE)
+        f.close()
+
+  def Seed(self, path):
+    """Adds pronunciations from an existing dictionary for words the store
+       does not know yet, returning the number of words added
+    """
+    new = [(w, p) for w, p in ReadDictionary(path) if w not in self.prons]
+    self.__Append(new)
+    return len(set(w for w, p in new))
+
+  def Has(self, word):
+    return (word in self.prons)
+
+  def Get(self, word):
+    return self.prons.get(word, [])
+
+  def GetMissing(self, words):
+    return [w for w in words if w not in self.prons]
+
+  def Generate(self, words, logfile=None):
+    """Runs letter-to-sound on the words not already in the store and
+       returns the number of words given a pronunciation
+    """
+    missing = sorted(set(self.GetMissing(words)))
+    if (len(missing) == 0):
+      return 0
+    workdir = tempfile.mkdtemp(prefix='pron')
+    try:
+      batches = []
+      for i in range(0, len(missing), self.BATCHSIZE):
+        batches.append(missing[i:i + self.BATCHSIZE])
+      cmds = []
+      outs = []
+      for k, batch in enumerate(batches):
+        dictdir = os.path.join(workdir, str(k))
+        os.makedirs(dictdir)
+        with open(os.path.join(dictdir, 'words'), 'w') as f:
+          f.write(NEWLINE.join(batch) + NEWLINE)
+        cmds.append([ os.path.join(self.tools, self.DICTCMD), '-tools',
+                      self.tools, '-dictdir', dictdir, '-words', 'words',
+                      '-dict', 'words.dic' ])
+        outs.append(os.path.join(dictdir, 'words.dic'))
+      RunCommands(cmds, self.jobs, logfile)
+      wanted = set(missing)
+      entries = []
+      for out in outs:
+        if (os.path.exists(out)):
+          entries += [(w, p) for w, p in ReadDictionary(out) if w in wanted]
+      self.__Append(entries)
+      return len(set(w for w, p in entries))
+    finally:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  def WriteDictionary(self, words, path):
+    """Writes a dictionary for words, returning the words which have no
+       pronunciation and were left out
+    """
+    missing = []
+    with open(path, 'w') as f:
+      for word in sorted(set(words)):
+        prons = self.prons.get(word)
+        if (not prons):
+          missing.append(word)
+          continue
+        for k, pron in enumerate(prons):
+          name = word if (k == 0) else "%s(%d)" % (word, k + 1)
+          f.write(name + '\t' + pron + NEWLINE)
+      f.close()
+    return missing
@@ -0,0 +1,290 @@
+"""
+RecognizerLoop
+
+A single-threaded event loop which hosts many recognizer sessions.
+
+ASR and ASRGoogleAPI share the same Play/Pause/Flush/Exit controls and the
+same callback(event, tag, items) signature but deliver events from
+gstreamer or their own worker threads.  A RecognizerLoop runs every
+control operation and every event handler for all of its sessions on one
+thread, so sessions need no locking of their own.  Control operations
+return futures which can be waited on or cancelled, and each session can
+be consumed as an iterator of events.
+
+Backends which accept a loop also run their audio processing on it and
+share one HTTP transport and one encoder pool per loop, so adding a
+session does not add threads beyond those of the audio device (and of
+gstreamer for pocketsphinx).
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import threading
+import Queue
+import sys
+
+class RecognizerCancelled:
+  pass
+
+class RecognizerTimeout:
+  pass
+
+class RecognizerFuture:
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.result = None
+    self.error = None
+    self.cancelled = False
+    self.callbacks = []
+    self.lock = threading.Lock()
+
+  def Done(self):
+    return self.event.is_set()
+
+  def Cancel(self):
+    """Cancels the operation if it has not run yet"""
+    return self.__Complete(None, RecognizerCancelled(), True)
+
+  def IsCancelled(self):
+    return self.cancelled
+
+  def SetResult(self, result):
+    return self.__Complete(result, None, False)
+
+  def SetError(self, error):
+    return self.__Complete(None, error, False)
+
+  def __Complete(self, result, error, cancelled):
+    with self.lock:
+      if (self.event.is_set()):
+        return False
+      self.result = result
+      self.error = error
+      self.cancelled = cancelled
+      self.event.set()
+      callbacks = self.callbacks
+      self.callbacks = []
+    for cb in callbacks:
+      cb(self)
+    return True
+
+  def AddDoneCallback(self, callback):
+    with self.lock:
+      if (not self.event.is_set()):
+        self.callbacks.append(callback)
+        return
+    callback(self)
+
+  def Wait(self, timeout=None):
+    """Waits for completion and returns the result (or raises its error).
+       Raises RecognizerTimeout if it has not completed within timeout.
+    """
+    if (not self.event.wait(timeout)):
+      raise RecognizerTimeout()
+    if (self.error is not None):
+      raise self.error
+    return self.result
+
+class RecognizerLoop:
+
+  def __init__(self):
+    self.tasks = Queue.Queue()
+    self.thread = None
+    self.running = False
+    self.lock = threading.Lock()
+    self.transports = {}     # url -> HTTPTransport shared by sessions
+    self.encoders = {}       # (channels, sampwidth, rate) -> AudioEncoder
+
+  def GetTransport(self, url, workers=None, timeout=None):
+    """Returns the transport shared by every session posting to url"""
+    from SpeechTransport import HTTPTransport
+    with self.lock:
+      if (url not in self.transports):
+        self.transports[url] = HTTPTransport(url, None,
+          workers=workers if (workers) else HTTPTransport.WORKERS,
+          timeout=timeout if (timeout) else HTTPTransport.TIMEOUT)
+      return self.transports[url]
+
+  def GetEncoder(self, channels, sampwidth, rate):
+    """Returns the encoder pool shared by sessions with this audio format"""
+    from AudioEncode import AudioEncoder
+    key = (channels, sampwidth, rate)
+    with self.lock:
+      if (key not in self.encoders):
+        self.encoders[key] = AudioEncoder(channels, sampwidth, rate)
+      return self.encoders[key]
+
+  def Start(self):
+    """Runs the loop on its own background thread"""
+    if (self.thread is None):
+      self.thread = threading.Thread(target=self.RunForever)
+      self.thread.daemon = True
+      self.thread.start()
+
+  def RunForever(self):
+    """Runs queued work until Stop is called (may be used instead of Start)"""
+    self.running = True
+    while (self.running):
+      task = self.tasks.get()
+      if (task is None):
+        break
+      future, func, args = task
+      if (future and future.Done()):
+        continue     # Cancelled before it ran
+      try:
+        result = func(*args)
+        if (future):
+          future.SetResult(result)
+      except Exception as e:
+        if (future):
+          future.SetError(e)
+        else:
+          print "Recognizer loop handler failed:", sys.exc_info()[1]
+    self.running = False
+
+  def IsLoopThread(self):
+    return (threading.current_thread() is self.thread)
+
+  def CallSoon(self, func, *args):
+    """Schedules func on the loop thread and returns a future for it"""
+    future = RecognizerFuture()
+    self.tasks.put((future, func, args))
+    return future
+
+  def Post(self, func, *args):
+    """Schedules func on the loop thread without a future"""
+    self.tasks.put((None, func, args))
+
+  def Stop(self):
+    self.tasks.put(None)
+    if (self.thread and not self.IsLoopThread()):
+      self.thread.join()
+      self.thread = None
+    with self.lock:
+      for transport in self.transports.values():
+        transport.Exit()
+      for encoder in self.encoders.values():
+        encoder.Exit()
+      self.transports = {}
+      self.encoders = {}
+
+class RecognizerSession:
+
+  CLOSED = ('closed', None, None)    # End of the event stream
+
+  def __init__(self, loop, factory, handler=None):
+    """factory(callback) must create a recognizer (such as ASR or
+       ASRGoogleAPI) that reports through callback(event, tag, items).
+       handler(event, tag, items), if given, is called on the loop thread.
+    """
+    self.loop = loop
+    self.factory = factory
+    self.handler = handler
+    self.recognizer = None
+    self.events = Queue.Queue()
+    self.closed = False
+
+  def __OnEvent(self, event, tag, items):
+    # Recognizer threads hand their events over to the loop thread
+    self.loop.Post(self.__Dispatch, event, tag, items)
+
+  def __Dispatch(self, event, tag, items):
+    if (self.closed):
+      return
+    self.events.put((event, tag, items))
+    if (self.handler):
+      self.handler(event, tag, items)
+
+  def __Start(self):
+    if (self.recognizer is None):
+      self.recognizer = self.factory(self.__OnEvent)
+    self.recognizer.Play()
+
+  def __Stop(self):
+    if (self.recognizer):
+      self.recognizer.Pause()
+
+  def __Flush(self):
+    if (self.recognizer):
+      self.recognizer.Flush()
+
+  def __Close(self):
+    if (self.recognizer):
+      self.recognizer.Pause()
+      self.recognizer.Exit()
+      self.recognizer = None
+    if (not self.closed):
+      self.closed = True
+      self.events.put(self.CLOSED)
+
+  def Start(self):
+    """Creates the recognizer if needed and starts listening"""
+    return self.loop.CallSoon(self.__Start)
+
+  def Stop(self):
+    """Pauses listening; the session may be started again"""
+    return self.loop.CallSoon(self.__Stop)
+
+  def Flush(self):
+    return self.loop.CallSoon(self.__Flush)
+
+  def Close(self):
+    """Shuts the recognizer down and ends the event stream"""
+    return self.loop.CallSoon(self.__Close)
+
+  def Cancel(self):
+    """Abandons pending results and closes the session"""
+    self.loop.CallSoon(self.__Flush)
+    return self.Close()
+
+  def NextEvent(self, timeout=None):
+    """Returns the next (event, tag, items), or None on timeout or close"""
+    try:
+      ev = self.events.get(True, timeout)
+    except Queue.Empty:
+      return None
+    if (ev is self.CLOSED):
+      self.events.put(ev)    # Stay closed for any other readers
+      return None
+    return ev
+
+  def Events(self, timeout=None):
+    """Iterates over events until the session is closed (or a timeout)"""
+    while (True):
+      ev = self.NextEvent(timeout)
+      if (ev is None):
+        return
+      yield ev
+
+  def Results(self, timeout=None):
+    """Iterates over final results only, skipping partials"""
+    for event, tag, items in self.Events(timeout):
+      if (event == 'result'):
+        yield (tag, items)
+
+def ASRSession(loop, handler=None, **kwargs):
+  """A session around the pocketsphinx recognizer"""
+  from ASR import ASR
+  return RecognizerSession(loop, lambda cb: ASR(cb, **kwargs), handler)
+
+def GoogleSession(loop, handler=None, **kwargs):
+  """A session around the Google recognizer, which runs on the loop and
+     uses its shared transport and encoder
+  """
+  from ASRGoogleAPI import ASRGoogleAPI
+  return RecognizerSession(loop, lambda cb: ASRGoogleAPI(cb, loop=loop,
+                                                         **kwargs), handler)
+
+def MuxSession(loop, backends, handler=None, **kwargs):
+  """A session around several backends sharing one capture"""
+  from RecognizerMux import RecognizerMux
+  return RecognizerSession(loop, lambda cb: RecognizerMux(backends, cb,
+                                                          **kwargs), handler)
@@ -0,0 +1,248 @@
+"""
+RecognizerMux
+
+Captures each utterance once and fans it out to several recognition
+backends concurrently, arbitrating between their results.
+
+In FIRST mode the first acceptable result wins, trading cost for latency.
+In BEST mode every backend is given until the deadline and the highest
+scoring result wins.  The multiplexer exposes the same Play/Pause/Flush/
+Exit controls and callback(event, tag, items) as ASR and ASRGoogleAPI,
+reporting the tag of the winning backend.
+
+A backend is any object with a 'tag' attribute and a Recognize(utterance)
+method returning (items, score) or None, where score may be None if the
+backend has no confidence measure.  Scores are only comparable between
+backends of the same kind, so BEST mode is most useful with several
+instances of one backend (e.g. pocketsphinx with different models).
+
+Dependencies: SpeechRecord, AudioEncode, requests
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from SpeechRecord import SpeechRecord
+from VAD import AdaptiveVAD, HangoverVAD
+from SpeechStream import ParseResults
+import AudioEncode
+from multiprocessing.pool import ThreadPool
+import threading
+import Queue
+import time
+import json
+import sys
+import requests
+
+class Utterance:
+
+  def __init__(self, pcm, rate, channels=1, sampwidth=2):
+    """One captured utterance shared (read-only) by all backends"""
+    self.pcm = pcm
+    self.rate = rate
+    self.channels = channels
+    self.sampwidth = sampwidth
+    self.encoded = {}
+    self.lock = threading.Lock()
+
+  def GetDuration(self):
+    return float(len(self.pcm)) / (self.rate * self.channels * self.sampwidth)
+
+  def Encode(self, fmt):
+    """Returns the audio in the given format, encoding it at most once"""
+    with self.lock:
+      if (fmt not in self.encoded):
+        self.encoded[fmt] = AudioEncode.Encode(self.pcm, fmt, self.channels,
+                                               self.sampwidth, self.rate)
+      return self.encoded[fmt]
+
+class GoogleRecognizer:
+
+  URL = 'https://www.google.com/speech-api/v1/recognize?client=chromium&lang=en-QA&maxresults=10'
+  TIMEOUT = 10
+
+  def __init__(self, url=URL, tag='google', timeout=TIMEOUT):
+    """Backend posting complete utterances to the Google API"""
+    self.url = url
+    self.tag = tag
+    self.timeout = timeout
+    self.session = requests.Session()
+
+  def Recognize(self, utterance):
+    headers = { 'Content-Type': AudioEncode.CONTENTTYPES[AudioEncode.FLAC] +
+                '; rate=' + str(utterance.rate) + ';' }
+    try:
+      r = self.session.post(self.url, data=utterance.Encode(AudioEncode.FLAC),
+                            headers=headers, timeout=self.timeout)
+      resp = json.loads(r.text)
+    except (requests.RequestException, ValueError):
+      print "Was not able to process API response:", sys.exc_info()[1]
+      return None
+    for event, items in ParseResults(resp):
+      if (event == 'result'):
+        score = None
+        hyps = resp.get('hypotheses', [])
+        if (len(hyps) > 0 and 'confidence' in hyps[0]):
+          score = hyps[0]['confidence']
+        return (items, score)
+    return None
+
+class PocketsphinxRecognizer:
+
+  def __init__(self, tag='cmu', **kwargs):
+    """Backend using the batch mode of an ASR instance (see ASR for kwargs).
+       Decodes are serialized since they share one decoder.
+    """
+    from ASR import ASR
+    self.tag = tag
+    self.asr = ASR(None, tag=tag, live=False, **kwargs)
+    self.lock = threading.Lock()
+
+  def Recognize(self, utterance):
+    with self.lock:
+      res = self.asr.DecodeBuffers([utterance.pcm], utterance.rate,
+                                   utterance.channels, utterance.sampwidth)
+    items, prob = res[0][1:3]
+    if (not items or prob < self.asr.minProb or
+        len(items[0].split(' ')) > self.asr.wordLimit):
+      return None
+    return (items, prob)
+
+class RecognizerMux:
+
+  FIRST = 'first'          # First acceptable result wins
+  BEST = 'best'            # Best score received before the deadline wins
+
+  RATE = 16000
+  DEADLINE = 5.0           # Seconds to wait for backends per utterance
+  MAXRECTIME = 15
+  INITIALTIMEOUT = 10
+  DEFAULTTIMEOUT = 2
+  MINLENGTH = 1.0          # Minimum duration in seconds of recording to submit
+  CHUNKMS = 30
+  ARBITERS = 4             # Utterances arbitrated at once
+
+  def __init__(self, backends, callback, mode=FIRST, deadline=DEADLINE,
+               minScore=None, timeout=DEFAULTTIMEOUT, rate=RATE, vad=None,
+               tag='mux'):
+    """Arbitrates between backends; a result is acceptable if it has items
+       and, when minScore is given, a score of at least minScore
+    """
+    self.backends = backends
+    self.callback = callback
+    self.mode = mode
+    self.deadline = deadline
+    self.minScore = minScore
+    self.timeout = timeout
+    self.rate = rate
+    self.tag = tag
+    self.isPlaying = False
+    self.generation = 0
+    # Late backends keep running after a deadline, so allow for a backlog.
+    # Arbitration waits on backend calls, so it has a pool of its own and
+    # can never hold every backend worker.
+    self.pool = ThreadPool(4 * len(backends))
+    self.arbiters = ThreadPool(self.ARBITERS)
+    if (vad is None):
+      vad = HangoverVAD(AdaptiveVAD())
+    self.rec = SpeechRecord(rate=rate, callback=self.__RecordingComplete,
+                            chunkMs=self.CHUNKMS, mode=SpeechRecord.CALLBACK,
+                            vad=vad)
+
+  def __Acceptable(self, result):
+    if (result is None or not result[0]):
+      return False
+    if (self.minScore is None):
+      return True
+    return (result[1] is not None and result[1] >= self.minScore)
+
+  def __Run(self, backend, utterance, results):
+    try:
+      res = backend.Recognize(utterance)
+    except Exception:
+      print "Backend", backend.tag, "failed:", sys.exc_info()[1]
+      res = None
+    results.put((backend, res))
+
+  def Recognize(self, utterance, mode=None, deadline=None):
+    """Runs all backends on an utterance and returns (tag, items, score)
+       for the winning result, or None
+    """
+    if (mode is None):
+      mode = self.mode
+    if (deadline is None):
+      deadline = self.deadline
+    results = Queue.Queue()
+    for b in self.backends:
+      self.pool.apply_async(self.__Run, (b, utterance, results))
+    end = time.time() + deadline
+    best = None
+    for i in range(len(self.backends)):
+      remaining = end - time.time()
+      if (remaining <= 0):
+        break
+      try:
+        backend, res = results.get(True, remaining)
+      except Queue.Empty:
+        break
+      if (not self.__Acceptable(res)):
+        continue
+      if (mode == self.FIRST):
+        return (backend.tag, res[0], res[1])
+      score = res[1] if (res[1] is not None) else float('-inf')
+      if (best is None or score > best[0]):
+        best = (score, backend.tag, res[0], res[1])
+    if (best is None):
+      return None
+    return best[1:]
+
+  def __Arbitrate(self, utterance, generation):
+    win = self.Recognize(utterance)
+    if (win and self.callback and self.isPlaying and
+        generation == self.generation):
+      self.callback('result', win[0], win[1])
+
+  def __StartNewRecording(self):
+    self.rec.StartRecord(maxSeconds=self.MAXRECTIME, timeout=self.timeout,
+                         initTimeout=self.INITIALTIMEOUT)
+
+  def __RecordingComplete(self):
+    info = self.rec.GetRecordingInfo()
+    seconds = float(info[0] * self.rec.chunk) / self.rate
+    if (seconds >= self.MINLENGTH and self.isPlaying):
+      # One copy of the audio is shared by every backend
+      pcm = AudioEncode.EncodeRaw(self.rec.GetRecordingViews())
+      utterance = Utterance(pcm, self.rate, self.rec.channels,
+                            self.rec.GetSampleWidth())
+      self.arbiters.apply_async(self.__Arbitrate, (utterance, self.generation))
+    if (self.isPlaying):
+      self.__StartNewRecording()
+
+  def IsPlaying(self):
+    return self.isPlaying
+
+  def Play(self):
+    if (self.isPlaying is False):
+      self.isPlaying = True
+      self.__StartNewRecording()
+
+  def Pause(self):
+    self.isPlaying = False
+
+  def Flush(self):
+    """Discards results for utterances already being recognized"""
+    self.generation += 1
+
+  def Exit(self):
+    self.Pause()
+    self.rec.Exit()
+    self.arbiters.close()
+    self.arbiters.join()
+    self.pool.close()
+    self.pool.join()
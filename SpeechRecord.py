@@ -16,19 +16,15 @@ PARTICULAR PURPOSE.
 import pyaudio
 import wave
 import sys
-import array
 import numpy as np
 import threading
+import Queue
 import subprocess
 import os
-
-def CalcRmsPower(data):
-  """Computes the RMS level of the last chunk of sound"""
-  if (len(data) > 0):
-    nums = array.array('h', ''.join(data))
-    sq = [i**2 for i in nums]
-    return np.sqrt(np.sum(sq)/len(data))
-  return 0
+from AudioEnergy import CalcRmsPower, RmsEnergy
+from AudioBuffer import AudioRingBuffer
+from VAD import EnergyVAD
+import AudioEncode
 
 class SpeechRecord:
 
@@ -36,152 +32,278 @@ class SpeechRecord:
   FORMAT = pyaudio.paInt16   # 16-bit is generally good enough for speech
   CHANNELS = 1               # 1=>Mono, 2=>Stereo
   RATE = 8000                # Sample rate
+  CHUNKMS = 250              # Duration of each audio chunk in milliseconds
+
+  # Capture modes
+  BLOCKING = 'blocking'      # A reader thread per recording (stream.read)
+  CALLBACK = 'callback'      # One long-lived worker fed by PortAudio
+
+  # Sample types used for energy measurement of each pyaudio format
+  SAMPLETYPES = { pyaudio.paInt8: np.int8, pyaudio.paUInt8: np.uint8,
+                  pyaudio.paInt16: np.int16, pyaudio.paInt32: np.int32,
+                  pyaudio.paFloat32: np.float32 }
 
   def __init__(self, format=FORMAT, channels=CHANNELS, rate=RATE,
-               callback=None):
+               callback=None, chunkMs=CHUNKMS, mode=BLOCKING, vad=None,
+               streamCallback=None, post=None):
                
-    """Establishes an audio stream and empties the frame buffer"""
+    """Establishes an audio stream and empties the frame buffer.
+
+       vad is the voice activity detector used for endpointing, which
+       defaults to the fixed ambient level threshold EnergyVAD.  If given,
+       streamCallback(data) is called with audio as soon as it becomes part
+       of a recording (the pre-roll at speech onset, then each chunk).
+       In callback mode, post(func, *args) may be given to run chunk
+       processing on an existing thread (such as a RecognizerLoop) rather
+       than on a capture thread of the recorder's own.
+    """
     self.p = pyaudio.PyAudio()
     self.format = format
     self.rate = rate
     self.channels = channels
-    self.chunk = self.rate/4
+    self.mode = mode
+    self.chunk = self.rate * chunkMs / 1000
+    self.chunkBytes = self.chunk * channels * self.p.get_sample_size(format)
+    if (vad is None):
+      vad = EnergyVAD()
+    self.vad = vad
+    self.framesPerChunk = self.__FramesPerChunk(rate * vad.frameMs / 1000)
+    self.frameSize = self.chunk / self.framesPerChunk
+    self.frameBytes = self.chunkBytes / self.framesPerChunk
+    self.buffer = AudioRingBuffer(0)
+    self.energy = RmsEnergy(dtype=self.SAMPLETYPES[format], channels=channels,
+                            window=self.frameSize)
     self.__Flush()
     self.recordThread = None
+    self.session = None
     self.callback = callback
+    self.streamCallback = streamCallback
     self.recordEvent = threading.Event()
 
     # Open input stream to audio device
-    self.stream = self.p.open(format=format,
-                              channels=channels,
-                              rate=rate,
-                              input=True,
-                              frames_per_buffer=self.chunk)
+    if (mode == self.CALLBACK):
+      self.lock = threading.RLock()
+      self.post = post
+      self.captureThread = None
+      if (post is None):
+        self.captureQueue = Queue.Queue()
+        self.captureThread = self.__CaptureThread__(self.captureQueue,
+                                                      self.__ProcessChunk)
+        self.captureThread.start()
+      self.stream = self.p.open(format=format,
+                                channels=channels,
+                                rate=rate,
+                                input=True,
+                                frames_per_buffer=self.chunk,
+                                stream_callback=self.__StreamCallback)
+    else:
+      self.stream = self.p.open(format=format,
+                                channels=channels,
+                                rate=rate,
+                                input=True,
+                                frames_per_buffer=self.chunk)
+
+  # Endpointing state machine for a single recording, fed one chunk at a time
+  class __RecordSession__:
+
+    STARTDELAY = 1     # Seconds of audio kept from before speech onset
+
+    WAITING = 0        # Waiting for the voice activity detector to trigger
+    RECORDING = 1      # Recording until quiescent
+
+    def __init__(self, parent, maxSeconds, timeout, initTimeout):
+      self.parent = parent
+      self.state = self.WAITING
+      self.recording = False
+      self.done = False
+      self.count = 0
+      self.quiescentFrames = 0
+      # All timings are counted in VAD frames rather than whole chunks
+      rate = parent.rate
+      frame = parent.frameSize
+      self.initFrames = int((rate * initTimeout) / frame)
+      self.recordFrames = int((rate * maxSeconds) / frame)
+      self.maxFrames = int((timeout * rate) / frame)
+      self.startFrames = int((rate * self.STARTDELAY) / frame)
+      parent.vad.Reset(rate, frame)
+
+    def Process(self, data):
+      """Consumes a chunk and returns True once the recording is complete"""
+      wasRecording = self.recording
+      done = self.__Consume(data)
+      if (self.recording and self.parent.streamCallback):
+        if (wasRecording):
+          self.parent.streamCallback(data)
+        else:
+          # Speech has just started, so send the pre-roll as well
+          for view in self.parent.buffer.GetViews():
+            self.parent.streamCallback(view)
+      return done
+
+    def __Consume(self, data):
+      parent = self.parent
+      parent.buffer.Append(data)
+      n = parent.energy.Update(data)
+      if (n == 0):
+        return False   # Too short to complete a frame
+      levels = parent.energy.GetEnergies(n)
+      samples = np.frombuffer(data, dtype=parent.energy.dtype).reshape(n, -1)
+
+      for i in range(n):
+        # Detection uses the first channel only
+        speech = parent.vad.Process(samples[i, ::parent.channels], levels[i])
+        remaining = n - 1 - i    # Later frames of this chunk already buffered
+
+        if (self.state == self.WAITING):
+          self.count += 1
+          if (speech):
+            # Truncate back to 'startdelay'
+            k = self.startFrames + 1 + remaining
+            parent.buffer.Truncate(k * parent.frameBytes)
+            parent.energy.Truncate(k)
+            self.recording = True
+            self.state = self.RECORDING
+            self.count = 0
+            #print "**** Output detected:", levels[i]
+          elif (self.count >= self.initFrames):
+            return True
+          continue
+
+        # Record until quiescent
+        self.count += 1
+        if (speech):
+          self.quiescentFrames = 0   # Ok, back again
+        else:
+          self.quiescentFrames += 1  # Things have gone quiet
+        if (self.quiescentFrames >= self.maxFrames):
+          # Remove last frames of silence
+          k = self.maxFrames + remaining
+          if (parent.energy.GetFrameCount() >= k):
+            parent.buffer.Trim(k * parent.frameBytes)
+            parent.energy.Trim(k)
+          return True
+        if (self.count >= self.recordFrames):
+          parent.buffer.Trim(remaining * parent.frameBytes)
+          parent.energy.Trim(remaining)
+          return True
+      return False
+
+    def Finish(self):
+      """Posts the completion event and calls the user callback"""
+      self.done = True
+      if (not self.recording):
+        # Flush record buffer
+        self.parent.buffer.Clear()
+        self.parent.energy.Reset()
+
+      # Post completion event
+      self.parent.recordEvent.set()
+
+      # Call user callback if defined
+      if (self.parent.callback):
+        self.parent.callback()
 
   # Meta class for background sound recording
   class __BackgroundRecordThread__(threading.Thread):
 
-    def __init__(self, event, stream, parent, callback, rate, chunk, maxSeconds,
-                 timeout, initTimeout):
+    def __init__(self, stream, chunk, session):
 
       threading.Thread.__init__(self)
-      self.event = event
       self.stream = stream
-      self.rate = rate
       self.chunk = chunk
-      self.parent = parent
-      self.callback = callback
-      self.completeEvent = event
-      self.recordThread = None
+      self.session = session
       self.stop = False
-      self.initTimeout=initTimeout
-      self.timeout=timeout
-      self.startdelay = 1
-      self.maxSeconds=maxSeconds
 
     def Exit(self):
        self.stop = True
        self.join()
 
-    def __RecordChunk(self):
-      """Records a new chunk from the audio stream"""
-      self.parent.frames.append(self.stream.read(self.chunk))
-
     def run(self):
       """Record an input wavefrom using an starting power detector and
          quiescence timeout
       """
-
-      # Ignore the first part which might contain noise caused by a
-      # key or mouse press
-      #for i in range(0, int((self.rate * self.ignoreFirst) / self.chunk)):
-      #  self.__RecordChunk()
-
-      # Quickly calculate the ambient noise level
-      self.__RecordChunk()
-      rms = CalcRmsPower(self.parent.frames[-1:])
-      #print "**** Ambient noise: ", rms
-      minRmsThreshold = rms * 5
-      self.parent.frames = []
-
-      # Power detector
-      recording = False
-      for i in range(0, int((self.rate * self.initTimeout) / self.chunk)):
-        if (self.stop):
-          break
-        self.__RecordChunk()
-        rms = CalcRmsPower(self.parent.frames[-1:])
-        if (rms > minRmsThreshold):
-          # Truncate back to 'startdelay'
-          k = int((self.rate * self.startdelay) / self.chunk)
-          #print "Truncation:", k
-          if (len(self.parent.frames) >= k):
-            #print "Truncated back", k, "frames"
-            self.parent.frames = self.parent.frames[-k:]
-          recording = True
-          #print "**** Output detected:", rms
+      while (not self.stop):
+        if (self.session.Process(self.stream.read(self.chunk))):
           break
+      #print "Finished recording"
+      self.session.Finish()
 
-      # Record until quiescent or stop request
-      maxChunks = (self.timeout*self.rate) / self.chunk
-      #print "maxChunks=", maxChunks
-      if (recording):
-        quiescentChunks = 0
-        for i in range(0, int((self.rate * self.maxSeconds) / self.chunk)):
-          self.__RecordChunk()
-          rms = CalcRmsPower(self.parent.frames[-1:])
-          if (rms <= minRmsThreshold):
-            quiescentChunks += 1  # Things have gone quiet
-            #print "Quiet for", quiescentChunks, "frames"
-          else:
-            quiescentChunks = 0                    # Ok, back again
-            #print "Ok, again:", quiescentChunks
-          if (quiescentChunks == maxChunks):
-            # Remove last frames of silence
-            if (len(self.parent.frames) >= maxChunks):
-              self.parent.frames = self.parent.frames[:-maxChunks]
-            break
-          if (self.stop):
-            #print "Stopped externally"
-            break
-        #print "Finished recording"
-      else:
-        # Flush record buffer
-        self.parent.frames = []
+  # Long-lived worker which drives recordings from the callback mode queue
+  class __CaptureThread__(threading.Thread):
 
-      # Post completion event
-      self.event.set()
+    def __init__(self, queue, process):
+      threading.Thread.__init__(self)
+      self.queue = queue
+      self.process = process
+      self.daemon = True
 
-      # Call user callback if defined
-      if (self.callback):
-        self.callback()
+    def run(self):
+      while (True):
+        data = self.queue.get()
+        if (data is None):
+          break
+        self.process(data)
+
+  def __ProcessChunk(self, data):
+    with self.lock:
+      session = self.session
+      # Audio is discarded while no recording is in progress
+      if (session and not session.done and session.Process(data)):
+        session.Finish()
+
+  def __FramesPerChunk(self, frameSize):
+    """Splits a chunk into whole VAD frames as close to frameSize as possible"""
+    divisors = [n for n in range(1, self.chunk + 1) if (self.chunk % n == 0)]
+    return min(divisors, key=lambda n: abs(self.chunk / n - frameSize))
+
+  def __StreamCallback(self, data, frameCount, timeInfo, status):
+    """Called by PortAudio with each captured chunk"""
+    if (self.post):
+      self.post(self.__ProcessChunk, data)
+    else:
+      self.captureQueue.put(data)
+    return (None, pyaudio.paContinue)
 
   def StartRecord(self, maxSeconds=60, timeout=2, initTimeout=3):
 
     # Clean up if already running
     self.StopRecord()
 
+    # Size the buffer for the pre-roll plus the longest recording allowed
+    chunks = 1 + int(maxSeconds * self.rate / self.chunk) + \
+             int(self.rate * self.__RecordSession__.STARTDELAY / self.chunk)
+    if (self.buffer.GetCapacity() < chunks * self.chunkBytes):
+      self.buffer.Resize(chunks * self.chunkBytes)
+
     # Flush buffer
     self.__Flush()
 
-    # Start background thread
-    self.recordThread = \
-      self.__BackgroundRecordThread__(self.recordEvent, self.stream,
-                                      self,
-                                      self.callback,
-                                      self.rate, self.chunk,
-                                      maxSeconds,
-                                      timeout, initTimeout)
-    self.recordThread.start()
+    session = self.__RecordSession__(self, maxSeconds, timeout, initTimeout)
+    if (self.mode == self.CALLBACK):
+      # The capture worker picks the new session up from its next chunk
+      with self.lock:
+        self.session = session
+    else:
+      # Start background thread
+      self.session = session
+      self.recordThread = \
+        self.__BackgroundRecordThread__(self.stream, self.chunk, session)
+      self.recordThread.start()
 
   def StopRecord(self):
     if (not self.IsRecordComplete()):
-      self.recordThread.Exit()
+      if (self.mode == self.CALLBACK):
+        with self.lock:
+          if (not self.session.done):
+            self.session.Finish()
+      else:
+        self.recordThread.Exit()
       self.recordThread = None
+      self.session = None
       self.recordEvent.clear()
 
   def WaitRecordComplete(self, timeout=10):
-    if (self.recordThread):
+    if (self.session):
       if (self.recordEvent.wait(timeout)):
         self.recordEvent.clear()
         return True
@@ -190,48 +312,67 @@ class SpeechRecord:
     return True
 
   def IsRecordComplete(self):
-    if (self.recordThread is None):
+    if (self.session is None):
       return True
     else:
       return self.WaitRecordComplete(0)
 
   def GetRecordingInfo(self):
-    sz = len(self.frames)
+    sz = len(self.buffer) / self.chunkBytes
     if (sz >= 2):
-      power = CalcRmsPower(self.frames[-2:])
+      power = self.energy.GetRms(2 * self.framesPerChunk)
     else:
       power = 0
     return (sz, power)
 
   def __Flush(self):
-    self.frames = []
+    self.buffer.Clear()
+    self.energy.Reset()
+
+  def GetRecordingViews(self):
+    """Returns the recorded audio as memoryviews, valid until the next record"""
+    return self.buffer.GetViews()
+
+  def GetSampleWidth(self):
+    return self.p.get_sample_size(self.format)
+
+  def Encode(self, fmt=AudioEncode.WAV):
+    """Returns everything recorded encoded in memory as 'wav', 'flac' or 'raw'"""
+    return AudioEncode.Encode(self.buffer.GetViews(), fmt, self.channels,
+                              self.GetSampleWidth(), self.rate)
 
   def WriteFileAndClose(self, outputFileName='output.wav'):
     """Write everything recorded out to a wave file"""
     ext = outputFileName.split('.')[-1]
-    if (ext != 'wav'):
-      filename = '.'.join(outputFileName.split('.')[:-1]) + '.wav'
-    else:
-      filename = outputFileName
-
+    if (ext in (AudioEncode.WAV, AudioEncode.FLAC)):
+      # Natively supported, so encode straight to the output file
+      with open(outputFileName, 'wb') as f:
+        f.write(self.Encode(ext))
+        f.close()
+      return
+
+    filename = '.'.join(outputFileName.split('.')[:-1]) + '.wav'
     wf = wave.open(filename, 'wb')
     wf.setnchannels(self.channels)
     wf.setsampwidth(self.p.get_sample_size(self.format))
     wf.setframerate(self.rate)
-    wf.writeframes(b''.join(self.frames))
+    for view in self.buffer.GetViews():
+      wf.writeframes(view)
     wf.close()
     
     # Convert to different audio format (supported by sox)
-    if (ext != 'wav'):
-      cmd = ['sox', filename, '-t', ext, outputFileName ]
-      with open(os.devnull, 'w') as devnull:
-        task = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
-        task.wait()
-      os.remove(filename)    # Remove the origin .wav file
+    cmd = ['sox', filename, '-t', ext, outputFileName ]
+    with open(os.devnull, 'w') as devnull:
+      task = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+      task.wait()
+    os.remove(filename)    # Remove the origin .wav file
 
   def Exit(self):
     self.StopRecord()
     self.stream.stop_stream()
     self.stream.close()
+    if (self.mode == self.CALLBACK and self.captureThread):
+      self.captureQueue.put(None)
+      self.captureThread.join()
     self.p.terminate()
 
@@ -0,0 +1,170 @@
+"""
+SpeechStream
+
+Streaming recognition backends which upload audio while the user is still
+speaking and report partial results as they arrive.
+
+A backend is a factory: Begin(callback) opens a stream for one utterance,
+audio is pushed with Feed(data) and the utterance is closed with End() (or
+abandoned with Cancel()).  Results are reported by calling
+callback(event, items) with event 'partial' or 'result', matching the
+events produced by ASR.
+
+Dependencies: requests, AudioEncode
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from AudioEncode import FlacEncoder, CONTENTTYPES, FLAC
+import threading
+import Queue
+import uuid
+import json
+import sys
+import requests
+
+class StreamingBackend:
+
+  def Begin(self, callback):
+    """Opens a stream for a new utterance and returns it"""
+    raise NotImplementedError
+
+class HTTPStreamingBackend(StreamingBackend):
+
+  TIMEOUT = 10         # Seconds allowed for connect and for each read
+
+  def __init__(self, upUrl, rate, channels=1, sampwidth=2, downUrl=None,
+               timeout=TIMEOUT):
+    """Streams FLAC using chunked transfer encoding.
+
+       With a downUrl the results are read from a separate long-polling GET
+       paired with the upload by a random 'pair' query parameter, which lets
+       partial results arrive before the upload has finished (full-duplex
+       style).  Without one, results are read from the upload response.
+       Responses are newline separated JSON objects.
+    """
+    self.upUrl = upUrl
+    self.downUrl = downUrl
+    self.rate = rate
+    self.channels = channels
+    self.sampwidth = sampwidth
+    self.timeout = timeout
+    self.session = requests.Session()
+
+  def Begin(self, callback):
+    return HTTPStream(self, callback)
+
+  def Exit(self):
+    self.session.close()
+
+class HTTPStream:
+
+  def __init__(self, backend, callback):
+    self.backend = backend
+    self.callback = callback
+    self.cancelled = False
+    self.audio = Queue.Queue()
+    self.encoder = FlacEncoder(backend.channels, backend.sampwidth,
+                               backend.rate)
+    self.pair = uuid.uuid4().hex
+    self.threads = [threading.Thread(target=self.__Upload)]
+    if (backend.downUrl):
+      self.threads.append(threading.Thread(target=self.__Download))
+    for t in self.threads:
+      t.daemon = True
+      t.start()
+
+  def Feed(self, data):
+    """Queues audio for upload (the caller's buffer may be reused)"""
+    self.audio.put(memoryview(data).tobytes())
+
+  def End(self):
+    """Marks the end of the utterance; results are still delivered"""
+    self.audio.put(None)
+
+  def Cancel(self):
+    """Abandons the utterance and suppresses any further results"""
+    self.cancelled = True
+    self.audio.put(None)
+
+  def __Url(self, url):
+    sep = '&' if ('?' in url) else '?'
+    return url + sep + 'pair=' + self.pair
+
+  def __Body(self):
+    """Generator producing the chunked upload body as audio arrives"""
+    yield self.encoder.GetHeader()
+    while (True):
+      data = self.audio.get()
+      if (data is None or self.cancelled):
+        break
+      frames = self.encoder.Encode(data)
+      if (frames):
+        yield frames
+    if (not self.cancelled):
+      yield self.encoder.Finish()
+
+  def __Upload(self):
+    backend = self.backend
+    headers = { 'Content-Type': CONTENTTYPES[FLAC] + '; rate=' +
+                str(backend.rate) + ';' }
+    try:
+      r = backend.session.post(self.__Url(backend.upUrl), data=self.__Body(),
+                               headers=headers, timeout=backend.timeout,
+                               stream=True)
+      if (not backend.downUrl):
+        self.__ReadResults(r)
+      r.close()
+    except requests.RequestException:
+      print "Streaming upload failed:", sys.exc_info()[1]
+
+  def __Download(self):
+    backend = self.backend
+    try:
+      r = backend.session.get(self.__Url(backend.downUrl),
+                              timeout=backend.timeout, stream=True)
+      self.__ReadResults(r)
+      r.close()
+    except requests.RequestException:
+      print "Streaming download failed:", sys.exc_info()[1]
+
+  def __ReadResults(self, r):
+    for line in r.iter_lines():
+      if (self.cancelled):
+        break
+      if (not line):
+        continue
+      try:
+        results = ParseResults(json.loads(line))
+      except (ValueError, TypeError, AttributeError, KeyError):
+        # Not JSON, or JSON of an unexpected shape
+        print "Was not able to process API response:", line
+        continue
+      for event, items in results:
+        if (not self.cancelled):
+          self.callback(event, items)
+
+def ParseResults(resp):
+  """Returns a list of (event, items) from one JSON response object.
+
+     Understands both the one-shot 'hypotheses' format and the streaming
+     'result' format, where each result has a list of alternatives and is
+     marked 'final' once it will no longer change.
+  """
+  out = []
+  if ('hypotheses' in resp.keys()):
+    if (resp.get('status', 0) == 0 and len(resp['hypotheses']) > 0):
+      out.append(('result', [h['utterance'].upper()
+                             for h in resp['hypotheses']]))
+  for res in resp.get('result', []):
+    items = [a['transcript'].upper() for a in res.get('alternative', [])]
+    if (len(items) > 0):
+      out.append(('result' if res.get('final') else 'partial', items))
+  return out
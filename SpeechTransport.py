@@ -0,0 +1,210 @@
+"""
+SpeechTransport
+
+A pooled HTTP transport for cloud speech recognition requests.
+
+Requests are posted by a bounded pool of worker threads sharing one
+persistent connection pool, with per-request timeouts and retry with
+exponential backoff.  Responses are handed to each callback strictly in
+the order its requests were submitted, so recognizers sharing a
+transport are not held back by each other's slow requests.
+
+Dependencies: requests
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import traceback
+import threading
+import Queue
+import time
+import requests
+
+class HTTPTransport:
+
+  WORKERS = 4            # Maximum number of requests in flight
+  TIMEOUT = 10           # Seconds allowed for connect and for each read
+  RETRIES = 2            # Further attempts after a failed request
+  BACKOFF = 0.5          # Seconds before the first retry, doubled each time
+
+  # Response codes worth retrying since the next attempt may succeed
+  RETRYCODES = (429, 500, 502, 503, 504)
+
+  def __init__(self, url, callback, workers=WORKERS, timeout=TIMEOUT,
+               retries=RETRIES, backoff=BACKOFF):
+    """callback(context, response) is called in submission order, where
+       response is a requests.Response or None if every attempt failed.
+       Requests may instead give their own callback, so one transport can
+       be shared by several recognizers; order is kept per callback.
+    """
+    self.url = url
+    self.callback = callback
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.lock = threading.RLock()
+    self.ready = threading.Condition(self.lock)
+    self.jobs = Queue.Queue()
+    self.sequence = 0      # Requests submitted
+    self.delivered = 0     # Requests delivered
+    self.finished = 0      # Requests whose result has come back
+    # callback -> [next submission, next delivery, results, delivering]
+    self.orders = {}
+    self.listeners = []    # Called whenever a request finishes
+    self.workers = [threading.Thread(target=self.__Worker)
+                    for i in range(workers)]
+    for w in self.workers:
+      w.daemon = True
+      w.start()
+
+  def Submit(self, data, headers=None, context=None, callback=None):
+    """Queues a POST of data and returns its sequence number among the
+       requests for the same callback.
+
+       data may also be an object with a get() method returning the body
+       (such as a pending encode), which is resolved by the worker.  The
+       response goes to callback if given, otherwise to the transport's.
+       Responses are ordered per callback, so a caller wanting its own
+       order should give the same callback every time.
+    """
+    with self.lock:
+      order = self.orders.setdefault(callback, [0, 0, {}, False])
+      seq = order[0]
+      order[0] += 1
+      self.sequence += 1
+    self.jobs.put((seq, data, headers, (callback, context)))
+    return seq
+
+  def GetPending(self):
+    """Returns the number of submitted requests not yet delivered"""
+    with self.lock:
+      return self.sequence - self.delivered
+
+  def AddSlotListener(self, listener):
+    """listener() is called each time a request finishes and frees a slot"""
+    with self.lock:
+      self.listeners.append(listener)
+
+  def RemoveSlotListener(self, listener):
+    with self.lock:
+      if (listener in self.listeners):
+        self.listeners.remove(listener)
+
+  def HasSlot(self):
+    """Returns True if a request submitted now would start straight away"""
+    with self.lock:
+      return (self.sequence - self.finished < len(self.workers))
+
+  def WaitForSlot(self):
+    """Blocks until fewer requests are in flight than there are workers, so
+       callers can hold work back in their own bounded queue.  Results
+       waiting on an earlier callback do not count, so a callback may call
+       this without deadlocking.
+    """
+    with self.lock:
+      while (self.sequence - self.finished >= len(self.workers)):
+        self.ready.wait()
+
+  def Flush(self):
+    """Discards every request that has not yet been started"""
+    while (True):
+      try:
+        job = self.jobs.get_nowait()
+      except Queue.Empty:
+        break
+      if (job is None):
+        # Keep exit requests for the workers
+        self.jobs.put(job)
+        break
+      self.__Deliver(job[0], job[3], None, False)
+
+  def __Post(self, data, headers):
+    """Posts with retries, returning the response or None"""
+    for attempt in range(self.retries + 1):
+      if (attempt > 0):
+        time.sleep(self.backoff * (2 ** (attempt - 1)))
+      try:
+        r = self.session.post(self.url, data=data, headers=headers,
+                              timeout=self.timeout)
+      except requests.RequestException:
+        continue
+      if (r.status_code not in self.RETRYCODES):
+        return r
+    return None
+
+  def __Worker(self):
+    while (True):
+      job = self.jobs.get()
+      if (job is None):
+        break
+      seq, data, headers, context = job
+      try:
+        if (hasattr(data, 'get')):
+          data = data.get()
+        response = self.__Post(data, headers)
+      except Exception:
+        # A failed encode must not hold back every later delivery
+        traceback.print_exc()
+        response = None
+      self.__Deliver(seq, context, response, True)
+      with self.lock:
+        listeners = list(self.listeners)
+      for listener in listeners:
+        listener()
+
+  def __Deliver(self, seq, context, response, valid):
+    """Holds results back until all earlier ones for the same callback
+       have been delivered.
+
+       Callbacks run without the lock held, so they may call back into the
+       transport, and one thread at a time delivers for each callback to
+       keep its results in order.
+    """
+    key = context[0]
+    with self.lock:
+      order = self.orders[key]
+      order[2][seq] = (context, response, valid)
+      self.finished += 1
+      self.ready.notify_all()
+      if (order[3]):
+        return
+      order[3] = True
+    while (True):
+      with self.lock:
+        ready = []
+        while (order[1] in order[2]):
+          ready.append(order[2].pop(order[1]))
+          order[1] += 1
+        self.delivered += len(ready)
+        if (len(ready) == 0):
+          order[3] = False
+          if (order[0] == order[1] and self.orders.get(key) is order):
+            # Nothing outstanding, so a later request starts afresh
+            del self.orders[key]
+          return
+      for (callback, context), response, valid in ready:
+        callback = callback if (callback) else self.callback
+        if (valid and callback):
+          try:
+            callback(context, response)
+          except Exception:
+            traceback.print_exc()
+
+  def Exit(self):
+    for w in self.workers:
+      self.jobs.put(None)
+    for w in self.workers:
+      w.join()
+    self.session.close()
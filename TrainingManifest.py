@@ -0,0 +1,255 @@
+"""
+TrainingManifest
+
+A transactional manifest of the utterances in a training directory.
+
+Each entry records an utterance id, its transcript, the path, duration
+and content hash of its wave file and a status, in an SQLite database
+kept beside the training data.  Listing, counting, exporting control and
+transcription files and deleting entries are then indexed queries rather
+than a directory listing and one file open per utterance.  A manifest
+created for an existing directory is filled in from its .txt and .wav
+files the first time it is opened.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+from FeatureCache import HashFile
+import threading
+import hashlib
+import io
+import sqlite3
+import wave
+import os
+
+NEWLINE = "\n"
+
+def WaveDuration(path):
+  """Returns the length of a wave file (a path or file object) in seconds,
+     or None if it is unreadable
+  """
+  try:
+    w = wave.open(path, 'rb')
+    try:
+      return w.getnframes() / float(w.getframerate())
+    finally:
+      w.close()
+  except (wave.Error, EOFError, IOError):
+    return None
+
+class TrainingManifest:
+
+  TEXT = ".txt"
+  WAV = ".wav"
+  PENDING = "pending"      # Transcript only, no audio yet
+  READY = "ready"          # Transcript and audio, used for training
+  SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      id TEXT UNIQUE NOT NULL,
+      transcript TEXT NOT NULL,
+      wav TEXT,
+      duration REAL,
+      hash TEXT,
+      status TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS entries_status ON entries (status, seq);
+  """
+
+  def __init__(self, path, training):
+    """path is the database file and training the directory it describes"""
+    if (training[-1] != '/'): training += '/'
+    self.path = path
+    self.training = training
+    self.lock = threading.Lock()
+    create = not os.path.exists(path)
+    # Shared by worker threads, which are serialized by the lock
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.text_factory = str
+    self.db.executescript(self.SCHEMA)
+    if (create):
+      self.Import()
+
+  def Import(self, texts=True):
+    """Brings the manifest up to date with the training directory: entries
+       are added for new .txt files, pending entries whose .wav has since
+       appeared become ready, ready entries whose wave file has gone are
+       pending again and entries whose files have all gone are removed.
+       texts is False when transcripts are only kept in the manifest, as
+       in a packed session.  Returns (added, updated, removed).
+    """
+    names = set(os.listdir(self.training))
+    added = 0
+    updated = 0
+    removed = []
+    with self.lock:
+      rows = self.db.execute("SELECT id, wav, status FROM entries").fetchall()
+    known = set()
+    for id, wav, status in rows:
+      known.add(id)
+      text = (not texts or id + self.TEXT in names)
+      if (status == self.READY and wav and os.path.exists(wav)):
+        continue
+      if (id + self.WAV in names):
+        self.SetWave(id, self.training + id + self.WAV, commit=False)
+        updated += 1
+      elif (not text):
+        removed.append(id)
+      elif (status == self.READY):
+        with self.lock:
+          self.db.execute("UPDATE entries SET wav=NULL, duration=NULL, "
+                          "hash=NULL, status=? WHERE id=?", (self.PENDING, id))
+        updated += 1
+    for f in sorted(names):
+      if (not f.endswith(self.TEXT)):
+        continue
+      id = f[:-len(self.TEXT)]
+      if (id in known):
+        continue
+      with open(self.training + f, 'r') as r:
+        sent = r.read()
+        r.close()
+      self.Add(id, sent, commit=False)
+      if (id + self.WAV in names):
+        self.SetWave(id, self.training + id + self.WAV, commit=False)
+      added += 1
+    self.Commit()
+    if (removed):
+      self.Delete(removed)
+    return (added, updated, len(removed))
+
+  def Commit(self):
+    with self.lock:
+      self.db.commit()
+
+  def Add(self, id, transcript, commit=True):
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO entries (id, transcript, status) "
+                      "VALUES (?, ?, ?)", (id, transcript, self.PENDING))
+      if (commit):
+        self.db.commit()
+
+  def SetWave(self, id, path, data=None, commit=True):
+    """Records the wave file of an entry, which makes it ready for training.
+       If the wave data is given, path is only where it is kept.
+    """
+    if (data is None):
+      duration = WaveDuration(path)
+      digest = HashFile(path)
+    else:
+      duration = WaveDuration(io.BytesIO(data))
+      digest = hashlib.sha1(data).hexdigest()
+    with self.lock:
+      self.db.execute("UPDATE entries SET wav=?, duration=?, hash=?, status=? "
+                      "WHERE id=?", (path, duration, digest, self.READY, id))
+      if (commit):
+        self.db.commit()
+
+  def Delete(self, ids):
+    """Removes entries, returning the ids which were in the manifest"""
+    ids = list(ids)
+    found = []
+    with self.lock:
+      for i in range(0, len(ids), 500):
+        batch = ids[i:i + 500]
+        marks = ','.join('?' * len(batch))
+        found += [r[0] for r in self.db.execute(
+                  "SELECT id FROM entries WHERE id IN (%s)" % marks, batch)]
+        self.db.execute("DELETE FROM entries WHERE id IN (%s)" % marks, batch)
+      self.db.commit()
+    return found
+
+  def Clear(self):
+    """Removes every entry, returning the ids removed"""
+    with self.lock:
+      ids = [r[0] for r in self.db.execute("SELECT id FROM entries")]
+      self.db.execute("DELETE FROM entries")
+      self.db.commit()
+    return ids
+
+  def Has(self, id):
+    with self.lock:
+      return self.db.execute("SELECT 1 FROM entries WHERE id=?",
+                             (id,)).fetchone() is not None
+
+  def Get(self, id):
+    """Returns (transcript, wav, duration, hash, status) or None"""
+    with self.lock:
+      return self.db.execute("SELECT transcript, wav, duration, hash, status "
+                             "FROM entries WHERE id=?", (id,)).fetchone()
+
+  def GetHashes(self, ids):
+    """Returns id -> hash of the wave file for each id"""
+    hashes = {}
+    with self.lock:
+      for id in ids:
+        row = self.db.execute("SELECT hash FROM entries WHERE id=?",
+                              (id,)).fetchone()
+        if (row):
+          hashes[id] = row[0]
+    return hashes
+
+  def GetTranscript(self, id):
+    entry = self.Get(id)
+    return entry[0] if (entry) else None
+
+  def GetIds(self, status=None):
+    with self.lock:
+      if (status is None):
+        rows = self.db.execute("SELECT id FROM entries ORDER BY seq")
+      else:
+        rows = self.db.execute("SELECT id FROM entries WHERE status=? "
+                               "ORDER BY seq", (status,))
+      return [r[0] for r in rows]
+
+  def GetCount(self, status=None):
+    with self.lock:
+      if (status is None):
+        row = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()
+      else:
+        row = self.db.execute("SELECT COUNT(*) FROM entries WHERE status=?",
+                              (status,)).fetchone()
+      return row[0]
+
+  def GetDuration(self):
+    """Returns the total seconds of audio ready for training"""
+    with self.lock:
+      row = self.db.execute("SELECT SUM(duration) FROM entries WHERE status=?",
+                            (self.READY,)).fetchone()
+      return row[0] if (row[0]) else 0.0
+
+  def WriteFileids(self, path):
+    """Writes the control file of entries ready for training"""
+    k = 0
+    with self.lock:
+      with open(path, 'w') as f:
+        for (id,) in self.db.execute("SELECT id FROM entries WHERE status=? "
+                                     "ORDER BY seq", (self.READY,)):
+          f.write(id + NEWLINE)
+          k += 1
+        f.close()
+    return k
+
+  def WriteTranscriptions(self, path):
+    """Writes the transcription file matching WriteFileids"""
+    k = 0
+    with self.lock:
+      with open(path, 'w') as f:
+        for id, sent in self.db.execute("SELECT id, transcript FROM entries "
+                                        "WHERE status=? ORDER BY seq",
+                                        (self.READY,)):
+          f.write("<s> " + sent + " </s> (" + id + ")" + NEWLINE)
+          k += 1
+        f.close()
+    return k
+
+  def Close(self):
+    with self.lock:
+      self.db.close()
@@ -0,0 +1,219 @@
+"""
+UtteranceArchive
+
+A packed archive of training utterances.
+
+The wave files of many utterances are stored back to back in one data
+file which is memory mapped for reading, and an index file beside it
+maps each utterance id to the offset and length of its audio together
+with its transcript.  Both files are only appended to: removing an
+utterance appends a tombstone to the index, and Compact rewrites the
+archive without the space removed utterances still take up.  Audio can
+be read as a buffer onto the mapping without copying, or written out as
+ordinary wave files for tools which expect them.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import mmap
+import os
+
+NEWLINE = "\n"
+TAB = "\t"
+TEXT = ".txt"
+WAV = ".wav"
+
+class UtteranceArchiveExceptionUnknownId:
+  pass
+
+def PackDirectory(src, path, remove=False):
+  """Adds every <id>.wav in src with its <id>.txt transcript to the
+     archive at path, optionally removing the files once packed.  Returns
+     the number of utterances added.
+  """
+  if (src[-1] != '/'): src += '/'
+  archive = UtteranceArchive(path)
+  names = set(os.listdir(src))
+  added = []
+  for f in sorted(names):
+    if (not f.endswith(WAV)):
+      continue
+    id = f[:-len(WAV)]
+    if (id + TEXT not in names or archive.Has(id)):
+      continue
+    with open(src + id + TEXT, 'r') as r:
+      sent = r.read()
+      r.close()
+    archive.AddFile(id, src + f, sent)
+    added.append(id)
+  archive.Close()
+  if (remove):
+    for id in added:
+      os.remove(src + id + WAV)
+      os.remove(src + id + TEXT)
+  return len(added)
+
+def UnpackArchive(path, dst):
+  """Writes <id>.wav and <id>.txt in dst for every utterance in the
+     archive at path, returning the number written
+  """
+  if (dst[-1] != '/'): dst += '/'
+  archive = UtteranceArchive(path)
+  ids = archive.GetIds()
+  for id in ids:
+    archive.WriteWave(id, dst + id + WAV)
+    with open(dst + id + TEXT, 'w') as f:
+      f.write(archive.GetTranscript(id))
+      f.close()
+  archive.Close()
+  return len(ids)
+
+class UtteranceArchive:
+
+  INDEX = ".index"
+  REMOVED = "-"          # Length given to a removed utterance in the index
+
+  def __init__(self, path):
+    """path is the data file, the index is kept beside it"""
+    self.path = path
+    self.indexPath = path + self.INDEX
+    self.mm = None
+    self.size = 0
+    self.__Load()
+
+  def __Load(self):
+    self.entries = {}      # id -> (offset, length, transcript)
+    self.order = []        # ids in the order they were added
+    for f in (self.path, self.indexPath):
+      if (not os.path.exists(f)):
+        with open(f, 'ab') as w:
+          w.close()
+    with open(self.indexPath, 'rb') as f:
+      for line in f:
+        if (not line.endswith(NEWLINE)):
+          break          # Partly written, the audio is not referenced
+        id, offset, length, sent = line[:-1].split(TAB, 3)
+        if (length == self.REMOVED):
+          self.entries.pop(id, None)
+        else:
+          if (id not in self.entries):
+            self.order.append(id)
+          self.entries[id] = (int(offset), int(length), sent)
+    if (len(self.order) != len(self.entries)):
+      self.order = [id for id in self.order if id in self.entries]
+    self.__Map()
+
+  def __Map(self):
+    size = os.path.getsize(self.path)
+    if (size != self.size):
+      # Buffers already handed out keep the old mapping alive
+      self.mm = None
+      if (size > 0):
+        with open(self.path, 'rb') as f:
+          self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+          f.close()
+      self.size = size
+
+  def Add(self, id, data, transcript):
+    """Appends the wave file data of an utterance, replacing any
+       utterance with the same id
+    """
+    sent = ' '.join(transcript.split())
+    with open(self.path, 'ab') as f:
+      f.seek(0, os.SEEK_END)
+      offset = f.tell()
+      f.write(data)
+      f.close()
+    # The index only refers to audio once it has been written
+    with open(self.indexPath, 'ab') as f:
+      f.write(TAB.join((id, str(offset), str(len(data)), sent)) + NEWLINE)
+      f.close()
+    if (id not in self.entries):
+      self.order.append(id)
+    self.entries[id] = (offset, len(data), sent)
+    self.__Map()
+
+  def AddFile(self, id, path, transcript):
+    with open(path, 'rb') as f:
+      data = f.read()
+      f.close()
+    self.Add(id, data, transcript)
+
+  def Remove(self, ids):
+    """Removes utterances, returning the ids which were in the archive"""
+    removed = [id for id in ids if id in self.entries]
+    if (len(removed) == 0):
+      return removed
+    with open(self.indexPath, 'ab') as f:
+      for id in removed:
+        f.write(TAB.join((id, '0', self.REMOVED, '')) + NEWLINE)
+        del self.entries[id]
+      f.close()
+    self.order = [id for id in self.order if id in self.entries]
+    return removed
+
+  def Has(self, id):
+    return (id in self.entries)
+
+  def GetIds(self):
+    return list(self.order)
+
+  def GetCount(self):
+    return len(self.order)
+
+  def GetTranscript(self, id):
+    return self.__Entry(id)[2]
+
+  def __Entry(self, id):
+    entry = self.entries.get(id)
+    if (entry is None):
+      raise UtteranceArchiveExceptionUnknownId
+    return entry
+
+  def GetBuffer(self, id):
+    """Returns the wave file of an utterance as a buffer onto the mapping,
+       without copying
+    """
+    offset, length, sent = self.__Entry(id)
+    return buffer(self.mm, offset, length)
+
+  def GetData(self, id):
+    offset, length, sent = self.__Entry(id)
+    return self.mm[offset:offset + length]
+
+  def WriteWave(self, id, path):
+    with open(path, 'wb') as f:
+      f.write(self.GetBuffer(id))
+      f.close()
+
+  def WriteWaves(self, ids, dir):
+    """Writes <id>.wav in dir for each id, reading the data file in order"""
+    if (dir[-1] != '/'): dir += '/'
+    for id in sorted(ids, key=lambda id: self.__Entry(id)[0]):
+      self.WriteWave(id, dir + id + WAV)
+
+  def GetWastedBytes(self):
+    """Returns the bytes held by removed or replaced utterances"""
+    return self.size - sum(e[1] for e in self.entries.itervalues())
+
+  def Compact(self):
+    """Rewrites the archive keeping only current utterances"""
+    tmp = UtteranceArchive(self.path + '.tmp')
+    for id in self.order:
+      tmp.Add(id, self.GetBuffer(id), self.GetTranscript(id))
+    tmp.Close()
+    self.Close()
+    os.rename(tmp.indexPath, self.indexPath)
+    os.rename(tmp.path, self.path)
+    self.__Load()
+
+  def Close(self):
+    self.mm = None
+    self.size = 0
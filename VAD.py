@@ -0,0 +1,241 @@
+"""
+VAD
+
+Voice activity detectors operating on short frames of audio samples.
+
+Each detector is given one frame at a time together with its RMS level
+(already computed by the caller's energy tracker) and decides whether the
+frame contains speech.
+
+Dependencies: numpy
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import numpy as np
+
+def MsToFrames(ms, rate, frameSize):
+  """Converts a duration in milliseconds to a whole number of frames"""
+  return max(1, int(round((rate * ms / 1000.0) / frameSize)))
+
+class VAD:
+
+  FRAMEMS = 10         # Preferred frame duration in milliseconds
+
+  def __init__(self, frameMs=FRAMEMS):
+    self.frameMs = frameMs
+    self.rate = None
+    self.frameSize = None
+
+  def Reset(self, rate, frameSize):
+    """Prepares for a new recording of frames of frameSize samples"""
+    self.rate = rate
+    self.frameSize = frameSize
+
+  def Process(self, samples, rms):
+    """Returns True if the frame is considered to contain speech"""
+    raise NotImplementedError
+
+class NoiseFloor:
+
+  EXPONENTIAL = 'exponential'
+  PERCENTILE = 'percentile'
+
+  def __init__(self, method=EXPONENTIAL, alpha=0.05, percentile=10,
+               historyMs=3000):
+    """Tracks the background noise level from frame RMS levels.
+
+       The exponential tracker follows quiet frames with a smoothing factor
+       alpha and drops immediately to any quieter frame.  The percentile
+       tracker takes a low percentile of the last historyMs of frames, which
+       is robust against speech without needing to be told which frames
+       were quiet.
+    """
+    self.method = method
+    self.alpha = alpha
+    self.percentile = percentile
+    self.historyMs = historyMs
+    self.history = np.zeros(0)
+    self.frames = 0
+    self.level = None
+
+  def Reset(self, rate, frameSize):
+    if (self.method == self.PERCENTILE):
+      n = MsToFrames(self.historyMs, rate, frameSize)
+      if (len(self.history) != n):
+        self.history = np.zeros(n)
+    self.frames = 0
+    self.level = None
+
+  def GetLevel(self):
+    return self.level
+
+  def Update(self, rms, speech=False):
+    """Adds a frame level and returns the new noise floor"""
+    if (self.method == self.PERCENTILE):
+      self.history[self.frames % len(self.history)] = rms
+      self.frames += 1
+      self.level = np.percentile(self.history[:self.frames], self.percentile)
+    elif (self.level is None or rms < self.level):
+      self.level = rms
+    elif (not speech):
+      self.level += self.alpha * (rms - self.level)
+    return self.level
+
+class EnergyVAD(VAD):
+
+  def __init__(self, factor=5, calibrateMs=250, frameMs=VAD.FRAMEMS):
+    """Fixed threshold at a multiple of the ambient level measured at the
+       start of each recording (this is the original SpeechRecord detector)
+    """
+    VAD.__init__(self, frameMs)
+    self.factor = factor
+    self.calibrateMs = calibrateMs
+
+  def Reset(self, rate, frameSize):
+    VAD.Reset(self, rate, frameSize)
+    self.calibrateFrames = MsToFrames(self.calibrateMs, rate, frameSize)
+    self.frames = 0
+    self.sumsq = 0.0
+    self.threshold = None
+
+  def Process(self, samples, rms):
+    if (self.threshold is None):
+      self.sumsq += rms * rms
+      self.frames += 1
+      if (self.frames == self.calibrateFrames):
+        self.threshold = np.sqrt(self.sumsq / self.frames) * self.factor
+      return False
+    return (rms > self.threshold)
+
+class AdaptiveVAD(VAD):
+
+  def __init__(self, factor=3.0, floor=None, minLevel=50,
+               frameMs=VAD.FRAMEMS):
+    """Threshold at a multiple of a continuously tracked noise floor.
+
+       minLevel stops the threshold collapsing to nothing in digital
+       silence.
+    """
+    VAD.__init__(self, frameMs)
+    self.factor = factor
+    self.minLevel = minLevel
+    if (floor is None):
+      floor = NoiseFloor()
+    self.floor = floor
+
+  def Reset(self, rate, frameSize):
+    VAD.Reset(self, rate, frameSize)
+    self.floor.Reset(rate, frameSize)
+
+  def GetThreshold(self):
+    level = self.floor.GetLevel()
+    if (level is None):
+      return None
+    return max(level, self.minLevel) * self.factor
+
+  def Process(self, samples, rms):
+    threshold = self.GetThreshold()
+    speech = (threshold is not None and rms > threshold)
+    self.floor.Update(rms, speech)
+    return speech
+
+class HangoverVAD(VAD):
+
+  def __init__(self, vad, onsetMs=30, hangoverMs=200):
+    """Adds hysteresis to another detector: speech must persist for onsetMs
+       before it is reported, and is still reported for hangoverMs after the
+       detector last saw it
+    """
+    VAD.__init__(self, vad.frameMs)
+    self.vad = vad
+    self.onsetMs = onsetMs
+    self.hangoverMs = hangoverMs
+
+  def Reset(self, rate, frameSize):
+    VAD.Reset(self, rate, frameSize)
+    self.vad.Reset(rate, frameSize)
+    self.onsetFrames = MsToFrames(self.onsetMs, rate, frameSize)
+    self.hangoverFrames = MsToFrames(self.hangoverMs, rate, frameSize)
+    self.active = False
+    self.run = 0        # Consecutive speech frames seen while inactive
+    self.hang = 0       # Frames of hangover remaining while active
+
+  def Process(self, samples, rms):
+    speech = self.vad.Process(samples, rms)
+    if (self.active):
+      if (speech):
+        self.hang = self.hangoverFrames
+      else:
+        self.hang -= 1
+        if (self.hang <= 0):
+          self.active = False
+          self.run = 0
+    elif (speech):
+      self.run += 1
+      if (self.run >= self.onsetFrames):
+        self.active = True
+        self.hang = self.hangoverFrames
+    else:
+      self.run = 0
+    return self.active
+
+class ZeroCrossingVAD(AdaptiveVAD):
+
+  def __init__(self, factor=3.0, lowFactor=1.5, zcrRange=(0.1, 0.5),
+               floor=None, minLevel=50, frameMs=VAD.FRAMEMS):
+    """Energy detector that also accepts quieter frames whose zero-crossing
+       rate (crossings per sample) lies in zcrRange, which catches unvoiced
+       fricatives at the edges of words
+    """
+    AdaptiveVAD.__init__(self, factor, floor, minLevel, frameMs)
+    self.lowFactor = lowFactor
+    self.zcrRange = zcrRange
+
+  def Process(self, samples, rms):
+    threshold = self.GetThreshold()
+    speech = False
+    if (threshold is not None):
+      if (rms > threshold):
+        speech = True
+      elif (rms > threshold * self.lowFactor / self.factor):
+        signs = np.signbit(samples)
+        zcr = np.count_nonzero(signs[1:] != signs[:-1]) / float(len(samples))
+        speech = (self.zcrRange[0] <= zcr <= self.zcrRange[1])
+    self.floor.Update(rms, speech)
+    return speech
+
+class SpectralFlatnessVAD(AdaptiveVAD):
+
+  def __init__(self, flatness=0.3, factor=2.0, floor=None, minLevel=50,
+               frameMs=20):
+    """Accepts frames above the noise floor whose spectral flatness is below
+       the given value.  Noise has a flat spectrum (flatness near 1) while
+       voiced speech is dominated by harmonics.
+    """
+    AdaptiveVAD.__init__(self, factor, floor, minLevel, frameMs)
+    self.flatness = flatness
+
+  def Reset(self, rate, frameSize):
+    AdaptiveVAD.Reset(self, rate, frameSize)
+    self.window = np.hanning(frameSize)
+
+  def GetFlatness(self, samples):
+    if (len(samples) != len(self.window)):
+      self.window = np.hanning(len(samples))
+    power = np.abs(np.fft.rfft(samples * self.window)) ** 2 + 1e-10
+    return np.exp(np.mean(np.log(power))) / np.mean(power)
+
+  def Process(self, samples, rms):
+    threshold = self.GetThreshold()
+    speech = (threshold is not None and rms > threshold and
+              self.GetFlatness(samples) < self.flatness)
+    self.floor.Update(rms, speech)
+    return speech
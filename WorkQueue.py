@@ -0,0 +1,135 @@
+"""
+WorkQueue
+
+A thread-safe bounded work queue with back-pressure policies, depth and
+age metrics and generation based flushing.
+
+Every Flush starts a new generation.  Consumers note the generation when
+they take an item and check it with IsCurrent before acting on results,
+so work that was already in flight when the flush happened is cancelled.
+
+Copyright (c) 2014 All Right Reserved, Liam Wickins
+
+Please see the LICENSE file for more information.
+
+THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY
+KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A
+PARTICULAR PURPOSE.
+"""
+
+import threading
+import collections
+import time
+
+class WorkQueue:
+
+  MAXSIZE = 8
+
+  # Back-pressure policies applied when the queue is full
+  BLOCK = 'block'              # Wait for space
+  DROPOLDEST = 'drop-oldest'   # Discard the item at the head
+  DROPNEWEST = 'drop-newest'   # Discard the item being added
+
+  def __init__(self, maxSize=MAXSIZE, policy=DROPOLDEST):
+    self.maxSize = maxSize
+    self.policy = policy
+    self.items = collections.deque()
+    self.cond = threading.Condition()
+    self.closed = False
+    self.generation = 0
+    self.enqueued = 0
+    self.dequeued = 0
+    self.dropped = 0
+    self.flushed = 0
+    self.maxDepth = 0
+    self.totalWait = 0.0
+
+  def Put(self, item, timeout=None):
+    """Adds an item, returning False if it was dropped or timed out"""
+    with self.cond:
+      if (self.closed):
+        return False
+      if (len(self.items) >= self.maxSize):
+        if (self.policy == self.DROPNEWEST):
+          self.dropped += 1
+          return False
+        elif (self.policy == self.DROPOLDEST):
+          self.items.popleft()
+          self.dropped += 1
+        else:
+          end = None if (timeout is None) else time.time() + timeout
+          while (len(self.items) >= self.maxSize and not self.closed):
+            remaining = None if (end is None) else end - time.time()
+            if (remaining is not None and remaining <= 0):
+              self.dropped += 1
+              return False
+            self.cond.wait(remaining)
+          if (self.closed):
+            return False
+      self.items.append((time.time(), item))
+      self.enqueued += 1
+      self.maxDepth = max(self.maxDepth, len(self.items))
+      self.cond.notify_all()
+      return True
+
+  def Get(self, timeout=None):
+    """Removes and returns (item, generation), or None on timeout or close"""
+    with self.cond:
+      end = None if (timeout is None) else time.time() + timeout
+      while (len(self.items) == 0):
+        if (self.closed):
+          return None
+        remaining = None if (end is None) else end - time.time()
+        if (remaining is not None and remaining <= 0):
+          return None
+        self.cond.wait(remaining)
+      stamp, item = self.items.popleft()
+      self.dequeued += 1
+      self.totalWait += time.time() - stamp
+      self.cond.notify_all()
+      return (item, self.generation)
+
+  def Flush(self):
+    """Discards all queued items and cancels the current generation"""
+    with self.cond:
+      self.flushed += len(self.items)
+      self.items.clear()
+      self.generation += 1
+      self.cond.notify_all()
+
+  def IsCurrent(self, generation):
+    return (generation == self.generation)
+
+  def GetGeneration(self):
+    return self.generation
+
+  def GetDepth(self):
+    with self.cond:
+      return len(self.items)
+
+  def GetOldestAge(self):
+    """Returns how long in seconds the head item has been waiting"""
+    with self.cond:
+      if (len(self.items) == 0):
+        return 0.0
+      return time.time() - self.items[0][0]
+
+  def GetStats(self):
+    with self.cond:
+      if (self.dequeued > 0):
+        meanWait = self.totalWait / self.dequeued
+      else:
+        meanWait = 0.0
+      oldest = time.time() - self.items[0][0] if (self.items) else 0.0
+      return { 'depth': len(self.items), 'maxDepth': self.maxDepth,
+               'enqueued': self.enqueued, 'dequeued': self.dequeued,
+               'dropped': self.dropped, 'flushed': self.flushed,
+               'oldestAge': oldest, 'meanWait': meanWait,
+               'generation': self.generation }
+
+  def Close(self):
+    """Wakes all waiters; Get returns None once the queue is empty"""
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()